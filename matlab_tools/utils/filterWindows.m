@@ -20,20 +20,66 @@ if isvector(windowsetInside)
     end
 end
 
+% Windows are sorted once and each query is answered by counting sorted
+% bounds (countSorted), O((N+M) log(N+M)) rather than testing every pair.
+nOut = size(windowsetOutside,1);
+nIn = size(windowsetInside,1);
+
+% Sorted bounds of inside windows with start <= end, number of these
+% windows containing x is (#starts <= x) - (#ends < x)
+valid = windowsetInside(:,1) <= windowsetInside(:,2);
+validStarts = sort(windowsetInside(valid,1));
+validEnds = sort(windowsetInside(valid,2));
+
 % window start is between stim bounds
-noStim_inds1=arrayfun(@(x)sum((x >= windowsetInside(:,1)).* (x<= windowsetInside(:,2)))==0, windowsetOutside(:,1));
+noStim_inds1 = countSorted(validStarts, windowsetOutside(:,1), true) - ...
+    countSorted(validEnds, windowsetOutside(:,1), false) == 0;
 
 % window end is between stim bounds
-noStim_inds2=arrayfun(@(x)sum((x >= windowsetInside(:,1)).* (x<= windowsetInside(:,2)))==0, windowsetOutside(:,2));
+noStim_inds2 = countSorted(validStarts, windowsetOutside(:,2), true) - ...
+    countSorted(validEnds, windowsetOutside(:,2), false) == 0;
 
-% window contains both stim bounds
-noStim_inds3=arrayfun(@(i)sum((windowsetOutside(i,1) <= windowsetInside(:,1)).* (windowsetOutside(i,2) >= windowsetInside(:,2)))== 0, (1:size(windowsetOutside,1)));
+% window contains both stim bounds: smallest end among inside windows
+% starting at or after the window start is within the window
+[inStarts, inOrder] = sort(windowsetInside(:,1));
+inEndsMin = flipud(cummin(flipud(windowsetInside(inOrder,2))));
+k = countSorted(inStarts, windowsetOutside(:,1), false) + 1;
+noStim_inds3 = true(nOut,1);
+has = k <= nIn;
+noStim_inds3(has) = inEndsMin(k(has)) > windowsetOutside(has,2);
 
-set1_exclusive_inds = logical(noStim_inds1.*noStim_inds2.*noStim_inds3');
+set1_exclusive_inds = noStim_inds1 & noStim_inds2 & noStim_inds3;
 set1_inclusive_inds = ~set1_exclusive_inds;
 
-set2_included_inds = arrayfun(@(i)sum((windowsetInside(i,1) >= windowsetOutside(:,1)).*...
-    (windowsetInside(i,2) <= windowsetOutside(:,2)))==1, (1:size(windowsetInside,1)));
+% Exactly one of the outside windows starting at or before the window start
+% ends at or after the window end: compare to largest and second largest end
+[outStarts, outOrder] = sort(windowsetOutside(:,1));
+outEnds = windowsetOutside(outOrder,2);
+outEndsMax1 = cummax(outEnds);
+outEndsMax2 = cummax(min(outEnds, [-Inf; outEndsMax1(1:end-1)]));
+k = countSorted(outStarts, windowsetInside(:,1), true);
+set2_included_inds = false(1,nIn);
+has = k > 0;
+set2_included_inds(has) = outEndsMax1(k(has)) >= windowsetInside(has,2) & ...
+    outEndsMax2(k(has)) < windowsetInside(has,2);
+
+
+end
 
 
-end
\ No newline at end of file
+function n = countSorted(vals, x, inclusive)
+% Number of vals <= x (inclusive) or < x for each x, by sorting vals and x
+% together. Ties sort vals before x when inclusive, after x otherwise.
+
+vals = vals(:);
+x = x(:);
+isVal = [true(numel(vals),1); false(numel(x),1)];
+tieKey = double(isVal == ~inclusive);
+[~, order] = sortrows([double([vals; x]), tieKey]);
+nVals = cumsum(isVal(order));
+
+n = zeros(numel(x),1);
+isX = ~isVal(order);
+n(order(isX) - numel(vals)) = nVals(isX);
+
+end
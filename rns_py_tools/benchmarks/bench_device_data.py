@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_device_data.py
+
+Compares write time and file size of Device_Data.mat written with
+hdf5storage.savemat (previous path) against device_data.writeDeviceData
+(chunked, with and without compression), and the time to read a single
+event back from each file.
+
+To run:
+    - cd to rns_py_tools
+    - python -m benchmarks.bench_device_data [n_events]
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import h5py
+import hdf5storage
+import numpy as np
+from functions import device_data
+
+EVENT_LEN = 90*250  # 90 second events at 250 Hz
+
+
+def synthetic_device_data(n_events, seed=0):
+    ''' ECoG-like int16 data: low frequency random walk plus noise, in 
+    [-512, 511] like mid-rail corrected RNS recordings '''
+    
+    rng = np.random.default_rng(seed)
+    n = n_events*EVENT_LEN
+    
+    walk = np.cumsum(rng.normal(0, 4, size=(n, 4)), axis=0)
+    for i_chan in range(4):
+        walk[:,i_chan] -= np.convolve(walk[:,i_chan], np.ones(250)/250, mode='same')
+    AllData = np.clip(walk + rng.normal(0, 8, size=(n, 4)), -512, 511).astype(np.int16)
+    
+    starts = np.arange(n_events)*EVENT_LEN
+    eventIdx = np.stack((starts, starts+EVENT_LEN-1), axis=1).astype(np.int32)
+    
+    return AllData, eventIdx
+
+
+def run(n_events=200):
+    
+    AllData, eventIdx = synthetic_device_data(n_events)
+    i_ev = n_events//2
+    
+    writers = {
+        'hdf5storage.savemat': lambda p: hdf5storage.savemat(
+            p, {"AllData": AllData, "EventIdx":eventIdx}, format ='7.3', 
+            oned_as='column', store_python_metadata=True),
+        'writeDeviceData (uncompressed)': lambda p: device_data.writeDeviceData(
+            p, AllData, eventIdx, compression=None),
+        'writeDeviceData (gzip 1 + shuffle)': lambda p: device_data.writeDeviceData(
+            p, AllData, eventIdx, compression_opts=1),
+        'writeDeviceData (gzip 4 + shuffle)': lambda p: device_data.writeDeviceData(
+            p, AllData, eventIdx),
+        }
+    
+    print('AllData: %d events, %d samples, %.1f MB in memory\n'%(
+        n_events, AllData.shape[0], AllData.nbytes/1e6))
+    print('%-36s %10s %10s %14s'%('writer', 'write (s)', 'size (MB)', 'read event (ms)'))
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, writer in writers.items():
+            mat_pth = os.path.join(tmp, 'Device_Data.mat')
+            
+            t0 = time.perf_counter()
+            writer(mat_pth)
+            t_write = time.perf_counter() - t0
+            
+            t0 = time.perf_counter()
+            with h5py.File(mat_pth, 'r') as f:
+                f['AllData'][:, eventIdx[i_ev,0]:eventIdx[i_ev,1]+1]
+            t_read = time.perf_counter() - t0
+            
+            print('%-36s %10.2f %10.1f %14.2f'%(name, t_write, 
+                  os.path.getsize(mat_pth)/1e6, t_read*1e3))
+            os.remove(mat_pth)
+        
+
+if __name__ == "__main__":
+    
+    run(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_filter_windows.py
+
+Compares the sorted/searchsorted utils.filterWindows against the previous 
+implementation, which tested every outside window against every inside 
+window, on stim windows matched against ECoG recording windows.
+
+To run:
+    - cd to rns_py_tools
+    - python -m benchmarks.bench_filter_windows [n_stims]
+
+"""
+
+import sys
+import time
+import numpy as np
+from functions import utils
+
+
+def legacy_filterWindows(windowsetOutside, windowsetInside):
+    # Previous utils.filterWindows O(N*M) implementation
+    
+    if np.ndim(windowsetInside) == 1:
+        windowsetInside = np.stack((windowsetInside, windowsetInside), axis=1)
+    
+    noStim_inds1 = np.array([np.sum((x >= windowsetInside[:, 0]) & (x <= windowsetInside[:, 1]))==0 for x in windowsetOutside[:, 0]])
+    noStim_inds2 = np.array([np.sum((x >= windowsetInside[:, 0]) & (x <= windowsetInside[:, 1]))==0 for x in windowsetOutside[:, 1]])
+    noStim_inds3 = np.array([np.sum((windowsetOutside[i, 0] <= windowsetInside[:, 0]) & (windowsetOutside[i, 1] >= windowsetInside[:, 1]))==0 for i in range(windowsetOutside.shape[0])])
+    
+    set1_exclusive_inds = (noStim_inds1 & noStim_inds2 & noStim_inds3)
+    set1_inclusive_inds = ~set1_exclusive_inds
+    
+    set2_included_inds = np.array([np.sum((windowsetInside[i, 0] >= windowsetOutside[:, 0]) & (windowsetInside[i, 1] <= windowsetOutside[:, 1]))==1 for i in range(windowsetInside.shape[0])])
+    
+    return set1_inclusive_inds, set1_exclusive_inds, set2_included_inds
+
+
+def _windows(rng, n, length, span):
+    # n sorted windows of random length up to length samples in [0, span)
+    
+    starts = np.sort(rng.integers(0, span, n))
+    return np.stack((starts, starts + rng.integers(1, length, n)), axis=1)
+
+
+def _time(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t0, out
+
+
+def run(n_stims=20000):
+    
+    # ~90 s ECoG recordings at 250 Hz, about one per 10 stims; short stims
+    rng = np.random.default_rng(0)
+    n_events = max(n_stims // 10, 1)
+    span = n_events * 22500
+    ecog = _windows(rng, n_events, 22500, span)
+    stims = _windows(rng, n_stims, 250, span)
+    
+    print('%d stim windows, %d ECoG windows\n'%(n_stims, n_events))
+    print('%-18s %12s %12s %9s'%('outside, inside', 'legacy (s)', 'sorted (s)', 'speedup'))
+    
+    for name, outside, inside in [('ecog, stims', ecog, stims), 
+                                  ('stims, ecog', stims, ecog),
+                                  ('stims, starts', stims, ecog[:,0])]:
+        t_legacy, out_legacy = _time(legacy_filterWindows, outside, inside)
+        t_new, out_new = _time(utils.filterWindows, outside, inside)
+        
+        assert all((a == b).all() for a, b in zip(out_new, out_legacy))
+        
+        print('%-18s %12.4f %12.4f %8.1fx'%(name, t_legacy, t_new, t_legacy/t_new))
+    
+
+if __name__ == "__main__":
+    
+    run(*[int(x) for x in sys.argv[1:2]])
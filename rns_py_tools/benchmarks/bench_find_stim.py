@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_find_stim.py
+
+Measures stim_detection.findStim throughput (samples/sec) on synthetic
+AllData read through a memmap, with 90 s events containing periodic stims,
+for different numbers of threads.
+
+To run:
+    - cd to rns_py_tools
+    - python -m benchmarks.bench_find_stim [n_events]
+
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from functions import stim_detection
+
+
+def _allData(rng, n_events, event_len=22500):
+    # Noisy events with a flat 0.2 s stim on 3-4 channels every ~5 s
+
+    data = rng.integers(-300, 300, (n_events*event_len, 4)).astype(np.int16)
+    eventStarts = np.arange(n_events)*event_len
+
+    for i_start in range(100, data.shape[0] - 100, 1250):
+        data[i_start:i_start + 50, :rng.integers(3, 5)] = rng.integers(-50, 50)
+
+    return data, eventStarts
+
+
+def run(n_events=200):
+
+    rng = np.random.default_rng(0)
+    [data, eventStarts] = _allData(rng, n_events)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dat_file = os.path.join(tmp, 'AllData.dat')
+        data.tofile(dat_file)
+        n_samples = data.shape[0]
+        del data
+
+        mm = np.memmap(dat_file, dtype=np.int16, mode='r').reshape(-1, 4)
+
+        print('%d events, %d samples\n'%(n_events, n_samples))
+        print('%-8s %10s %10s %14s'%('threads', 'stims', 'time (s)', 'samples/sec'))
+
+        out = None
+        for n_jobs in [1, 2, 4, 8]:
+            t0 = time.perf_counter()
+            [SSI, stats] = stim_detection.findStim(mm, eventStarts, n_jobs=n_jobs)
+            t = time.perf_counter() - t0
+
+            assert out is None or (SSI == out).all()
+            out = SSI
+
+            print('%-8d %10d %10.3f %14.3g'%(n_jobs, SSI.shape[0], t, n_samples/t))
+
+        del mm
+
+
+if __name__ == "__main__":
+
+    run(*[int(x) for x in sys.argv[1:2]])
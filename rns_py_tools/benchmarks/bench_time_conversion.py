@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_time_conversion.py
+
+Compares the vectorized timestamp conversions in utils (str2usec, usec2dt64,
+usec2str) against the previous per-element datetime implementations of 
+str2dt_usec and posix2dt_UTC on catalog-sized inputs. 
+
+To run:
+    - cd to rns_py_tools
+    - python -m benchmarks.bench_time_conversion [n_rows]
+
+"""
+
+import sys
+import time
+import datetime as DT
+import numpy as np
+import pandas as pd
+from functions import utils
+
+
+def legacy_str2dt_usec(s):
+    # Previous utils.str2dt_usec list implementation
+    EPOCH = DT.datetime(1970,1,1)
+    dt = [DT.datetime.strptime(x,"%Y-%m-%d %H:%M:%S.%f") for x in s]
+    return [int((x - EPOCH).total_seconds() * 1000000) for x in dt]
+
+
+def legacy_posix2dt_UTC(psx):
+    # Previous utils.posix2dt_UTC list implementation
+    return [DT.datetime.utcfromtimestamp(x*10**-6) for x in psx]
+
+
+def legacy_usec2str(psx):
+    # Previous annotation label formatting in pennsieve_tools
+    return [DT.datetime.strftime(x, "%Y-%m-%d %H:%M:%S.%f")[:-3] for x in legacy_posix2dt_UTC(psx)]
+
+
+def _time(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t0, out
+
+
+def run(n_rows=50000):
+    
+    rng = np.random.default_rng(0)
+    usec = np.sort(rng.integers(1.5e15, 1.7e15, n_rows)) // 1000 * 1000
+    col = pd.Series(utils.usec2str(usec))
+    
+    cases = [
+        ('string -> usec', legacy_str2dt_usec, col.tolist(), utils.str2usec, col),
+        ('usec -> datetime', legacy_posix2dt_UTC, usec, utils.usec2dt64, usec),
+        ('usec -> string', legacy_usec2str, usec, utils.usec2str, usec),
+        ]
+    
+    print('%d catalog rows\n'%n_rows)
+    print('%-18s %12s %12s %9s'%('conversion', 'legacy (s)', 'vector (s)', 'speedup'))
+    
+    for name, legacy_fn, legacy_in, vec_fn, vec_in in cases:
+        t_legacy, out_legacy = _time(legacy_fn, legacy_in)
+        t_vec, out_vec = _time(vec_fn, vec_in)
+        
+        if name == 'usec -> datetime':
+            assert (pd.DatetimeIndex(out_vec).to_pydatetime() == np.array(out_legacy)).all()
+        else:
+            assert list(out_vec) == list(out_legacy)
+        
+        print('%-18s %12.4f %12.4f %8.1fx'%(name, t_legacy, t_vec, t_legacy/t_vec))
+    
+
+if __name__ == "__main__":
+    
+    run(*[int(x) for x in sys.argv[1:2]])
@@ -12,6 +12,11 @@ Functions in this file:
     NPdat2vector(dataFolder, catalog_csv)
     NPgetDataPath
     NPdat2mef
+    createConcatDatLayFiles
+    planConcatDatFiles
+    
+    DatFile(dat_file, enabled)
+    DatTime(start_usec, fs, n_samples)
     
     helper functions
 
@@ -20,28 +25,151 @@ Functions in this file:
 import glob
 import numpy as np
 import pandas as pd
-from pandas import DateOffset
 import sys
-import re
 import datetime as DT
 import os
 import logging
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from os import path as pth
 from functions import utils as utils
+from functions import box_sync
+from functions.ecog_catalog import EcogCatalog, asCatalog
 
 # Constants
 NUM_CHANNELS = 4
 SAMPLING_RATE = 250
+MID_RAIL = 512
+COPY_CHUNK_SAMPLES = 2**18
 
 
-def NPdownloadNewBoxData(ptID, config, client):
+class DatTime(namedtuple('DatTime', ['start_usec', 'fs', 'n_samples'])):
+    '''
+    Compact time descriptor of a single .dat recording, replaces a dense
+    per-sample time vector.
+    
+    Attributes:
+        start_usec (int): UTC start time of the recording in posix microseconds
+        fs (int): sampling rate (Hz)
+        n_samples (int): number of samples per channel
     '''
-    Download new NeuroPace data from Box.com
+    __slots__ = ()
+    
+    def vector(self):
+        ''' Returns the dense time vector (usec) of the recording '''
+        return self.start_usec + np.arange(self.n_samples)/self.fs*10**6
 
+
+class DatFile:
+    '''
+    Read-only, memory-mapped view of a single NeuroPace .dat file. Samples 
+    are only read from disk when accessed, and channels that were off during 
+    the recording are never stored.
+    
     Args:
-        folderID (str): id of root box folder (can be found in box folder URL)
-        path (str): DESCRIPTION.
-        client (OAuth2): DESCRIPTION.
+        dat_file (str): path to .dat file
+        enabled (list of bool): True for each of the NUM_CHANNELS channels that
+            was enabled during the recording
+            
+    Attributes:
+        raw (np.memmap): (n_samples, # enabled channels) interleaved int16 
+            data as stored on disk (no mid-rail offset correction)
+        n_samples (int): number of samples per channel
+        
+    Example:
+        datf = DatFile('/path/to/12345.dat', [True, False, False, True])
+        ch1 = datf.channel(0)
+        fdata = datf.toArray()
+    '''
+    
+    def __init__(self, dat_file, enabled):
+        
+        self.path = dat_file
+        self.enabled = np.array(enabled, dtype=bool).reshape(-1)
+        assert self.enabled.size == NUM_CHANNELS, 'Expected %d channel flags'%NUM_CHANNELS
+        
+        num_enabled = int(self.enabled.sum())
+        nbytes = os.stat(dat_file).st_size
+        
+        if nbytes % (2*num_enabled):
+            raise ValueError('%s size (%d bytes) does not match %d enabled channels'
+                             %(pth.basename(dat_file), nbytes, num_enabled))
+        
+        self.n_samples = nbytes // (2*num_enabled)
+        
+        # np.memmap cannot map empty files
+        if self.n_samples:
+            self.raw = np.memmap(dat_file, dtype=np.int16, mode='r', 
+                                 shape=(self.n_samples, num_enabled))
+        else:
+            self.raw = np.empty((0, num_enabled), dtype=np.int16)
+        
+        # Column of self.raw holding each channel, -1 if channel is off
+        self._cols = np.cumsum(self.enabled) - 1
+        self._cols[~self.enabled] = -1
+        
+        
+    def rawChannel(self, i_chan):
+        ''' Strided (zero-copy) view of channel i_chan (0-indexed) as stored 
+        on disk, None if the channel is off'''
+        
+        col = self._cols[i_chan]
+        if col < 0:
+            return None
+        return self.raw[:, col]
+    
+    
+    def channel(self, i_chan):
+        '''
+        Mid-rail corrected data of channel i_chan (0-indexed). Off channels 
+        are returned as a read-only zero array that takes no memory.
+        '''
+        
+        col = self._cols[i_chan]
+        if col < 0:
+            return np.broadcast_to(np.int16(0), (self.n_samples,))
+        return np.subtract(self.raw[:, col], MID_RAIL, dtype=np.int16)
+    
+        
+    def toArray(self, out=None):
+        '''
+        Mid-rail corrected data of all channels, off channels are zero-padded.
+
+        Args:
+            out (np.array, optional): (n_samples, NUM_CHANNELS) array to fill
+                in place (may be a view into a larger array). 
+
+        Returns:
+            (n_samples, NUM_CHANNELS) int16 array
+        '''
+        
+        if out is None:
+            out = np.empty((self.n_samples, NUM_CHANNELS), dtype=np.int16)
+        
+        for i_chan in range(NUM_CHANNELS):
+            col = self._cols[i_chan]
+            if col < 0:
+                out[:, i_chan] = 0
+            else:
+                np.subtract(self.raw[:, col], MID_RAIL, out=out[:, i_chan], casting='unsafe')
+        
+        return out
+
+
+def NPdownloadNewBoxData(ptID, config, client, full=False):
+    '''
+    Download new NeuroPace data from Box.com. Only files that are new or 
+    changed since the last sync, recorded in the patient's Box manifest, are
+    downloaded.
+
+    Args:
+        ptID (str): patient ID
+        config (dict): config dictionary, with box root folder id 
+            (config['boxKeys']['Folder_ID'], can be found in box folder URL)
+        client (OAuth2): authenticated Box client
+        full (bool, optional): list every remote folder, even if unchanged
+            since the last sync. Defaults to False.
 
     Returns:
         None.
@@ -51,51 +179,23 @@ def NPdownloadNewBoxData(ptID, config, client):
     folderID= config['boxKeys']['Folder_ID']
     path = config['paths']['RNS_RAW_Folder']
     
-    ptFolders = client.folder(folder_id=folderID).get_items()
+    [_, ptFolders] = box_sync.listFolder(client, folderID)
 
     rt = pth.basename(NPgetDataPath(ptID, config, 'root folder'))
-    ptFolder = [i for i in ptFolders if i.name == rt][0]
+    ptFolder = ptFolders[rt]
     
     logging.info('Updating %s...'%ptFolder.name)
-    fpath= os.path.join(path, ptFolder.name)
-        
-    if not os.path.exists(fpath):
-        _downloadAll(ptFolder.id, path, 0, client)
-    else:
-        
-        # Download the CSV catalog and read into variable
-        pat = re.compile('.*ECoG_Catalog.csv')
-        try:
-            ecog_catalog =[item for item in ptFolder.get_items() if pat.match(item.name)][0]
-            output_file = open(os.path.join(fpath, ecog_catalog.name), 'wb')
-            client.file(file_id=ecog_catalog.id).download_to(output_file)
-            output_file.close()
-            logging.info('     Ecog_Catalog updated')
-        except IndexError:
-            logging.error('ECoG_Catalog.csv missing in %s'%(ptFolder.name))
-            return
-        
-        # Download the Histograms
-        try: 
-            rh = re.compile('.*Histograms*')
-            hist_folder =[item for item in ptFolder.get_items() if rh.match(item.name)][0]
-            _downloadAll(hist_folder.id, fpath, 0, client)
-            logging.info('     Histograms updated')
-        except IndexError:
-            logging.warning('Histogram Folder missing in %s'%(ptFolder.name))
-            pass
-            
-        # Download new Episode Durations files from box that are not local 
-        try:
-            _helper_downloadNew('.*EpisodeDurations*', ptFolder, fpath, client)
-            logging.info('     Episode Durations updated')
-        except IndexError:
-            logging.warning('Episode Durations missing in %s'%(ptFolder.name))
-        
-
-        # Download new Data files from box that are not local 
-        _helper_downloadNew('.*Data*', ptFolder, fpath, client)
-        logging.info('     Dat files updated')
+    
+    # Download new and changed files (ECoG catalog, Histograms, Episode 
+    # Durations and Data files) since the last sync
+    manifest = box_sync.BoxManifest(NPgetDataPath(ptID, config, 'box manifest'))
+    summary = box_sync.syncFolder(client, ptFolder, path, manifest, full=full)
+    
+    logging.info('     %d files updated, %d unchanged, %d folders listed'
+                 %(summary['downloaded'], summary['skipped'], summary['listed']))
+    
+    if not pth.exists(NPgetDataPath(ptID, config, 'ecog catalog')):
+        logging.error('ECoG_Catalog.csv missing in %s'%(ptFolder.name))
 
 
 def NPdeidentifier(ptID, config):
@@ -184,6 +284,7 @@ def NPgetDataPath(ptID, config, NPDataName):
            * Daily Histogram
            * Hourly Histogram
            * Episode Durations Folder
+           * Box Manifest
             
     Returns:
         string: path to NeuroPace data file or folder
@@ -202,13 +303,37 @@ def NPgetDataPath(ptID, config, NPDataName):
         'hourly histogram': pth.join(fld, prefix + ' Histograms EXTERNAL #PHI', prefix + '_Histogram_Hourly.csv'),
         'daily histogram':  pth.join(fld, prefix + ' Histograms EXTERNAL #PHI', prefix + '_Histogram_Daily.csv'),
         'dat folder':       pth.join(fld, prefix + ' Data EXTERNAL #PHI'),
-        'episode durations folder': pth.join(fld, prefix + ' EpisodeDurations EXTERNAL #PHI')
+        'episode durations folder': pth.join(fld, prefix + ' EpisodeDurations EXTERNAL #PHI'),
+        'box manifest':     pth.join(config['paths']['RNS_RAW_Folder'], prefix + '_Box_Manifest.json')
             }
     
     return switcher.get(NPDataName.lower(), "File/Folder not found")
 
 
-def NPdat2mat(ptID, config):
+def NPdat2mat(ptID, config, memmap_path=None, n_jobs=1, catalog_inds=None):
+    '''
+    Aggregates all of a patient's .dat files into a single data array. Files 
+    are sized from disk and the catalog's enabled channels first, so AllData 
+    is allocated once and filled in place.
+
+    Args:
+        ptID (string): patient ID
+        config (dict): config.json dictionary
+        memmap_path (str, optional): if given, AllData is allocated as a 
+            disk-backed np.memmap at this path instead of in memory. 
+            Defaults to None.
+        n_jobs (int, optional): number of worker processes used to decode 
+            .dat files. Workers write their files directly into a memmapped
+            AllData. Defaults to 1.
+        catalog_inds ([int], optional): ecog catalog rows to aggregate. 
+            Defaults to None (all rows).
+
+    Returns:
+        AllData: (n_samples, NUM_CHANNELS) C-contiguous int16 array
+        eventIdx: (n_events, 2) int32 array of first and last AllData index 
+            of each event
+        dneIdx: list of ecog catalog rows without an associated .dat file
+    '''
     
     dataFolder = NPgetDataPath(ptID, config, 'Dat Folder')
     catalog_csv = NPgetDataPath(ptID, config, 'ECoG Catalog')
@@ -220,31 +345,36 @@ def NPdat2mat(ptID, config):
     ecog_df['Patient ID']= ptID
 
     _checkDatFolderEcogConcordance(ecog_df, NumberOfFiles)
-
-    ctr = 0
     
-    AllData = []
-    eventIdx = []
-    dneIdx = []
+    if catalog_inds is None:
+        catalog_inds = range(ecog_df.shape[0])
+    catalog_inds = list(catalog_inds)
+    ecog_df = ecog_df.iloc[catalog_inds]
     
-    for i_file in range(0,ecog_df.shape[0]):
-            
-        try:
-            [fdata, ftime, t_conversion_usec] = _readDatFile(dataFolder, ecog_df.iloc[[i_file]])
-            dlen = fdata.shape[1]
-            AllData.append(fdata)
-            eventIdx.append(ctr + np.array([0,dlen-1]))
-            ctr = ctr + dlen
-            
-        except (FileNotFoundError):
-            logging.error('File %s not found'%(ecog_df['Filename'][i_file]))
-            dneIdx.append(i_file)
-            
-
-    AllData = np.concatenate(AllData, axis = 1)
-    AllData = AllData.astype('int16').T
-    eventIdx = np.array(eventIdx)
-    eventIdx = eventIdx.astype('int32')
+    enabled = _getEnabledChs(ecog_df)
+    fnames = ecog_df['Filename'].tolist()
+    
+    # First pass: get sample count of each file
+    [dlens, dneIdx] = _getDatLengths(dataFolder, ecog_df, enabled)
+    dneIdx = [catalog_inds[i] for i in dneIdx]
+        
+    ends = np.cumsum(dlens[dlens >= 0])
+    starts = ends - dlens[dlens >= 0]
+    eventIdx = np.stack((starts, ends-1), axis=1).astype('int32')
+    
+    n_samples = int(ends[-1]) if ends.size else 0
+    
+    # Second pass: decode each file directly into its slice of AllData
+    found = np.where(dlens >= 0)[0]
+    tasks = [(pth.join(dataFolder, fnames[i_file]), enabled[i_file], 
+              starts[i_event], ends[i_event]) for i_event, i_file in enumerate(found)]
+    
+    if n_jobs > 1 and n_samples:
+        AllData = _parallelFillAllData(tasks, n_samples, n_jobs, memmap_path)
+    else:
+        AllData = _allocAllData(n_samples, memmap_path)
+        for [dat_file, ch_enabled, i_start, i_end] in tasks:
+            DatFile(dat_file, ch_enabled).toArray(out=AllData[i_start:i_end])
 
     assert eventIdx.shape[0] == ecog_df.shape[0]-len(dneIdx)
 
@@ -280,7 +410,8 @@ def NPdat2mef(ptID, config):
         
         try:
             
-            [fdata, ftime, t_conversion_usec] = _readDatFile(dataFolder, ecog_df.iloc[[i_file]])
+            [datf, ftime, t_conversion_usec] = _readDatFile(dataFolder, ecog_df.iloc[[i_file]],
+                                                            memmap=True)
         
             # Create mef subfolder, skip creation if mef folder already exists
             if pth.isdir(pth.join(dpath, fname)):
@@ -291,14 +422,17 @@ def NPdat2mef(ptID, config):
             blockSize = round(4000/SAMPLING_RATE)
             th = 100000
             
+            t_vec = ftime.vector().astype('l')
+            
             for i_chan in range(0,NUM_CHANNELS):
                 
                 chanLabel= '%s_C%d.mef'%(ptID, i_chan+1)
+                chdata = datf.channel(i_chan)
                 
-                logging.debug(fdata[i_chan][:])
+                logging.debug(chdata)
                 
                 mw = MefWriter(pth.join(dpath, fname, chanLabel), blockSize, SAMPLING_RATE, th)
-                mw.writeData((fdata[i_chan][:]).astype(int), ftime.astype('l'), fdata.shape[1])
+                mw.writeData(chdata.astype(int), t_vec, ftime.n_samples)
                 mw.setInstitution(inst);
                 mw.setSubjectID(ptID);
                 mw.setChannelName(chanLabel[0:-4]);
@@ -306,7 +440,7 @@ def NPdat2mef(ptID, config):
                 mw.close()  
                 
         except(FileNotFoundError):
-            logging.Error('File %s not found'%(ecog_df['Filename'][i_file]))
+            logging.error('File %s not found'%(ecog_df['Filename'][i_file]))
             continue
         
     return None
@@ -321,7 +455,7 @@ def createConcatDatLayFiles(ptID, config, ecog_df, newFilename, newFilePath):
     Args:
         ptID (string): patient ID
         config (object): config file
-        ecog_df (Pandas dataframe): ecog dataframe containing rows corresponding to data to concatenate
+        ecog_df (Pandas dataframe or EcogCatalog): ecog catalog containing rows corresponding to data to concatenate
         newFilename (string): Name for concatenated file (extension should be omitted).
         newFilePath (string): Path to folder for concatenated output files
 
@@ -338,152 +472,40 @@ def createConcatDatLayFiles(ptID, config, ecog_df, newFilename, newFilePath):
     '''
 
     try:
-        assert isinstance(ecog_df, pd.DataFrame)
+        assert isinstance(ecog_df, (pd.DataFrame, EcogCatalog))
     except AssertionError as err:
-        logging.error('Expected a DataFrame input')
+        logging.error('Expected a DataFrame or EcogCatalog input')
         raise err
 
     # General file info variables, 
-    dataFolder = NPgetDataPath(ptID, config, 'Dat Folder')
     datcat = pth.join(newFilePath, '%s.dat' % newFilename)
     
-    # First remove rows in ecog_df if associated .dat files are missing
-    fnames = os.listdir(dataFolder);
-    isin = np.array([x in fnames for x in ecog_df.Filename.tolist()])
-    if (~isin).any():
-        idx = np.where(~isin)[0]
-        logging.warning('Files not in data folder, skipping associated rows ' +
-                        'in ecog.csv: %s'%ecog_df.iloc[idx].Filename.tolist())
-        ecog_df = ecog_df.loc[isin, :]
-        if ecog_df.empty:
-            return {}
-              
-    # Sort by files by UTC start times
-    start_utc,_,_,_ = _getTimeStrings(ecog_df)
-    srt_inds = np.argsort(start_utc)
-    datfiles = ecog_df['Filename'].tolist()
-    datfiles = [datfiles[i] for i in srt_inds]
-
-    datFileCount = len(datfiles)
-
-    # Lists are appended and then written to .lay
-    startTimes = []
-    datSizes = []
-
-    # For edge case with only one file in a month (while loop won't run as is in range(0, 0))
-    if datFileCount == 1:
-        target1_name = datfiles[0]
-        target1 = pth.join(dataFolder, target1_name)
-        
-        _catExporter(ecog_df, datcat, target1)
-
-        rawUTC1 = pd.Timestamp(ecog_df.loc[ecog_df['Filename'] == target1_name, 'Raw UTC timestamp'].iloc[0])
-        ecog_PTL1 = ecog_df.loc[ecog_df['Filename'] == target1_name, 'ECoG pre-trigger length'].iloc[0]
-        start1 = rawUTC1 - DateOffset(seconds=ecog_PTL1)
-
-        startTimes.append(start1)
-        datSizes.append(pth.getsize(target1))
-
-    # Primary loop, compare_pass used to iterate through files
-    rm_bytes = {}
-    compare_pass = 0
-    while compare_pass in range(0, datFileCount - 1):
-
-        # File names and paths vars
-        target1_name = datfiles[compare_pass] 
-        target1 = pth.join(dataFolder, target1_name)
-        target2_name = datfiles[compare_pass + 1]
-        target2 = pth.join(dataFolder, target2_name)
-
-        # Time vars (could be streamlined but would result in really long definitions)
-        rawUTC1 = pd.Timestamp(ecog_df.loc[ecog_df['Filename'] == target1_name, 'Raw UTC timestamp'].iloc[0])
-        ecog_PTL1 = ecog_df.loc[ecog_df['Filename'] == target1_name, 'ECoG pre-trigger length'].iloc[0]
-        ecog_L1 = ecog_df.loc[ecog_df['Filename'] == target1_name, 'ECoG length'].iloc[0]
-        t2end1 = ecog_L1 - ecog_PTL1
-        start1 = rawUTC1 - DateOffset(seconds=ecog_PTL1)
-        end1 = rawUTC1 + DateOffset(seconds=t2end1)
-
-        rawUTC2 = pd.Timestamp(ecog_df.loc[ecog_df['Filename'] == target2_name, 'Raw UTC timestamp'].iloc[0])
-        ecog_PTL2 = ecog_df.loc[ecog_df['Filename'] == target2_name, 'ECoG pre-trigger length'].iloc[0]
-        start2 = rawUTC2 - DateOffset(seconds=ecog_PTL2)
-
-
-        try:
-            assert start1 <= start2
-        except AssertionError as err:
-            logging.error('Start times out of order %s:%s, %s:%s'%(target1_name, 
-                                                                      start1.strftime("%m/%d/%Y, %H:%M:%S"),
-                                                                      target2_name,                                                                     start2.strftime("%m/%d/%Y, %H:%M:%S")))
-            raise err
-        
-        # Uses latest known end
-        total_end = pd.Timestamp(ecog_df['Raw UTC timestamp'].iloc[0]) - DateOffset(
-            seconds=ecog_df['ECoG pre-trigger length'].iloc[0])
-        if end1 > total_end:
-            total_end = end1
-
-        # Amount of time overlap (both forms used)
-        overlapTimeSeconds = pd.Timedelta.total_seconds(total_end - start2)
-        overlapTimedelta = pd.Timedelta(total_end - start2)
-
-        # Overlap in bytes based on off chs
-        chs2 = _getOffChs(ecog_df, target2_name)
-        bytes2del = overlapTimeSeconds * 500 * (4 - len(chs2))
-
-        # In the event file is completely overlapped
-        if bytes2del >= pth.getsize(target2):
-            datfiles.remove(target2_name)
-            
-            bytes2del = pth.getsize(target2)
-            overlapTimeSeconds = bytes2del / 500 / (4 - len(chs2))
-            overlapTimedelta = pd.to_timedelta(overlapTimeSeconds, 's')
-            
-            rm_bytes[target2_name] = bytes2del
-            
-            datFileCount -= 1
-            continue
-
-        # < 0 as in no overlap, so just sends files to be concatenated
-        if overlapTimeSeconds < 0:
-            if compare_pass == 0:
-                # For first step, where first file needs to be concatenated as well
-                _catExporter(ecog_df, datcat, target1)
-                startTimes.append(start1)
-                datSizes.append(pth.getsize(target1))
-            _catExporter(ecog_df, datcat, target2)
-            startTimes.append(start2)
-            datSizes.append(pth.getsize(target2))
-            compare_pass += 1
-
-        # In the event that overlap exists, sends files to be concatenated along with amount to drop of second file
-        if overlapTimeSeconds >= 0:
-
-            logging.info('Overlap found, between %s and %s'%(target1_name, target2_name))
-            logging.info('Bytes to delete bytes2del %d, File1 start: %s'%(bytes2del, start1.strftime("%m/%d/%Y, %H:%M:%S")))
-
-            start2new = start2 + overlapTimedelta
-            
-            rm_bytes[target2_name] = bytes2del
-            
-            if compare_pass == 0:
-                _catExporter(ecog_df, datcat, target1)
-                startTimes.append(start1)
-                datSizes.append(pth.getsize(target1))
-                
-            _catExporter(ecog_df, datcat, target2, int(bytes2del))
-            startTimes.append(start2new)
-            datSizes.append(pth.getsize(target2) - int(bytes2del))
-            compare_pass += 1
+    [plan, catalog] = _planConcatFiles(ptID, config, ecog_df)
+    if plan.empty:
+        return {}
+    ecog_df = catalog.df
+    dataFolder = catalog.dataFolder
+    
+    # Execute plan, appending kept files (minus overlap) to concatenated file
+    kept = plan[plan['Keep']]
+    with open(datcat, 'wb', buffering=0) as out:
+        for fname, trim in zip(kept['Filename'], kept['Trim bytes']):
+            _catExporter(catalog, out, pth.join(dataFolder, fname), int(trim))
+    
+    # Dictionary of filenames and bytes removed from each
+    overlapped = plan[plan['Overlap usec'] >= 0]
+    rm_bytes = {f: int(b) for f, b in zip(overlapped['Filename'], overlapped['Trim bytes'])}
 
 
     # Below section creates corresponding .lay file
 
     # Sample indices corresponding to each .dat segment
-    i_samp = np.cumsum([0] + [int(x / 2 / (4 - len(_getOffChs(ecog_df, i))))
-                              for i, x in zip(datfiles, datSizes)])
+    i_samp = np.append(kept['Sample offset'].values, 
+                       kept['Sample offset'].values[-1] + kept['Samples'].values[-1])
+    startTimes = kept['Start usec'].tolist()
 
     dat_fnames = [x[:-4] for x in ecog_df['Filename']]
-    EPOCH = pd.Timestamp('1970-1-1')
+    t0 = pd.Timestamp(startTimes[0], unit='us')
     
     logging.debug(i_samp)
 
@@ -504,13 +526,13 @@ def createConcatDatLayFiles(ptID, config, ecog_df, newFilename, newFilePath):
                 'ID=%s\n' % ptID,
                 'Birthdate=\n',
                 'Sex=\n',
-                'TestDate=%s\n' % startTimes[0].strftime("%m/%d/%Y"),
-                'TestTime=%s\n' % startTimes[0].strftime("%H:%M:%S.%f"),
+                'TestDate=%s\n' % t0.strftime("%m/%d/%Y"),
+                'TestTime=%s\n' % t0.strftime("%H:%M:%S.%f"),
                 'Comments1=\n',
                 'Technician=\n\n',
 
                 '[SampleTimes]\n'
-                ] + ['%s=%s\n' % (x, pd.Timedelta.total_seconds(y - EPOCH))
+                ] + ['%s=%s\n' % (x, y / 10**6)
                      for x, y in zip(i_samp[:-1], startTimes)
                      ] + [
                    '\n[ChannelMap]\n',
@@ -527,65 +549,95 @@ def createConcatDatLayFiles(ptID, config, ecog_df, newFilename, newFilePath):
     return rm_bytes
 
 
+def planConcatDatFiles(ptID, config, ecog_df):
+    '''
+    Plans the concatenation done by createConcatDatLayFiles without reading
+    or writing any data. Files are ordered by start time, and each file's 
+    overlap with all earlier files is found in a single pass using the 
+    running maximum end time. Fully overlapped files are skipped, partially
+    overlapped files are trimmed by whole samples from their start.
+    
+    Args:
+        ptID (string): patient ID
+        config (object): config file
+        ecog_df (Pandas dataframe or EcogCatalog): ecog catalog rows to concatenate
+    
+    Returns:
+        plan (DataFrame): one row per .dat file with an associated file, in
+        concatenation order, with columns
+            Filename
+            Keep: False if file is completely overlapped by earlier files
+            Overlap usec: overlap with earlier files (< 0 if none)
+            Trim bytes: bytes dropped from the start of the file
+            Start usec: UTC start of the file's kept data (posix usec)
+            Samples: kept samples per channel
+            Sample offset: index of first kept sample in concatenated file
+            
+    Example:
+        plan = planConcatDatFiles(ptID, config, ecog_df.iloc[mon_inds])
+        plan.to_csv('month_plan.csv')
+    '''
+    
+    return _planConcatFiles(ptID, config, ecog_df)[0]
+
+
 #### Helper Functions #####
 
-def _helper_downloadNew(folder_keyword, parent_folder_box, fpath, client):
-        
-   pat = re.compile(folder_keyword)
-   box_fold= [item for item in parent_folder_box.get_items() if pat.match(item.name)][0]
-   box_filenames =  [i.name for i in box_fold.get_items()]
+def _planConcatFiles(ptID, config, ecog_df):
+    # Returns concatenation plan and catalog of rows with existing .dat files
     
-   try:
-        local_fold = [item for item in os.listdir(fpath) if pat.match(item)][0]
-        local_filenames = os.listdir(os.path.join(fpath, local_fold))
-        
-        download_inds = [i for i, x in enumerate(box_filenames) if x not in local_filenames]
-        ids = [i.id for i in box_fold.get_items()]
-        
-        logging.info('Downloading %s new files to %s'%(len(download_inds), local_fold))
-        
-        for ind in download_inds:
-            output_file= open(os.path.join(fpath, box_fold.name, box_filenames[ind]), 'wb')
-            client.file(file_id=ids[ind]).download_to(output_file)
-            output_file.close()
+    dataFolder = NPgetDataPath(ptID, config, 'Dat Folder')
+    catalog = asCatalog(ecog_df, dataFolder)
     
-   except (IndexError, FileNotFoundError):
-       logging.error('Local folder %s not found, downloading all'%(box_fold.name))
-       _downloadAll(box_fold.id, fpath, 0)
-       pass
-            
-   return
-
-# recursively download all NeuroPace files in boxFolder
-def _downloadAll(folderID, path, ctr, client):
-    """ folderID: box folder ID
-        path: path where folder should be downloaded (don't include name of folder being downloaded
-        ctr: used to print progress
-    """          
-                        
-    folder = client.folder(folder_id=folderID).get()
-    items = client.folder(folder_id=folderID).get_items()
-
-    if not os.path.exists(os.path.join(path, folder.name)):
-        os.makedirs(os.path.join(path, folder.name))
-        
-
-    # mkdir folder name
-    for item in items:
-        # If item is a folder
-        if item.type == 'folder':
-            print(item.name)
-            _downloadAll(item.id, os.path.join(path, folder.name), ctr)
-        # output_file = open('file.pdf', 'wb')
-        elif item.type == 'file':
-            if item.name[0] == '.':
-                continue
-            ctr = ctr+1
-            if ctr%20 == 0:
-                print('Downloading' + pth.join(path, folder.name, item.name) + 'ctr %d'%ctr)
-            output_file = open(pth.join(path, folder.name, item.name), 'wb')
-            client.file(file_id=item.id).download_to(output_file)
-            output_file.close()
+    # First remove rows in ecog_df if associated .dat files are missing
+    isin = catalog.nbytes >= 0
+    if (~isin).any():
+        idx = np.where(~isin)[0]
+        logging.warning('Files not in data folder, skipping associated rows ' +
+                        'in ecog.csv: %s'%catalog.filenames[idx].tolist())
+        catalog = catalog.subset(isin)
+        
+    # Sort by files by UTC start times
+    srt = np.argsort(catalog.timestamp_usec, kind='stable')
+    fnames = catalog.filenames[srt]
+    start = catalog.start_usec[srt]
+    nchs = catalog.n_enabled[srt]
+    end = catalog.end_usec[srt]
+    nbytes = catalog.nbytes[srt]
+    fs = catalog.df['Sampling rate'].values[srt].astype(np.int64)
+    
+    if (np.diff(start) < 0).any():
+        i = np.where(np.diff(start) < 0)[0][0]
+        logging.error('Start times out of order %s:%s, %s:%s'%(fnames[i], utils.usec2str(start[i]),
+                                                              fnames[i+1], utils.usec2str(start[i+1])))
+        raise AssertionError('Start times out of order')
+    
+    # Samples in each file, overlaps use the catalog's ECoG length end times
+    n_samp = nbytes // (2*nchs)
+    
+    # Overlap with the latest end of all previous files. A skipped file never 
+    # extends the running maximum, since it ends before the maximum.
+    overlap = np.full(len(fnames), -1, dtype=np.int64)
+    overlap[1:] = np.maximum.accumulate(end)[:-1] - start[1:]
+    is_overlap = overlap >= 0
+    
+    keep = ~(is_overlap & (overlap*fs/10**6 >= n_samp))
+    trim_samp = np.where(is_overlap & keep, -(-overlap*fs // 10**6), 0)
+    samples = np.where(keep, n_samp - trim_samp, 0)
+    
+    plan = pd.DataFrame({'Filename': fnames,
+                         'Keep': keep,
+                         'Overlap usec': overlap,
+                         'Trim bytes': np.where(keep, trim_samp*2*nchs, nbytes),
+                         'Start usec': start + trim_samp*10**6//fs,
+                         'Samples': samples,
+                         'Sample offset': np.cumsum(samples) - samples})
+    
+    for i in np.where(is_overlap)[0]:
+        logging.info('Overlap found, between %s and earlier files, %s bytes to delete'
+                     %(fnames[i], plan['Trim bytes'][i]))
+    
+    return plan, catalog
 
 
 def _checkDatFolderEcogConcordance(ecog_df, NumberOfFiles):
@@ -607,72 +659,204 @@ def _checkDatFolderEcogConcordance(ecog_df, NumberOfFiles):
         sys.exit("Error: RawUTCTimestamp is not chronological")
         
         
-def _readDatFile(dataFolderPath, ecog_row):
-    
-    assert isinstance(ecog_row, pd.DataFrame), 'Expected a DataFrame input.'
-    assert ecog_row.shape[0] == 1, 'Expected a single row'
+def _readDatFile(dataFolderPath, ecog_row, memmap=False):
+    '''
+    Read a single .dat file
 
-    # Open up dat_file
-    dat_file = pth.join(dataFolderPath, ecog_row['Filename'].item())
-    fs = ecog_row['Sampling rate'].item()
+    Args:
+        dataFolderPath (str): path to folder containing .dat files
+        ecog_row (Pandas dataframe or EcogCatalog): single ecog catalog row of .dat file
+        memmap (bool, optional): return a memory-mapped DatFile and a DatTime 
+            descriptor instead of dense data and time arrays. Defaults to False.
+
+    Returns:
+        fdata: (NUM_CHANNELS, n_samples) int16 array, or DatFile if memmap
+        ftime: time vector in UTC usec, or DatTime if memmap
+        t_conversion_usec: UTC - local time offset in usec
+    '''
     
-    enabled = (ecog_row[['Ch 1 enabled', 'Ch 2 enabled', 
-                        'Ch 3 enabled', 'Ch 4 enabled']] == 'On').values.tolist()[0]
+    if isinstance(ecog_row, EcogCatalog):
+        assert len(ecog_row) == 1, 'Expected a single row'
+        enabled = ecog_row.enabled[0]
+        row_df = ecog_row.df
+    else:
+        assert isinstance(ecog_row, pd.DataFrame), 'Expected a DataFrame input.'
+        assert ecog_row.shape[0] == 1, 'Expected a single row'
+        enabled = _getEnabledChs(ecog_row)[0]
+        row_df = ecog_row
 
-    num_channels = sum(enabled)
+    # Open up dat_file
+    dat_file = pth.join(dataFolderPath, row_df['Filename'].item())
+    fs = row_df['Sampling rate'].item()
        
     # Note, 512 is mid-rail
-    with open(dat_file, 'rb') as fid:
-        fdata = np.fromfile(fid, np.int16).reshape((-1, num_channels)).T-512
-    
-
-    # Pad with zeros in each channel of fdata array if channel is "OFF"
-    # Note, ideally this would be Nan but python doesn't support Nan integers....
-    off_chans = [i for i, x in enumerate(enabled) if x == False]
-    for oc in off_chans:
-        fdata = np.insert(fdata, oc, 0, axis=0)
+    datf = DatFile(dat_file, enabled)
         
     # Get UTC and local trigger times, and timestamp as strings. 
     [t_start, t_trigger_UTC, t_trigger_local, t_conversion_usec] = _getTimeStrings(ecog_row)
     
-    # Calculate associated time vector    
-    dlen = fdata.shape[1]
-    t_vec = np.arange(dlen)/fs*10**6
-    ftime = t_start + t_vec
+    tinfo = DatTime(t_start[0], fs, datf.n_samples)
+    
+    if memmap:
+        return datf, tinfo, t_conversion_usec[0]
+    
+    # Off channels are padded with zeros in fdata array 
+    # Note, ideally this would be Nan but python doesn't support Nan integers....
+    fdata = np.empty((NUM_CHANNELS, datf.n_samples), dtype=np.int16)
+    datf.toArray(out=fdata.T)
+    
+    return fdata, tinfo.vector(), t_conversion_usec[0]
+
+def _getEnabledChs(ecog_df):
+    ''' Returns (n_rows, NUM_CHANNELS) boolean array of enabled channels '''
     
-    return fdata, ftime, t_conversion_usec[0]
+    return (ecog_df[['Ch %d enabled'%(i+1) for i in range(NUM_CHANNELS)]] == 'On').values
 
-def _getTimeStrings(ecog_df_row):
+
+def _getDatLengths(dataFolder, ecog_df, enabled):
     '''
-    Args:
-        ecog_df_row (TYPE): pandas Series object
+    Get the number of samples in each .dat file from its size on disk
 
     Returns:
-        t_start_UTC (TYPE): DESCRIPTION.
-        t_trigger_UTC (TYPE): DESCRIPTION.
-        t_trigger_local (TYPE): DESCRIPTION.
-        t_conversion_usec (TYPE): DESCRIPTION.
+        dlens: np.array with # of samples per ecog_df row, -1 if file is missing
+        dneIdx: list of ecog_df rows without an associated .dat file
+    '''
+    
+    dlens = np.full(ecog_df.shape[0], -1, dtype=np.int64)
+    dneIdx = []
+    
+    for i_file, fname in enumerate(ecog_df['Filename']):
+        try:
+            nbytes = os.stat(pth.join(dataFolder, fname)).st_size
+            dlens[i_file] = nbytes // (2*enabled[i_file].sum())
+        except FileNotFoundError:
+            logging.error('File %s not found'%(fname))
+            dneIdx.append(i_file)
+    
+    return dlens, dneIdx
+
 
+def _allocAllData(n_samples, memmap_path=None):
+    ''' Allocate (n_samples, NUM_CHANNELS) int16 AllData, in memory or as a 
+    disk-backed memmap if memmap_path is given '''
+    
+    shape = (n_samples, NUM_CHANNELS)
+    
+    if memmap_path and n_samples:
+        return np.memmap(memmap_path, dtype=np.int16, mode='w+', shape=shape)
+    
+    return np.empty(shape, dtype=np.int16)
+
+
+def _datManifest(dataFolder, filenames, eventIdx):
+    '''
+    Returns a manifest DataFrame recording the size, modification time and 
+    assigned AllData sample range of each aggregated .dat file
     '''
     
-    assert isinstance(ecog_df_row, pd.DataFrame), 'Expected a DataFrame input'
+    stats = [os.stat(pth.join(dataFolder, f)) for f in filenames]
+    
+    return pd.DataFrame({'Filename': list(filenames),
+                         'Size': [st.st_size for st in stats],
+                         'Mtime ns': [st.st_mtime_ns for st in stats],
+                         'Start idx': np.asarray(eventIdx)[:,0].astype(np.int64),
+                         'End idx': np.asarray(eventIdx)[:,1].astype(np.int64)})
+
+
+def _checkManifest(dataFolder, manifest):
+    ''' Returns True if every .dat file in manifest is unchanged on disk '''
+    
+    try:
+        current = _datManifest(dataFolder, manifest['Filename'], 
+                               manifest[['Start idx', 'End idx']].values)
+    except FileNotFoundError:
+        return False
+    
+    return (current[['Size', 'Mtime ns']].values == manifest[['Size', 'Mtime ns']].values).all()
+
+
+def _fillDatSlices(out_path, n_samples, tasks):
+    ''' Worker: decode .dat files into their slices of a memmapped AllData '''
     
-    raw_UTC_str = ecog_df_row['Raw UTC timestamp'].tolist()
-    raw_local_str = ecog_df_row['Raw local timestamp'].tolist()
-    timestamp_str = ecog_df_row['Timestamp'].tolist()
+    AllData = np.memmap(out_path, dtype=np.int16, mode='r+', shape=(n_samples, NUM_CHANNELS))
+    
+    for [dat_file, ch_enabled, i_start, i_end] in tasks:
+        DatFile(dat_file, ch_enabled).toArray(out=AllData[i_start:i_end])
+        
+    AllData.flush()
+    
+
+def _parallelFillAllData(tasks, n_samples, n_jobs, memmap_path=None):
+    '''
+    Decode .dat files in parallel worker processes. Each worker writes its
+    batch of files directly into a shared, disk-backed AllData. If memmap_path
+    is None, AllData is staged in a temporary file and then read into memory.
+    '''
+    
+    if memmap_path:
+        out_path = memmap_path
+    else:
+        fd, out_path = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+        
+    try:
+        _allocAllData(n_samples, out_path).flush()
+        
+        # Contiguous batches of files, a few per worker to balance load
+        n_batches = min(len(tasks), 4*n_jobs)
+        batches = [tasks[b[0]:b[-1]+1] for b in np.array_split(np.arange(len(tasks)), n_batches)]
         
-    t_trigger_UTC = utils.str2dt_usec(raw_UTC_str)
-    t_trigger_local = utils.str2dt_usec(raw_local_str)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_fillDatSlices, out_path, n_samples, batch) 
+                       for batch in batches]
+            for future in futures:
+                future.result()
+        
+        if memmap_path:
+            return np.memmap(out_path, dtype=np.int16, mode='r+', shape=(n_samples, NUM_CHANNELS))
+        
+        return np.fromfile(out_path, dtype=np.int16).reshape((n_samples, NUM_CHANNELS))
+    
+    finally:
+        if not memmap_path:
+            os.remove(out_path)
+
 
-    t_conversion_usec = [a - b for a, b in zip(t_trigger_UTC, t_trigger_local)]
-    t_start_UTC = [a + b for a, b in zip(utils.str2dt_usec(timestamp_str), t_conversion_usec)]
+def _getTimeStrings(ecog_df_row):
+    '''
+    Args:
+        ecog_df_row (DataFrame or EcogCatalog): one or more ecog catalog rows
 
+    Returns (lists of posix usec, one entry per row):
+        t_start_UTC: UTC start time of each recording
+        t_trigger_UTC: UTC trigger time
+        t_trigger_local: local trigger time
+        t_conversion_usec: UTC - local time offset
+
+    '''
+    
+    if isinstance(ecog_df_row, EcogCatalog):
+        return (ecog_df_row.timestamp_usec.tolist(), ecog_df_row.trigger_usec.tolist(),
+                (ecog_df_row.trigger_usec - ecog_df_row.tz_offset_usec).tolist(), 
+                ecog_df_row.tz_offset_usec.tolist())
     
-    return t_start_UTC, t_trigger_UTC, t_trigger_local, t_conversion_usec
+    assert isinstance(ecog_df_row, pd.DataFrame), 'Expected a DataFrame input'
+    
+    t_trigger_UTC = utils.str2usec(ecog_df_row['Raw UTC timestamp'])
+    t_trigger_local = utils.str2usec(ecog_df_row['Raw local timestamp'])
+
+    t_conversion_usec = t_trigger_UTC - t_trigger_local
+    t_start_UTC = utils.str2usec(ecog_df_row['Timestamp']) + t_conversion_usec
+
+    return (t_start_UTC.tolist(), t_trigger_UTC.tolist(), 
+            t_trigger_local.tolist(), t_conversion_usec.tolist())
 
 def _getOffChs(ecog_df, file):
     # Helper that returns list of off channels for a given file
 
+    if isinstance(ecog_df, EcogCatalog):
+        return ecog_df.offChs(file)
+
     ch = []
     name = os.path.basename(file)
     for x in range(1, 5):
@@ -682,23 +866,68 @@ def _getOffChs(ecog_df, file):
     return ch
 
 
-def _catExporter(ecog_df, datcat, file, overlap=0):
-    # Saves a given file to concatenated month file
-    # Pads off channels, last variable is # of bytes overlapping to get rid of (default 0)    
-    ch = _getOffChs(ecog_df, file)
-    if len(ch) > 0:
-        with open(file, 'rb') as outfile:
-            outfile.seek(overlap)
-            a = np.fromfile(outfile, np.int16).reshape((-1, 4 - len(ch))).T
-        for x in ch:
-            a = np.insert(a, x - 1, 512, axis=0)
-        with open(datcat, 'ab') as infile:
-            a.T.astype(np.int16).tofile(infile)
-    else:
-        with open(datcat, 'ab') as infile:
-            with open(file, 'rb') as outfile:
-                infile.write(outfile.read()[overlap:])
+def _catExporter(catalog, out, file, overlap=0):
+    # Streams a given file to the open (unbuffered) concatenated month file
+    # Pads off channels, last variable is # of bytes overlapping to get rid of (default 0)
+    
+    enabled = catalog.enabled[catalog.pos(file)]
+    n_ch = int(enabled.sum())
+    
+    # Partial frames would misalign every later sample of the month file
+    nbytes = os.stat(file).st_size
+    if nbytes % (2*n_ch):
+        raise ValueError('%s size (%d bytes) does not match %d enabled channels'
+                         %(pth.basename(file), nbytes, n_ch))
+    
+    with open(file, 'rb', buffering=0) as infile:
+        
+        if enabled.all():
+            _copyFileRange(infile, out, overlap)
+            return
+        
+        # Fill enabled channels of a preallocated, mid-rail padded buffer
+        buf = np.full((COPY_CHUNK_SAMPLES, NUM_CHANNELS), MID_RAIL, dtype=np.int16)
+        infile.seek(overlap)
+        while True:
+            a = np.frombuffer(infile.read(COPY_CHUNK_SAMPLES*n_ch*2), dtype=np.int16)
+            n = a.size // n_ch
+            if n == 0:
+                break
+            buf[:n, enabled] = a[:n*n_ch].reshape(n, n_ch)
+            out.write(memoryview(buf[:n]).cast('B'))
+
+
+def _copyFileRange(infile, out, offset=0):
+    # Copies infile from offset to the end onto out, in the kernel if possible,
+    # falling back to fixed size buffered chunks
+    
+    count = os.fstat(infile.fileno()).st_size - offset
+    
+    for copy_fn in [getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)]:
+        if copy_fn is None:
+            continue
+        try:
+            while count > 0:
+                if copy_fn is os.sendfile:
+                    n = os.sendfile(out.fileno(), infile.fileno(), offset, count)
+                else:
+                    n = copy_fn(infile.fileno(), out.fileno(), count, offset)
+                if n == 0:
+                    break
+                offset += n
+                count -= n
+            return
+        except OSError:
+            # Unsupported for these files, bytes copied so far are kept
+            continue
     
+    infile.seek(offset)
+    while count > 0:
+        chunk = infile.read(min(count, COPY_CHUNK_SAMPLES*NUM_CHANNELS*2))
+        if not chunk:
+            break
+        out.write(chunk)
+        count -= len(chunk)
 
 
     
\ No newline at end of file
@@ -1,4 +1,10 @@
 from . import pennsieve_tools
 from . import utils
 from . import visualize
-from . import NPDataHandler
\ No newline at end of file
+from . import NPDataHandler
+from . import device_data
+from . import ecog_catalog
+from . import box_sync
+from . import event_index
+from . import minmax_pyramid
+from . import stim_detection
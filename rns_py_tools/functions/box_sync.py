@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Box Sync
+(RNS Processing Toolbox)
+
+Purpose: Concurrent, resumable downloads of NeuroPace data from Box.com. Files
+are downloaded to a temporary .part file, verified against the size and SHA1
+reported by Box, then renamed, so a failed download never leaves a truncated
+file behind. Partial files are resumed on the next attempt. A local manifest
+of each synced folder's files (id, etag, size, SHA1) lets syncFolder skip
+unchanged files and folders.
+
+Functions in this file:
+    listFolder(client, folder_id)
+    downloadFolder(client, folder_id, path, overwrite, n_threads)
+    downloadFiles(client, files, folder, n_threads)
+    downloadFile(client, box_file, out_file)
+    syncFolder(client, box_folder, path, manifest, n_threads, full)
+    BoxManifest(path)
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+from os import path as pth
+from concurrent.futures import ThreadPoolExecutor
+
+# Constants
+DOWNLOAD_THREADS = 8
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_WAIT = 1.0  # seconds, doubled after each retry
+PARTIAL_SUFFIX = '.part'
+ITEM_FIELDS = ['type', 'id', 'name', 'size', 'sha1', 'etag', 'modified_at']
+FOLDER_FIELDS = ['type', 'id', 'name', 'modified_at']
+
+
+def listFolder(client, folder_id):
+    '''
+    Lists a Box folder with a single request.
+
+    Args:
+        client (boxsdk Client): authenticated Box client
+        folder_id (str): Box folder id
+
+    Returns:
+        files (dict): filename: Box file item (with size and sha1)
+        folders (dict): folder name: Box folder item
+    '''
+
+    files = {}
+    folders = {}
+
+    for item in client.folder(folder_id=folder_id).get_items(fields=ITEM_FIELDS):
+        if item.type == 'folder':
+            folders[item.name] = item
+        elif item.type == 'file' and item.name[0] != '.':
+            files[item.name] = item
+
+    return files, folders
+
+
+def downloadFolder(client, folder_id, path, overwrite=False, n_threads=DOWNLOAD_THREADS,
+                   name=None):
+    '''
+    Recursively downloads a Box folder into path/<folder name>. Each folder is
+    listed once, and all files are downloaded by one bounded thread pool.
+
+    Args:
+        client (boxsdk Client): authenticated Box client
+        folder_id (str): Box folder id
+        path (str): local parent folder (don't include name of folder being downloaded)
+        overwrite (bool, optional): download all files, rather than only
+            files that are missing locally or differ in size. Defaults to False.
+        n_threads (int, optional): maximum concurrent downloads. Defaults to
+            DOWNLOAD_THREADS.
+        name (str, optional): folder name, if known, to skip fetching it
+
+    Returns:
+        summary (dict): number of 'downloaded' and 'skipped' files, and list
+        of 'failed' file paths
+
+    Example:
+        summary = downloadFolder(client, ptFolder.id, config['paths']['RNS_RAW_Folder'])
+    '''
+
+    [tasks, n_skipped] = _folderTasks(client, folder_id, path, overwrite, name)
+
+    summary = downloadFiles(client, [t[0] for t in tasks], [t[1] for t in tasks], n_threads)
+    summary['skipped'] += n_skipped
+
+    return summary
+
+
+def downloadFiles(client, files, folder, n_threads=DOWNLOAD_THREADS):
+    '''
+    Downloads Box files concurrently.
+
+    Args:
+        client (boxsdk Client): authenticated Box client
+        files (list): Box file items, as returned by listFolder
+        folder (str or list): local folder, or one local folder per file
+        n_threads (int, optional): maximum concurrent downloads. Defaults to
+            DOWNLOAD_THREADS.
+
+    Returns:
+        summary (dict): number of 'downloaded' and 'skipped' files, and list
+        of 'failed' file paths
+    '''
+
+    if isinstance(folder, str):
+        folder = [folder]*len(files)
+    out_files = [pth.join(f, box_file.name) for box_file, f in zip(files, folder)]
+
+    summary = {'downloaded': 0, 'skipped': 0, 'failed': []}
+    if not files:
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max(1, min(n_threads, len(files)))) as ex:
+        results = ex.map(lambda a: downloadFile(client, *a), zip(files, out_files))
+
+        for out_file, ok in zip(out_files, results):
+            if ok:
+                summary['downloaded'] += 1
+            else:
+                summary['failed'].append(out_file)
+
+    if summary['failed']:
+        logging.error('%d Box downloads failed: %s'%(len(summary['failed']), summary['failed']))
+
+    return summary
+
+
+def downloadFile(client, box_file, out_file, retries=DOWNLOAD_RETRIES):
+    '''
+    Downloads a Box file to out_file via out_file.part, resuming an existing
+    .part file. The file is only renamed to out_file once its size and SHA1
+    match Box's metadata.
+
+    Args:
+        client (boxsdk Client): authenticated Box client
+        box_file: Box file item, with size and sha1 fields
+        out_file (str): local file path
+        retries (int, optional): retries on network errors or failed
+            verification. Defaults to DOWNLOAD_RETRIES.
+
+    Returns:
+        bool: True if out_file was downloaded and verified
+    '''
+
+    part_file = out_file + PARTIAL_SUFFIX
+    size = getattr(box_file, 'size', None)
+
+    for i_try in range(retries + 1):
+
+        offset = pth.getsize(part_file) if pth.exists(part_file) else 0
+        if offset and (size is None or offset > size):
+            os.remove(part_file)
+            offset = 0
+
+        try:
+            with open(part_file, 'ab') as f:
+                if offset == 0:
+                    client.file(file_id=box_file.id).download_to(f)
+                elif offset < size:
+                    client.file(file_id=box_file.id).download_to(f, byte_range=(offset, size-1))
+
+        except Exception as err:
+            # Keep partial file to resume from
+            logging.warning('Download of %s interrupted (%s), retrying'%(box_file.name, err))
+            time.sleep(DOWNLOAD_RETRY_WAIT * 2**i_try)
+            continue
+
+        if _verify(part_file, box_file):
+            os.replace(part_file, out_file)
+            return True
+
+        logging.warning('Download of %s failed verification, retrying'%box_file.name)
+        os.remove(part_file)
+
+    return False
+
+
+class BoxManifest:
+    '''
+    Local record of synced Box folders, persisted as a json file. For each 
+    folder id: name, modified_at, subfolders (name: id, modified_at) and files 
+    (name: id, etag, size, sha1).
+
+    Args:
+        path (str, optional): json file, None to keep the manifest in memory
+    '''
+
+    def __init__(self, path=None):
+
+        self.path = path
+        self.folders = {}
+
+        if path and pth.exists(path):
+            with open(path) as f:
+                self.folders = json.load(f)['folders']
+
+
+    def save(self):
+        ''' Write manifest to path '''
+
+        if not self.path:
+            return
+
+        os.makedirs(pth.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'folders': self.folders}, f)
+        os.replace(tmp, self.path)
+
+
+def syncFolder(client, box_folder, path, manifest, n_threads=DOWNLOAD_THREADS, full=False):
+    '''
+    Recursively downloads the files of a Box folder into path/<folder name>
+    that are new or have changed since the last sync recorded in manifest. 
+    Folders whose modified_at hasn't changed, and whose files are all still 
+    present locally, are not listed again unless full is True. Subfolders of
+    unchanged folders are fetched to check their own modified_at. Files without 
+    a manifest record (e.g. downloaded before the manifest existed) are 
+    compared by size and SHA1.
+
+    Args:
+        client (boxsdk Client): authenticated Box client
+        box_folder: Box folder item, with modified_at field (from listFolder)
+        path (str): local parent folder
+        manifest (BoxManifest): manifest, updated and saved
+        n_threads (int, optional): maximum concurrent downloads. Defaults to
+            DOWNLOAD_THREADS.
+        full (bool, optional): list all folders. Defaults to False.
+
+    Returns:
+        summary (dict): number of 'downloaded' and 'skipped' files and 
+        'listed' folders, and list of 'failed' file paths
+        
+    Example:
+        [_, ptFolders] = listFolder(client, root_id)
+        manifest = BoxManifest('/path/to/manifest.json')
+        syncFolder(client, ptFolders[name], raw_folder, manifest)
+    '''
+
+    counts = {'skipped': 0, 'listed': 0}
+    tasks = _syncTasks(client, box_folder, path, manifest, full, counts)
+
+    summary = downloadFiles(client, [t[0] for t in tasks], [t[1] for t in tasks], n_threads)
+    summary.update(skipped=counts['skipped'], listed=counts['listed'])
+
+    # Record downloaded files, failed files' folders are listed again next sync
+    failed = set(summary['failed'])
+    for [box_file, local_folder, folder_id] in tasks:
+        entry = manifest.folders[folder_id]
+        if pth.join(local_folder, box_file.name) in failed:
+            entry['files'].pop(box_file.name, None)
+            entry['modified_at'] = None
+        else:
+            entry['files'][box_file.name] = _fileRecord(box_file)
+
+    manifest.save()
+
+    return summary
+
+
+#### Helper Functions #####
+
+def _syncTasks(client, box_folder, path, manifest, full, counts):
+    # Recursively lists changed folders, updating manifest entries. Returns
+    # list of (box file, local folder, folder id) of files to download
+
+    local_folder = pth.join(path, box_folder.name)
+    os.makedirs(local_folder, exist_ok=True)
+
+    entry = manifest.folders.get(box_folder.id)
+    modified = getattr(box_folder, 'modified_at', None)
+
+    tasks = []
+
+    if (not full and entry is not None and modified is not None and 
+        entry['modified_at'] == modified and
+        all(_isCurrent(pth.join(local_folder, name), SimpleNamespace(**rec))
+            for name, rec in entry['files'].items())):
+
+        # Unchanged folder, only check subfolders. Box doesn't always update
+        # modified_at of a folder when a folder below it changes, so each
+        # subfolder's current modified_at is fetched (without listing it)
+        counts['skipped'] += len(entry['files'])
+        folders = {name: client.folder(folder_id=rec['id']).get(fields=FOLDER_FIELDS)
+                   for name, rec in entry['folders'].items()}
+
+    else:
+        [files, folders] = listFolder(client, box_folder.id)
+        counts['listed'] += 1
+
+        old_files = {} if entry is None else entry['files']
+        entry = {'name': box_folder.name, 'modified_at': modified, 'files': {},
+                 'folders': {name: {'id': f.id, 'modified_at': getattr(f, 'modified_at', None)}
+                             for name, f in folders.items()}}
+        manifest.folders[box_folder.id] = entry
+
+        for name, box_file in files.items():
+            if _isSynced(pth.join(local_folder, name), box_file, old_files.get(name)):
+                entry['files'][name] = _fileRecord(box_file)
+                counts['skipped'] += 1
+            else:
+                tasks.append((box_file, local_folder, box_folder.id))
+
+    for sub_folder in folders.values():
+        tasks += _syncTasks(client, sub_folder, local_folder, manifest, full, counts)
+
+    return tasks
+
+
+def _isSynced(out_file, box_file, record):
+    # True if local out_file is the current version of box_file, using the 
+    # manifest record of the last download if there is one
+
+    if not _isCurrent(out_file, box_file):
+        return False
+
+    if record is not None:
+        return (record['id'] == box_file.id and 
+                record['etag'] == getattr(box_file, 'etag', None) and
+                record['sha1'] == getattr(box_file, 'sha1', None))
+
+    return _verify(out_file, box_file)
+
+
+def _fileRecord(box_file):
+    # Manifest record of box_file
+
+    return {'id': box_file.id, 'etag': getattr(box_file, 'etag', None),
+            'size': getattr(box_file, 'size', None), 'sha1': getattr(box_file, 'sha1', None)}
+
+
+def _folderTasks(client, folder_id, path, overwrite=False, name=None):
+    # Recursively lists a Box folder, creating local folders. Returns list of
+    # (box file, local folder) of files to download, and # of skipped files
+
+    if name is None:
+        name = client.folder(folder_id=folder_id).get().name
+    local_folder = pth.join(path, name)
+    os.makedirs(local_folder, exist_ok=True)
+
+    [files, folders] = listFolder(client, folder_id)
+
+    tasks = [(box_file, local_folder) for box_file in files.values()
+             if overwrite or not _isCurrent(pth.join(local_folder, box_file.name), box_file)]
+    n_skipped = len(files) - len(tasks)
+
+    for sub_name, box_folder in folders.items():
+        [sub_tasks, sub_skipped] = _folderTasks(client, box_folder.id, local_folder, 
+                                                overwrite, sub_name)
+        tasks += sub_tasks
+        n_skipped += sub_skipped
+
+    return tasks, n_skipped
+
+
+def _isCurrent(out_file, box_file):
+    # True if out_file exists with the size of box_file
+
+    size = getattr(box_file, 'size', None)
+    return pth.exists(out_file) and (size is None or pth.getsize(out_file) == size)
+
+
+def _verify(file, box_file):
+    # True if file matches the size and SHA1 of box_file (where known)
+
+    size = getattr(box_file, 'size', None)
+    if size is not None and pth.getsize(file) != size:
+        return False
+
+    sha1 = getattr(box_file, 'sha1', None)
+    return not sha1 or _sha1(file) == sha1
+
+
+def _sha1(file, block_size=2**20):
+    # SHA1 hex digest of file
+
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Device Data
+(RNS Processing Toolbox)
+
+Purpose: Functions for writing aggregated device recordings (Device_Data.mat)
+as chunked, resizable and optionally compressed MATLAB v7.3 files, and for
+lazily reading them back. 
+
+Functions in this file:
+    writeDeviceData(mat_file, AllData, eventIdx)
+    appendDeviceData(mat_file, AllData, eventIdx)
+    isAppendable(mat_file)
+    openDeviceData(ptID, config)
+    DeviceData(mat_file, catalog)
+
+Note: MATLAB stores arrays column-major, so AllData (n_samples x 4 in MATLAB
+and Python) is stored in HDF5 as a (4, n_samples) dataset, and EventIdx
+(n_events x 2) as a (2, n_events) dataset.
+
+"""
+
+import datetime as DT
+import logging
+import h5py
+import numpy as np
+import pandas as pd
+from functions import utils
+from functions import event_index
+
+# Constants
+NUM_CHANNELS = 4
+MIN_CHUNK_LEN = 2**10
+MAX_CHUNK_LEN = 2**18
+EVENT_CHUNK_LEN = 2**12
+WRITE_BATCH_SAMPLES = 2**22
+
+
+def writeDeviceData(mat_file, AllData, eventIdx, compression='gzip',
+                    compression_opts=4, shuffle=True):
+    '''
+    Write AllData and EventIdx to a MATLAB v7.3 .mat file with chunked,
+    resizable datasets. Chunks are sized from the median event length so
+    that reading a single event touches as few chunks as possible.
+
+    Args:
+        mat_file (str): path to output .mat file, overwritten if it exists
+        AllData (np.array): (n_samples, NUM_CHANNELS) int16 array
+        eventIdx (np.array): (n_events, 2) array of first and last AllData
+            index of each event (0-indexed, as returned by NPdat2mat)
+        compression (str, optional): h5py compression filter, None to store
+            uncompressed. Defaults to 'gzip'.
+        compression_opts (int, optional): compression level. Defaults to 4.
+        shuffle (bool, optional): apply the byte shuffle filter before
+            compressing. Defaults to True.
+
+    Returns:
+        None.
+
+    Example:
+        [AllData, eventIdx, dneIdx] = npdh.NPdat2mat(ptID, config)
+        writeDeviceData('/path/to/Device_Data.mat', AllData, eventIdx)
+    '''
+
+    eventIdx = np.asarray(eventIdx, dtype=np.int32).reshape(-1, 2)
+
+    chunk_len = _eventChunkLen(eventIdx)
+    if not compression:
+        compression_opts = None
+        shuffle = False
+
+    with h5py.File(mat_file, 'w', userblock_size=512) as f:
+
+        dset = f.create_dataset('AllData', shape=(NUM_CHANNELS, 0),
+                                maxshape=(NUM_CHANNELS, None), dtype=np.int16,
+                                chunks=(NUM_CHANNELS, chunk_len),
+                                compression=compression,
+                                compression_opts=compression_opts,
+                                shuffle=shuffle)
+        dset.attrs['MATLAB_class'] = np.bytes_('int16')
+
+        edset = f.create_dataset('EventIdx', shape=(2, 0), maxshape=(2, None),
+                                 dtype=np.int32, chunks=(2, EVENT_CHUNK_LEN),
+                                 compression=compression,
+                                 compression_opts=compression_opts,
+                                 shuffle=shuffle)
+        edset.attrs['MATLAB_class'] = np.bytes_('int32')
+
+        _appendDatasets(dset, edset, AllData, eventIdx)
+
+    _writeMatHeader(mat_file)
+
+
+def appendDeviceData(mat_file, AllData, eventIdx):
+    '''
+    Append new events to a Device_Data.mat file created by writeDeviceData,
+    without rewriting the existing data.
+
+    Args:
+        mat_file (str): path to existing .mat file
+        AllData (np.array): (n_samples, NUM_CHANNELS) int16 array of new data
+        eventIdx (np.array): (n_events, 2) first and last index of each new
+            event, relative to the new AllData block (0-indexed)
+
+    Returns:
+        eventIdx (np.array): new event indices offset into the full AllData
+    '''
+
+    eventIdx = np.asarray(eventIdx, dtype=np.int32).reshape(-1, 2)
+
+    with h5py.File(mat_file, 'r+') as f:
+        dset = f['AllData']
+        edset = f['EventIdx']
+
+        if dset.maxshape[1] is not None or dset.chunks is None:
+            raise ValueError('%s is not appendable, rewrite it with writeDeviceData'%mat_file)
+
+        eventIdx = (eventIdx + dset.shape[1]).astype(np.int32)
+        _appendDatasets(dset, edset, AllData, eventIdx)
+
+    return eventIdx
+
+
+def isAppendable(mat_file):
+    ''' Returns True if mat_file has resizable AllData and EventIdx datasets '''
+
+    try:
+        with h5py.File(mat_file, 'r') as f:
+            return all(k in f and f[k].chunks is not None and f[k].maxshape[1] is None
+                       for k in ['AllData', 'EventIdx'])
+    except OSError:
+        return False
+
+
+def openDeviceData(ptID, config):
+    '''
+    Open a patient's Device_Data.mat, joined with their deidentified ECoG 
+    catalog, without loading any data.
+
+    Args:
+        ptID (str): patient ID
+        config (dict): config.json dictionary
+
+    Returns:
+        DeviceData object
+        
+    Example:
+        with openDeviceData('HUP1234', config) as dd:
+            event_data = dd[10]
+            trigger = dd.catalog['ECoG trigger'][10]
+    '''
+    
+    return DeviceData(utils.getDataPath(ptID, config, 'device data'), 
+                      utils.getDataPath(ptID, config, 'ecog catalog'))
+
+
+class DeviceData:
+    '''
+    Lazy, read-only access to AllData in a Device_Data.mat file. Only the bytes
+    of the requested samples are read from disk.
+    
+    Args:
+        mat_file (str): path to Device_Data.mat
+        catalog (str or DataFrame, optional): deidentified ECoG catalog (or 
+            path to ECoG_Catalog.csv) with one row per event in EventIdx
+            
+    Attributes:
+        eventIdx (np.array): (n_events, 2) first and last AllData index of 
+            each event (0-indexed)
+        catalog (DataFrame): ECoG catalog rows, or None
+        shape (tuple): (n_samples, NUM_CHANNELS) shape of AllData
+        
+    Indexing:
+        dd[i]             (n, NUM_CHANNELS) data of event i
+        dd[i:j], dd[[..]] list of event data arrays
+        dd.samples(a, b)  AllData[a:b]
+        dd.index          EventIndex of the events (requires catalog)
+        for x in dd:      iterate over event data arrays
+    '''
+    
+    def __init__(self, mat_file, catalog=None):
+        
+        self.path = mat_file
+        self._file = h5py.File(mat_file, 'r')
+        self._data = self._file['AllData']
+        self.eventIdx = self._file['EventIdx'][()].T.astype(np.int64)
+        self.shape = (self._data.shape[1], self._data.shape[0])
+        
+        if isinstance(catalog, str):
+            catalog = pd.read_csv(catalog)
+        self.catalog = catalog
+        self._index = None
+        
+        if catalog is not None:
+            if catalog.shape[0] != self.eventIdx.shape[0]:
+                logging.warning('ECoG catalog (%d rows) does not match EventIdx (%d events)'
+                                %(catalog.shape[0], self.eventIdx.shape[0]))
+            elif ('Event Start idx' in catalog and 
+                  (catalog['Event Start idx'].values-1 != self.eventIdx[:,0]).any()):
+                logging.warning('ECoG catalog Event Start idx does not match EventIdx')
+                
+    
+    def __len__(self):
+        return self.eventIdx.shape[0]
+    
+    
+    def __getitem__(self, key):
+        
+        if isinstance(key, slice):
+            return [self.event(i) for i in range(len(self))[key]]
+        if np.ndim(key) > 0:
+            return [self.event(i) for i in np.arange(len(self))[key]]
+        return self.event(key)
+    
+    
+    def __iter__(self):
+        for i_event in range(len(self)):
+            yield self.event(i_event)
+            
+            
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+        
+        
+    @property
+    def index(self):
+        ''' EventIndex mapping AllData indices to events and times '''
+        
+        if self._index is None:
+            self._index = event_index.fromCatalog(self.catalog, self.eventIdx)
+        return self._index
+    
+    
+    def event(self, i_event):
+        ''' Returns (n, NUM_CHANNELS) data of event i_event '''
+        
+        [i_start, i_end] = self.eventIdx[i_event]
+        return self.samples(i_start, i_end+1)
+    
+    
+    def samples(self, i_start, i_end):
+        ''' Returns AllData[i_start:i_end] as a (n, NUM_CHANNELS) array '''
+        
+        return self._data[:, int(i_start):int(i_end)].T
+    
+    
+    def close(self):
+        self._file.close()
+
+
+#### Helper Functions #####
+
+def _eventChunkLen(eventIdx):
+    # Chunk length along samples, the median event length
+
+    if eventIdx.shape[0] == 0:
+        return MIN_CHUNK_LEN
+
+    ev_len = int(np.median(eventIdx[:,1] - eventIdx[:,0] + 1))
+    return int(np.clip(ev_len, MIN_CHUNK_LEN, MAX_CHUNK_LEN))
+
+
+def _appendDatasets(dset, edset, AllData, eventIdx):
+    # Resize datasets and write new data in event-aligned batches, so at most
+    # WRITE_BATCH_SAMPLES are transposed in memory at a time
+
+    n_old = dset.shape[1]
+    n_new = AllData.shape[0]
+
+    dset.resize(n_old + n_new, axis=1)
+
+    # Batch boundaries on event starts
+    ev_starts = eventIdx[:,0] - n_old
+    ev_starts = ev_starts[(ev_starts > 0) & (ev_starts < n_new)]
+    bounds = [0]
+    for i_start in ev_starts:
+        if i_start - bounds[-1] >= WRITE_BATCH_SAMPLES:
+            bounds.append(int(i_start))
+    bounds.append(n_new)
+
+    for i_beg, i_end in zip(bounds[:-1], bounds[1:]):
+
+        # Guard against single events larger than the batch size
+        for i_b in range(i_beg, i_end, WRITE_BATCH_SAMPLES):
+            i_e = min(i_b + WRITE_BATCH_SAMPLES, i_end)
+            dset[:, n_old+i_b:n_old+i_e] = np.ascontiguousarray(AllData[i_b:i_e].T)
+
+    e_old = edset.shape[1]
+    edset.resize(e_old + eventIdx.shape[0], axis=1)
+    edset[:, e_old:] = eventIdx.T
+
+
+def _writeMatHeader(mat_file):
+    # Write MATLAB 7.3 header into the HDF5 userblock so MATLAB recognizes the
+    # file as a .mat file: 116 bytes of text, 8 byte subsystem offset,
+    # version and endian indicator
+
+    now = DT.datetime.utcnow()
+    weekday = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')[now.weekday()]
+    month = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+             'Sep', 'Oct', 'Nov', 'Dec')[now.month - 1]
+
+    s = ('MATLAB 7.3 MAT-file, Platform: RNS_processing_toolbox, Created on: '
+         '%s %s %s HDF5 schema 1.00 .'%(weekday, month, now.strftime('%d %H:%M:%S %Y')))
+
+    header = bytearray(s.ljust(116), encoding='ascii')
+    header.extend(bytearray.fromhex('00000000 00000000 0002494D'))
+
+    with open(mat_file, 'r+b') as f:
+        f.write(header)
+
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+ECoG Catalog
+(RNS Processing Toolbox)
+
+Purpose: Indexed ECoG catalog. Parses the catalog's time, channel and file
+columns once into NumPy arrays so per-file lookups don't need boolean masks
+over the whole DataFrame.
+
+Functions in this file:
+    EcogCatalog(ecog_df, dataFolder)
+    asCatalog(ecog_df, dataFolder)
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from os import path as pth
+from functions import utils
+
+# Constants
+NUM_CHANNELS = 4
+
+
+class EcogCatalog:
+    '''
+    ECoG catalog indexed by row position and filename. Accepted in place of
+    an ecog_df DataFrame by NPDataHandler and pennsieve_tools functions.
+
+    Args:
+        ecog_df (DataFrame or str): ecog catalog, or path to catalog csv
+        dataFolder (str, optional): folder containing the catalog's .dat
+            files, used to fill nbytes. Defaults to None.
+
+    Attributes (np.arrays with one entry per catalog row):
+        df (DataFrame): catalog rows
+        filenames: .dat filenames
+        trigger_usec: UTC trigger time (Raw UTC timestamp)
+        tz_offset_usec: UTC - local time offset
+        timestamp_usec: UTC recording start from the Timestamp column
+        start_usec: UTC recording start, trigger time - pre-trigger length
+        end_usec: UTC recording end, start_usec + ECoG length
+        pretrigger_usec: ECoG pre-trigger length
+        enabled: (n_rows, NUM_CHANNELS) boolean array of enabled channels
+        n_enabled: number of enabled channels
+        nbytes: .dat file size in bytes, -1 if missing (None without dataFolder)
+
+    Example:
+        catalog = EcogCatalog(pd.read_csv(catalog_csv), dataFolder)
+        i_row = catalog.pos('12345.dat')
+        off_chs = catalog.offChs('12345.dat')
+        month_catalog = catalog.subset(inds)
+    '''
+
+    def __init__(self, ecog_df, dataFolder=None):
+
+        if isinstance(ecog_df, str):
+            ecog_df = pd.read_csv(ecog_df)
+        assert isinstance(ecog_df, pd.DataFrame), 'Expected a DataFrame input'
+
+        self.df = ecog_df
+        self.dataFolder = dataFolder
+        self.filenames = ecog_df['Filename'].values.astype(str)
+
+        self.trigger_usec = utils.str2usec(ecog_df['Raw UTC timestamp'])
+        self.tz_offset_usec = self.trigger_usec - utils.str2usec(ecog_df['Raw local timestamp'])
+        self.timestamp_usec = utils.str2usec(ecog_df['Timestamp']) + self.tz_offset_usec
+        self.pretrigger_usec = np.round(ecog_df['ECoG pre-trigger length'].values*10**6).astype(np.int64)
+        self.start_usec = self.trigger_usec - self.pretrigger_usec
+        self.end_usec = self.start_usec + np.round(ecog_df['ECoG length'].values*10**6).astype(np.int64)
+
+        self.enabled = (ecog_df[['Ch %d enabled'%(i+1) for i in range(NUM_CHANNELS)]] == 'On').values
+        self.n_enabled = self.enabled.sum(axis=1)
+
+        self.nbytes = None
+        if dataFolder is not None:
+            self.nbytes = np.array([_getsize(pth.join(dataFolder, f)) for f in self.filenames],
+                                   dtype=np.int64)
+
+        self._index = {f: i for i, f in enumerate(self.filenames)}
+
+
+    def __len__(self):
+        return self.df.shape[0]
+
+
+    def pos(self, filename):
+        ''' Row position of filename (path or basename) '''
+        return self._index[pth.basename(filename)]
+
+
+    def positions(self, filenames):
+        ''' Row positions of a list of filenames as an np.array '''
+        return np.array([self.pos(f) for f in filenames], dtype=np.int64)
+
+
+    def row(self, key):
+        ''' Single row DataFrame by position or filename '''
+
+        i_row = self.pos(key) if isinstance(key, str) else key
+        return self.df.iloc[[i_row]]
+
+
+    def offChs(self, key):
+        ''' Sorted list of off channels (1-indexed) by position or filename '''
+
+        i_row = self.pos(key) if isinstance(key, str) else key
+        return (np.where(~self.enabled[i_row])[0] + 1).tolist()
+
+
+    def subset(self, inds):
+        '''
+        Catalog of selected rows (positions or boolean mask), without
+        re-parsing the DataFrame
+        '''
+
+        inds = np.arange(len(self))[inds]
+
+        sub = EcogCatalog.__new__(EcogCatalog)
+        sub.df = self.df.iloc[inds]
+        sub.dataFolder = self.dataFolder
+        for attr in ['filenames', 'trigger_usec', 'tz_offset_usec', 'timestamp_usec',
+                     'pretrigger_usec', 'start_usec', 'end_usec', 'enabled', 'n_enabled']:
+            setattr(sub, attr, getattr(self, attr)[inds])
+        sub.nbytes = None if self.nbytes is None else self.nbytes[inds]
+        sub._index = {f: i for i, f in enumerate(sub.filenames)}
+
+        return sub
+
+
+def asCatalog(ecog_df, dataFolder=None):
+    '''
+    Returns ecog_df as an EcogCatalog. An existing EcogCatalog is returned
+    as is, with file sizes filled in if dataFolder is given and it has none.
+    '''
+
+    if isinstance(ecog_df, EcogCatalog):
+        if dataFolder is not None and ecog_df.nbytes is None:
+            ecog_df.dataFolder = dataFolder
+            ecog_df.nbytes = np.array([_getsize(pth.join(dataFolder, f)) for f in ecog_df.filenames],
+                                      dtype=np.int64)
+        return ecog_df
+
+    return EcogCatalog(ecog_df, dataFolder)
+
+
+#### Helper Functions #####
+
+def _getsize(file):
+    # File size in bytes, -1 if file is missing
+
+    try:
+        return os.stat(file).st_size
+    except FileNotFoundError:
+        return -1
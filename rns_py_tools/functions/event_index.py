@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Event Index
+(RNS Processing Toolbox)
+
+Purpose: Compact index of the events in AllData (start sample, length, UTC
+start time and local time offset of each event). Maps AllData sample indices
+to events and times, and times back to sample indices, by binary search, so
+a dense per-sample AllTime vector is never needed.
+
+Functions in this file:
+    EventIndex(eventIdx, start_usec, tz_offset_usec, fs)
+    fromCatalog(ecog_df, eventIdx)
+    openEventIndex(ptID, config)
+
+"""
+
+import numpy as np
+from functions import utils
+from functions.ecog_catalog import asCatalog
+
+
+class EventIndex:
+    '''
+    Per-event index into AllData. Sample indices are 0-indexed, as in
+    EventIdx returned by NPdat2mat.
+
+    Args:
+        eventIdx (np.array): (n_events, 2) first and last AllData index of
+            each event
+        start_usec (np.array): UTC start time (posix usec) of each event
+        tz_offset_usec (np.array): UTC - local time offset of each event
+        fs (int or np.array): sampling rate (Hz), per event or for all events
+
+    Attributes (np.arrays with one entry per event):
+        start: first AllData index
+        length: number of samples
+        start_usec: UTC time of the first sample
+        tz_offset_usec: UTC - local time offset
+        fs: sampling rate
+
+    Example:
+        index = openEventIndex('HUP1234', config)
+        i_event = index.event([20, 593, 60394])
+        utc = index.usec([20, 593, 60394])
+        idx = index.idx(utc)
+    '''
+
+    def __init__(self, eventIdx, start_usec, tz_offset_usec, fs):
+
+        eventIdx = np.asarray(eventIdx, dtype=np.int64).reshape(-1, 2)
+
+        self.start = eventIdx[:,0]
+        self.length = eventIdx[:,1] - eventIdx[:,0] + 1
+        self.start_usec = np.asarray(start_usec, dtype=np.int64)
+        self.tz_offset_usec = np.asarray(tz_offset_usec, dtype=np.int64)
+        self.fs = np.broadcast_to(np.asarray(fs, dtype=np.int64), self.start.shape)
+
+        assert self.start_usec.shape == self.start.shape == self.tz_offset_usec.shape, \
+            'Expected one start time and offset per event'
+
+        # Search orders, events are normally already sorted in both
+        self._idx_order = _order(self.start)
+        self._usec_order = _order(self.start_usec)
+
+
+    def __len__(self):
+        return self.start.shape[0]
+
+
+    def event(self, idx):
+        '''
+        Event containing each AllData index. When events overlap, the event
+        with the latest start is returned. Indices outside of all events
+        map to -1.
+        '''
+
+        idx = np.asarray(idx, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(idx.shape, -1, dtype=np.int64)
+
+        i = np.searchsorted(self.start[self._idx_order], idx, 'right') - 1
+        i_event = self._idx_order[np.maximum(i, 0)]
+
+        inside = (i >= 0) & (idx - self.start[i_event] < self.length[i_event])
+        return np.where(inside, i_event, -1)
+
+
+    def usec(self, idx, local=False):
+        '''
+        Time of each AllData index in posix usec (UTC, or local if local is
+        True), matching the AllTime vector. NaN for indices outside of all
+        events.
+        '''
+
+        i_event = self.event(idx)
+        if len(self) == 0:
+            return np.full(i_event.shape, np.nan)
+
+        inside = i_event >= 0
+        i_event = np.maximum(i_event, 0)
+
+        t = (self.start_usec[i_event]
+             + (np.asarray(idx) - self.start[i_event])/self.fs[i_event]*10**6)
+        if local:
+            t = t - self.tz_offset_usec[i_event]
+
+        return np.where(inside, t, np.nan)
+
+
+    def idx(self, usec, local=False):
+        '''
+        AllData index of the sample nearest to each time in posix usec (UTC,
+        or local if local is True), within the latest event starting at or
+        before that time. Times outside of all events map to -1.
+        '''
+
+        usec = np.asarray(usec)
+        if len(self) == 0:
+            return np.full(usec.shape, -1, dtype=np.int64)
+
+        start_usec = self.start_usec[self._usec_order]
+        if local:
+            start_usec = start_usec - self.tz_offset_usec[self._usec_order]
+
+        i = np.searchsorted(start_usec, usec, 'right') - 1
+        i_event = self._usec_order[np.maximum(i, 0)]
+
+        offset = np.round((usec - start_usec[np.maximum(i, 0)])*self.fs[i_event]/10**6)
+        inside = (i >= 0) & (offset < self.length[i_event])
+
+        return np.where(inside, self.start[i_event] + np.where(inside, offset, 0), -1).astype(np.int64)
+
+
+    def searchsorted(self, usec, local=False):
+        '''
+        AllData index of the first sample at or after each time in posix usec
+        (UTC, or local if local is True). Times between events map to the
+        start of the next event, for converting time ranges to sample ranges.
+        '''
+
+        usec = np.asarray(usec)
+        if len(self) == 0:
+            return np.zeros(usec.shape, dtype=np.int64)
+
+        start_usec = self.start_usec[self._usec_order]
+        if local:
+            start_usec = start_usec - self.tz_offset_usec[self._usec_order]
+
+        i = np.searchsorted(start_usec, usec, 'right') - 1
+        i_event = self._usec_order[np.maximum(i, 0)]
+
+        offset = np.ceil((usec - start_usec[np.maximum(i, 0)])*self.fs[i_event]/10**6)
+        offset = np.clip(offset, 0, self.length[i_event]).astype(np.int64)
+
+        return np.where(i >= 0, self.start[i_event] + offset, self.start[self._usec_order[0]])
+
+
+    def bounds(self, i_event):
+        ''' First and last + 1 AllData index of events, as (n, 2) or (2,) array '''
+
+        i_event = np.asarray(i_event)
+        return np.stack((self.start[i_event], self.start[i_event] + self.length[i_event]), axis=-1)
+
+
+def fromCatalog(ecog_df, eventIdx=None):
+    '''
+    EventIndex from a deidentified ECoG catalog (DataFrame, EcogCatalog or
+    path to ECoG_Catalog.csv), with one row per event in AllData.
+
+    Args:
+        ecog_df (DataFrame, EcogCatalog or str): ecog catalog
+        eventIdx (np.array, optional): (n_events, 2) 0-indexed first and last
+            AllData index of each event. Defaults to None, the catalog's
+            Event Start idx and Event End idx columns (1-indexed).
+
+    Returns:
+        EventIndex
+    '''
+
+    catalog = asCatalog(ecog_df)
+
+    if eventIdx is None:
+        eventIdx = np.stack((catalog.df['Event Start idx'].values,
+                             catalog.df['Event End idx'].values), axis=1) - 1
+
+    return EventIndex(eventIdx, catalog.timestamp_usec, catalog.tz_offset_usec,
+                      catalog.df['Sampling rate'].values)
+
+
+def openEventIndex(ptID, config):
+    ''' EventIndex of a patient's Device_Data.mat, from their deidentified ECoG catalog '''
+
+    return fromCatalog(utils.getDataPath(ptID, config, 'ecog catalog'))
+
+
+#### Helper Functions #####
+
+def _order(x):
+    # Sort order of x, without sorting if x is already sorted
+
+    if (np.diff(x) >= 0).all():
+        return np.arange(len(x))
+    return np.argsort(x, kind='stable')
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Min/Max Pyramid
+(RNS Processing Toolbox)
+
+Purpose: Multi-resolution min/max summaries of AllData (or a concatenated
+.dat file) for drawing overviews of long spans without reading every sample.
+Each level holds the per-channel minimum and maximum of consecutive bins of
+1:16, 1:256 and 1:4096 samples, stored in an HDF5 file next to the data and
+extended in place as new samples are appended.
+
+Functions in this file:
+    updatePyramid(pyr_file, data, rebuild)
+    updateDeviceDataPyramid(ptID, config, rebuild)
+    buildDatPyramid(dat_file, pyr_file, rebuild)
+    openPyramid(ptID, config)
+    MinMaxPyramid(pyr_file)
+
+"""
+
+import logging
+import os
+import h5py
+import numpy as np
+from functions import utils
+from functions import device_data
+
+# Constants
+NUM_CHANNELS = 4
+PYRAMID_LEVELS = (16, 256, 4096)
+PYRAMID_BLOCK_SAMPLES = 2**22   # multiple of the largest level
+PYRAMID_CHUNK_BINS = 2**12
+
+
+def updatePyramid(pyr_file, data, rebuild=False):
+    '''
+    Create or extend the min/max pyramid of data. Only samples after the
+    last complete 1:4096 bin already in pyr_file are read, in blocks of
+    PYRAMID_BLOCK_SAMPLES, so data can be a memmap or DeviceData of any size.
+
+    Args:
+        pyr_file (str): path to pyramid .h5 file
+        data (np.array, np.memmap or DeviceData): (n_samples, NUM_CHANNELS)
+            samples, sliceable along the first axis
+        rebuild (bool, optional): recompute all levels. Defaults to False,
+            also rebuilt if data is shorter than the stored pyramid.
+
+    Returns:
+        n_read (int): number of samples read from data
+    '''
+
+    n_samples = data.shape[0]
+
+    with h5py.File(pyr_file, 'a') as f:
+
+        if (rebuild or tuple(f.attrs.get('levels', ())) != PYRAMID_LEVELS
+                or f.attrs.get('n_samples', 0) > n_samples):
+            _createLevels(f)
+
+        # Restart at the last complete bin of the largest level
+        i_start = int(f.attrs['n_samples']) // PYRAMID_LEVELS[-1] * PYRAMID_LEVELS[-1]
+        for level in PYRAMID_LEVELS:
+            for key in ['min', 'max']:
+                f['L%d'%level][key].resize(i_start // level, axis=0)
+
+        for i_beg in range(i_start, n_samples, PYRAMID_BLOCK_SAMPLES):
+            block = _read(data, i_beg, min(i_beg + PYRAMID_BLOCK_SAMPLES, n_samples))
+            mins = maxs = block
+
+            for prev, level in zip((1,) + PYRAMID_LEVELS[:-1], PYRAMID_LEVELS):
+                bins = np.arange(0, mins.shape[0], level // prev)
+                mins = np.minimum.reduceat(mins, bins, axis=0)
+                maxs = np.maximum.reduceat(maxs, bins, axis=0)
+                _append(f['L%d'%level], mins, maxs)
+
+        f.attrs['n_samples'] = n_samples
+
+    logging.info('Updated min/max pyramid %s, %d samples read'%(pyr_file, n_samples - i_start))
+
+    return n_samples - i_start
+
+
+def updateDeviceDataPyramid(ptID, config, rebuild=False):
+    '''
+    Create or extend the min/max pyramid of a patient's Device_Data.mat.
+    Call with rebuild=True after Device_Data.mat is rewritten.
+
+    Args:
+        ptID (str): patient ID
+        config (dict): config.json dictionary
+        rebuild (bool, optional): recompute all levels. Defaults to False.
+
+    Returns:
+        n_read (int): number of samples read from Device_Data.mat
+    '''
+
+    with device_data.DeviceData(utils.getDataPath(ptID, config, 'device data')) as dd:
+        return updatePyramid(utils.getDataPath(ptID, config, 'device data pyramid'),
+                             dd, rebuild)
+
+
+def buildDatPyramid(dat_file, pyr_file=None, rebuild=False):
+    '''
+    Create or extend the min/max pyramid of a concatenated 4 channel .dat file
+    (see NPDataHandler.createConcatDatLayFiles), read through a memmap.
+
+    Args:
+        dat_file (str): path to .dat file
+        pyr_file (str, optional): path to pyramid .h5 file. Defaults to None,
+            <dat_file name>_pyramid.h5 next to the .dat file.
+        rebuild (bool, optional): recompute all levels. Defaults to False.
+
+    Returns:
+        pyr_file (str): path to pyramid .h5 file
+    '''
+
+    if pyr_file is None:
+        pyr_file = os.path.splitext(dat_file)[0] + '_pyramid.h5'
+
+    if os.path.getsize(dat_file) == 0:
+        data = np.empty((0, NUM_CHANNELS), dtype=np.int16)
+    else:
+        data = np.memmap(dat_file, dtype=np.int16, mode='r').reshape(-1, NUM_CHANNELS)
+
+    updatePyramid(pyr_file, data, rebuild)
+
+    return pyr_file
+
+
+def openPyramid(ptID, config):
+    ''' MinMaxPyramid of a patient's Device_Data.mat '''
+
+    return MinMaxPyramid(utils.getDataPath(ptID, config, 'device data pyramid'))
+
+
+class MinMaxPyramid:
+    '''
+    Read-only access to a min/max pyramid file. Queries return the coarsest
+    level with at least as many bins as requested pixels.
+
+    Args:
+        pyr_file (str): path to pyramid .h5 file
+
+    Attributes:
+        n_samples (int): number of samples summarized
+        levels (tuple): samples per bin of each level
+
+    Example:
+        with openPyramid('HUP1234', config) as pyr:
+            [level, pos, mins, maxs] = pyr.query(0, pyr.n_samples, 1200)
+
+        with openPyramid('HUP1234', config) as pyr, openDeviceData('HUP1234', config) as dd:
+            [level, pos, mins, maxs] = pyr.queryTime(t0, t1, 1200, dd.index, dd)
+    '''
+
+    def __init__(self, pyr_file):
+
+        self.path = pyr_file
+        self._file = h5py.File(pyr_file, 'r')
+        self.n_samples = int(self._file.attrs['n_samples'])
+        self.levels = tuple(int(x) for x in self._file.attrs['levels'])
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def level(self, level):
+        ''' (mins, maxs) h5py datasets, (n_bins, NUM_CHANNELS), of a level '''
+
+        grp = self._file['L%d'%level]
+        return grp['min'], grp['max']
+
+
+    def query(self, i_start, i_end, width, data=None):
+        '''
+        Min/max summary of samples i_start:i_end for plotting at width pixels.
+
+        Args:
+            i_start (int): first sample index
+            i_end (int): last sample index + 1
+            width (int): number of pixels (bins) wanted
+            data (np.array or DeviceData, optional): source samples, read
+                directly when the range is too short for the finest level.
+                Defaults to None, the finest level is used.
+
+        Returns:
+            level (int): samples per bin, 1 for raw samples
+            pos: (n_bins,) sample index of the start of each bin
+            mins: (n_bins, NUM_CHANNELS) minimum of each bin
+            maxs: (n_bins, NUM_CHANNELS) maximum of each bin
+        '''
+
+        i_start = max(int(i_start), 0)
+        i_end = min(int(i_end), self.n_samples)
+
+        fits = [lvl for lvl in self.levels if (i_end - i_start) // lvl >= width]
+
+        if not fits and data is not None:
+            samples = _read(data, i_start, i_end)
+            return 1, np.arange(i_start, i_end), samples, samples
+
+        level = max(fits) if fits else min(self.levels)
+        [b_start, b_end] = [i_start // level, -(-i_end // level)]
+        [mins, maxs] = self.level(level)
+
+        return (level, np.arange(b_start, b_end)*level,
+                mins[b_start:b_end], maxs[b_start:b_end])
+
+
+    def queryTime(self, t_start, t_end, width, index, data=None, local=False):
+        '''
+        Min/max summary between two posix usec times, see query. Times are
+        converted to sample indices with an EventIndex.
+        '''
+
+        [i_start, i_end] = index.searchsorted([t_start, t_end], local=local)
+        return self.query(i_start, i_end, width, data)
+
+
+    def close(self):
+        self._file.close()
+
+
+#### Helper Functions #####
+
+def _createLevels(f):
+    # Empty, resizable min and max datasets for each level
+
+    for key in list(f.keys()):
+        del f[key]
+
+    for level in PYRAMID_LEVELS:
+        grp = f.create_group('L%d'%level)
+        for key in ['min', 'max']:
+            grp.create_dataset(key, shape=(0, NUM_CHANNELS), maxshape=(None, NUM_CHANNELS),
+                               dtype=np.int16, chunks=(PYRAMID_CHUNK_BINS, NUM_CHANNELS))
+
+    f.attrs['levels'] = PYRAMID_LEVELS
+    f.attrs['n_samples'] = 0
+
+
+def _append(grp, mins, maxs):
+    # Append bins to a level's datasets
+
+    n_old = grp['min'].shape[0]
+    for key, x in [('min', mins), ('max', maxs)]:
+        grp[key].resize(n_old + x.shape[0], axis=0)
+        grp[key][n_old:] = x
+
+
+def _read(data, i_start, i_end):
+    # (n, NUM_CHANNELS) samples of an array, memmap or DeviceData
+
+    if hasattr(data, 'samples'):
+        return data.samples(i_start, i_end)
+    return np.asarray(data[i_start:i_end])
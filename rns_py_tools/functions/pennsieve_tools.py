@@ -10,6 +10,12 @@ Functions in this file:
     annotate_from_catalog(package, ecog_catalog)
     uploadMef(dataset, package, mefFolder)
     uploadNewDat(dataset, tsName, datFolder)
+    uploadNewDatByMonth(ptID, config, pnsv, ecog_catalog_inds, n_jobs, max_tmp_bytes)
+    get_pt_listing(ptID, config, pnsv)
+    CollectionListing(collection, pnsv)
+    insert_annotations(item, annots, layers, n_threads, retries)
+    LabelCache(path, max_age, sync)
+    poll_catalog_annotations(ptList, config, pnsv, deadline)
     
 """
 
@@ -17,6 +23,8 @@ import scipy.io as sio
 from pennsieve import Pennsieve
 from functions import NPDataHandler as npdh
 from functions import utils
+from functions import minmax_pyramid
+from functions.ecog_catalog import EcogCatalog
 import pandas as pd
 import numpy as np
 import datetime as DT
@@ -28,34 +36,296 @@ import logging
 import tempfile
 import os
 import shutil
+import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+# Constants
+ANNOT_THREADS = 8
+ANNOT_RETRIES = 3
+ANNOT_RETRY_WAIT = 1.0  # seconds, doubled after each retry
+LABEL_CACHE_MAX_AGE = 7*24*3600  # seconds
+POLL_DEADLINE = 10*60  # seconds
+POLL_MIN_WAIT = 10
+POLL_MAX_WAIT = 120
 
+# Per-run cache of patient collection listings, (dataset, ptID): CollectionListing
+_LISTINGS = {}
 
-# Data Functions
 
-def processPatientTimeseries(ptIDs, config, pnsv):
+
+# Collection Listing
+
+class CollectionListing:
+    '''
+    Cached listing of the items in a Pennsieve collection. The item listing
+    (name: package, state) and each item's layers are fetched once, and reused 
+    until refresh() is called. pennsieve_tools functions refresh the listing
+    after uploading, processing or changing layers. The Pennsieve client
+    caches the items of a collection object, so after refresh() the 
+    collection is fetched again through pnsv, once, when items are next used.
     
-    for ptID in ptIDs:
-        collection = get_pt_collection(ptID, config, pnsv)
+    Args:
+        collection: Pennsieve collection or dataset object
+        pnsv: Pennsieve object, None to never fetch the collection again
+        
+    Example:
+        listing = get_pt_listing('HUP123', config, pnsv)
+        if listing.get('HUP123_2020_01') is None:
+            ...
+        layer_names = listing.layers('HUP123_2020_01').keys()
+    '''
+    
+    def __init__(self, collection, pnsv=None):
+        
+        self.collection = collection
+        self.pnsv = pnsv
+        self._items = None
+        self._layers = {}
+        self._stale = False
+        
+        
+    def __iter__(self):
+        return iter(self.items)
         
-        for item in collection.items:
-            if item.state == 'UPLOADED':
-                item.process()            
     
+    @property
+    def items(self):
+        ''' List of items in the collection '''
+        
+        if self._items is None:
+            if self._stale:
+                self.collection = self._fetch()
+                self._stale = False
+            self._items = {}
+            for item in self.collection.items:
+                self._items.setdefault(item.name, item)
+        return list(self._items.values())
+    
+    
+    def get(self, name):
+        ''' Item named name, None if it doesn't exist '''
+        
+        self.items
+        return self._items.get(name)
+    
+    
+    def state(self, name):
+        ''' Processing state of item named name, None if it doesn't exist '''
+        
+        item = self.get(name)
+        return None if item is None else item.state
+    
+    
+    def layers(self, name):
+        ''' Dictionary of layer name: layer of item named name '''
+        
+        if name not in self._layers:
+            self._layers[name] = {l.name: l for l in self.get(name).layers}
+        return self._layers[name]
+    
+    
+    def refresh(self, name=None):
+        ''' Drop cached items, or only the layers of item named name '''
+        
+        if name is None:
+            self._items = None
+            self._layers = {}
+            self._stale = True
+        else:
+            self._layers.pop(name, None)
+            
+            
+    def _fetch(self):
+        # Collection fetched again from Pennsieve, with an up to date item list
+        
+        if self.pnsv is None:
+            return self.collection
+        if getattr(self.collection, 'type', None) == 'Collection':
+            return self.pnsv.get(self.collection.id)
+        return self.pnsv.get_dataset(self.collection.id)
 
-def get_pt_collection(ptID, config, pnsv):
+
+def get_pt_listing(ptID, config, pnsv, create=False):
+    '''
+    Cached listing of a patient's collection, shared by all pennsieve_tools 
+    functions for the rest of the run. The dataset and collection are
+    created if nonexistent and create is True.
+    '''
     
     i_pt = utils.ptIdxLookup(config, 'ID', ptID)
     dataset = config['patients'][i_pt]['pnsv_dataset']
-    ds = pnsv.get_dataset(dataset)
     
+    listing = _LISTINGS.get((dataset, ptID))
+    if (listing is not None and listing.pnsv is pnsv and 
+        (not create or listing.collection.name == ptID)):
+        return listing
+    
+    try:
+        ds = pnsv.get_dataset(dataset)
+    except:
+        if not create:
+            raise
+        ds = pnsv.create_dataset(dataset)
+        
     # Get collection for ptID, create one if nonexistent
     collection  = [i for i in ds.items if i.type == 'Collection' and i.name == ptID]
-    if not collection:
+    if collection:
+        collection = collection[0]
+    elif create:
+        collection = ds.create_collection(ptID)
+    else: 
         collection = ds
-    else: collection = collection[0]
     
-    return collection
+    listing = CollectionListing(collection, pnsv)
+    _LISTINGS[(dataset, ptID)] = listing
+    
+    return listing
+
+
+def clear_listing_cache():
+    ''' Drop all cached collection listings '''
+    
+    _LISTINGS.clear()
+    
+    
+# Annotation Label Cache
+
+class LabelCache:
+    '''
+    Local cache of the annotation labels in each (timeseries, layer) on 
+    Pennsieve, persisted between runs as a json file. Remote layers and labels
+    are only fetched when an entry is missing, older than max_age, or belongs 
+    to a timeseries with a different package id, or on every lookup with 
+    sync='full'. Labels inserted by pennsieve_tools are added to the cache.
+    
+    Args:
+        path (str, optional): json file, None to keep the cache in memory
+        max_age (float, optional): seconds before an entry is stale, None if 
+            entries never go stale. Defaults to LABEL_CACHE_MAX_AGE.
+        sync (str, optional): 'stale' to fetch only stale entries, 'full' to
+            always fetch. Defaults to 'stale'.
+            
+    Example:
+        cache = LabelCache(utils.getDataPath(ptID, config, 'pennsieve label cache'))
+        new_labels = set(labels) - cache.labels(listing, item, 'Seizures')
+        ...
+        cache.add(item, 'Seizures', new_labels)
+        cache.save()
+    '''
+    
+    def __init__(self, path=None, max_age=LABEL_CACHE_MAX_AGE, sync='stale'):
+        
+        assert sync in ['stale', 'full'], 'sync must be "stale" or "full"'
+        
+        self.path = path
+        self.max_age = max_age
+        self.sync = sync
+        self._ts = {}
+        
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._ts = json.load(f)['timeseries']
+            for entry in self._ts.values():
+                for lentry in entry['layers'].values():
+                    lentry['labels'] = set(lentry['labels'])
+                    
+    
+    def layers(self, listing, item):
+        ''' Names of layers in item '''
+        
+        entry = self._entry(item)
+        if self._stale(entry['updated']):
+            entry['layers'] = {name: entry['layers'].get(name, {'updated': None, 'labels': set()})
+                               for name in listing.layers(item.name)}
+            entry['updated'] = time.time()
+            
+        return list(entry['layers'].keys())
+    
+    
+    def labels(self, listing, item, layer):
+        ''' Set of annotation labels in layer of item '''
+        
+        entry = self._entry(item)
+        
+        # Layer is known not to exist
+        if layer not in entry['layers'] and not self._stale(entry['updated']):
+            return set()
+        
+        lentry = entry['layers'].get(layer)
+        if lentry is None or self._stale(lentry['updated']):
+            remote = listing.layers(item.name).get(layer)
+            if remote is None:
+                return set()
+            lentry = {'updated': time.time(), 'labels': set(a.label for a in remote.annotations())}
+            entry['layers'][layer] = lentry
+            
+        return set(lentry['labels'])
+    
+    
+    def add(self, item, layer, labels):
+        ''' Add labels inserted into layer of item '''
+        
+        entry = self._entry(item)
+        lentry = entry['layers'].setdefault(layer, {'updated': time.time(), 'labels': set()})
+        lentry['labels'].update(labels)
+        
+        
+    def drop(self, item, layer=None):
+        ''' Drop cached labels of layer, or of all layers, of item '''
+        
+        if layer is None:
+            self._ts.pop(item.name, None)
+        elif item.name in self._ts:
+            self._ts[item.name]['layers'].pop(layer, None)
+            self._ts[item.name]['updated'] = None
+        
+            
+    def save(self):
+        ''' Write cache to path '''
+        
+        if not self.path:
+            return
+        
+        ts = {name: dict(entry, layers={l: {'updated': v['updated'], 'labels': sorted(v['labels'])}
+                                        for l, v in entry['layers'].items()})
+              for name, entry in self._ts.items()}
+        
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'timeseries': ts}, f)
+        os.replace(tmp, self.path)
+        
+        
+    def _entry(self, item):
+        # Cache entry of item, reset if item is a different package
+        
+        item_id = getattr(item, 'id', None)
+        entry = self._ts.get(item.name)
+        if entry is None or entry['id'] != item_id:
+            entry = self._ts[item.name] = {'id': item_id, 'updated': None, 'layers': {}}
+        return entry
+    
+    
+    def _stale(self, updated):
+        # True if an entry updated at time updated must be fetched again
+        
+        if updated is None or self.sync == 'full':
+            return True
+        return self.max_age is not None and time.time() - updated > self.max_age
+    
+
+# Data Functions
+
+def processPatientTimeseries(ptIDs, config, pnsv):
+    
+    for ptID in ptIDs:
+        _processUploaded(get_pt_listing(ptID, config, pnsv))
+    
+
+def get_pt_collection(ptID, config, pnsv):
+    
+    return get_pt_listing(ptID, config, pnsv).collection
         
 
 def uploadSingleDat(ptID, config, pnsv, ecog_catalog_inds = None):
@@ -65,20 +335,24 @@ def uploadSingleDat(ptID, config, pnsv, ecog_catalog_inds = None):
     i_pt = utils.ptIdxLookup(config, 'ID', ptID)
     dataset = config['patients'][i_pt]['pnsv_dataset']
     
-    collection = pnsv.get_dataset(dataset)    
+    listing = CollectionListing(pnsv.get_dataset(dataset), pnsv)
 
-    [ecog_df, tmpPath] = _upload_prep(ptID, config, pnsv, ecog_catalog_inds)
+    [catalog, tmpPath] = _upload_prep(ptID, config, pnsv, ecog_catalog_inds)
     
     ts_name = ptID
-    npdh.createConcatDatLayFiles(ptID, config, ecog_df, ts_name, tmpPath)  
+    npdh.createConcatDatLayFiles(ptID, config, catalog, ts_name, tmpPath)  
 
-    _upload_dir_to_pnsv(ptID, tmpPath, collection)
+    _upload_dir_to_pnsv(ptID, tmpPath, listing)
     
 
-def uploadNewDatByMonth(ptID, config, pnsv, ecog_catalog_inds=None):
+def uploadNewDatByMonth(ptID, config, pnsv, ecog_catalog_inds=None, n_jobs=1,
+                        max_tmp_bytes=None):
     """
     Uploads new .dat files to patient folder in dataset. All .dat files
-    for a given month are concatenated into a single timeseries.
+    for a given month are concatenated into a single timeseries. Each month
+    is uploaded and deleted from the temp folder as soon as it is built,
+    while the following months are being built. A min/max pyramid of each
+    month is kept in the patient's Month_Pyramids folder.
     
     Args:
         ptID (string): DESCRIPTION.
@@ -86,55 +360,53 @@ def uploadNewDatByMonth(ptID, config, pnsv, ecog_catalog_inds=None):
         pnsv (Pennsieve): Pennsieve object
         ecog_catalog_inds ([int], optional): indices of selected events 
         in ecog catalog to upload. Defaults to None.
+        n_jobs (int, optional): number of processes used to build month
+        files concurrently. Defaults to 1.
+        max_tmp_bytes (int, optional): cap on the size of month files being
+        built or waiting for upload in the temp folder. At least one month is
+        always in flight. Defaults to None (no cap).
 
     Returns:
-        None.
+        failed ([str]): names of months that failed to build or upload, [] 
+        if all new months were uploaded. Failed months are built again on 
+        the next run.
 
     """
 
     logging.info('Consolidating %s data for Pennsieve'%ptID)
 
-    i_pt = utils.ptIdxLookup(config, 'ID', ptID)
-    dataset = config['patients'][i_pt]['pnsv_dataset']
+    listing = get_pt_listing(ptID, config, pnsv, create=True)
+    [catalog, tmpPath] = _upload_prep(ptID, config, pnsv, ecog_catalog_inds)
     
-    try:
-        ds = pnsv.get_dataset(dataset)
-    except:
-        ds = pnsv.create_dataset(dataset)
-        
-    # Get collection for ptID, create one if nonexistent
-    collection  = [i for i in ds.items if i.type == 'Collection' and i.name == ptID]
-    print('trying to get a collection')
-    if not collection:
-        collection = ds.create_collection(ptID)
-    else: collection = collection[0]
-    [ecog_df, tmpPath] = _upload_prep(ptID, config, pnsv, ecog_catalog_inds)
-    
-    utc_dt = [DT.datetime.strptime(s,"%Y-%m-%d %H:%M:%S.%f") for s in ecog_df['Raw UTC timestamp']]
-    yrmin= min(y.year for y in utc_dt)
-    yrmax = max(y.year for y in utc_dt)
     today = DT.date.today()
-            
-    # Concatenate .dat files for each month if collection doesn't exist, then upload 
-    for yr in range(yrmin,yrmax+1):
-        for mon in range (1,13):
-            
-            # Skip current month to avoid partial month upload
-            if (mon == today.month and yr == today.year):
-                break
-            
-            ts_name = '%s_%d_%02d'%(ptID, yr, mon)
-            
-            mon_inds = [i for i, x in enumerate(utc_dt)
-                    if x.month == mon and x.year == yr]
-                
-            if mon_inds and not collection.get_items_by_name('%s_%d_%02d'%(ptID, yr, mon)):
-                npdh.createConcatDatLayFiles(ptID, config,
-                                              ecog_df.iloc[mon_inds],
-                                              ts_name,
-                                              tmpPath) 
     
-    _upload_dir_to_pnsv(ptID, tmpPath, collection)
+    # Months with data that don't have a timeseries yet, skipping current 
+    # month to avoid partial month upload
+    months = {}
+    for (yr, mon), mon_inds in _monthGroups(catalog.trigger_usec).items():
+        
+        if (yr, mon) >= (today.year, today.month):
+            continue
+        
+        ts_name = '%s_%d_%02d'%(ptID, yr, mon)
+        if listing.get(ts_name) is None:
+            months[ts_name] = mon_inds
+    
+    # Concatenate .dat files for each new month, uploading each when built
+    failed = []
+    if months:
+        failed = _pipelineMonths(ptID, config, catalog, months, tmpPath, listing,
+                                 n_jobs, max_tmp_bytes)
+        _processUploaded(listing)
+    else:
+        print('No new data to upload for %s'%ptID)
+        
+    shutil.rmtree(tmpPath)
+    
+    if failed:
+        logging.error('%s months failed: %s'%(ptID, failed))
+        
+    return failed
 
 
 
@@ -144,21 +416,21 @@ def uploadNewDatByMonth(ptID, config, pnsv, ecog_catalog_inds=None):
 def pull_annotations(ptID, config, layerName, pnsv):
     
     
-    collection = get_pt_collection(ptID, config, pnsv)
+    listing = get_pt_listing(ptID, config, pnsv)
     
     anns = []
     desc = []
     
-    for ts in collection.items:
+    for ts in listing:
         
         if ts.type != 'TimeSeries':
             continue
         
-        if not np.isin(layerName, [l.name for l in ts.layers]):
+        layer = listing.layers(ts.name).get(layerName)
+        if layer is None:
             continue
         
-        layer = ts.get_layer(layerName)
-        labels = [annot.label for annot in ts.get_layer(layerName).annotations()]
+        labels = [annot.label for annot in layer.annotations()]
         print(labels)
         
      	# Make sure annotations are correct. 
@@ -175,69 +447,43 @@ def pull_annotations(ptID, config, layerName, pnsv):
     
 def add_empty_layer(ptID, config, layerName, pnsv):
     
-    collection = get_pt_collection(ptID, config, pnsv)
-    for ts in collection.items:
+    listing = get_pt_listing(ptID, config, pnsv)
+    for ts in listing:
             if ts.type == 'TimeSeries':
                 ts.add_layer(layerName)
+                listing.refresh(ts.name)
     
 def delete_layer(ptID, config, layerName, pnsv):
     
-    collection = get_pt_collection(ptID, config, pnsv)
-    for ts in collection.items:
+    listing = get_pt_listing(ptID, config, pnsv)
+    cache = _label_cache(ptID, config)
+    for ts in listing:
         if ts.type == 'TimeSeries':
-            if any([layerName in i.name for i in ts.layers]):
+            if any([layerName in i for i in listing.layers(ts.name)]):
                 layer = ts.get_layer(layerName)
                 ts.delete_layer(layer)
+                listing.refresh(ts.name)
+                cache.drop(ts)
+    cache.save()
             
 
-def annotate_UTC_from_mat(ptID, config, newLayer, annot_mat_file, pnsv):
-    
-    collection = get_pt_collection(ptID, config, pnsv)
+def annotate_UTC_from_mat(ptID, config, newLayer, annot_mat_file, pnsv, sync='stale'):
     
     logging.info('Adding new annotations to %s layer for %s'%(newLayer, ptID))
 
     annotations = sio.loadmat(annot_mat_file) # Your path to .mat file of timestamps in UTC here (e.g. /home/data/RNS_DataSharing/...)
     annots = annotations['annots']  # Get annots, should be stored in posixtime microseconds
     
-    annots_dt= []
-    annots_dt.append(utils.posix2dt_UTC(annots[:,0]))  # Clunky but I don't know how to do this better... 
-    annots_dt.append(utils.posix2dt_UTC(annots[:,1]))
-    
     try: 
          descriptions = annotations['descriptions']
     except: 
         descriptions = [newLayer] * len(annots)
 
-    annot_time_str = [DT.datetime.strftime(annot, "%Y-%m-%d %H:%M:%S.%f")[:-3]for annot in annots_dt[0]]
-    annot_str = ['%s-- %s'%(i,j) for i,j in zip(descriptions, annot_time_str)]
-    
-    yrmin= min(y.year for y in annots_dt[0])
-    yrmax = max(y.year for y in annots_dt[1])
-    
-    # Upload annotations to layer
-    for yr in range(yrmin,yrmax+1):
-        for mon in range (1,13):
-            
-            mon_inds = [i for i, x in enumerate(annots_dt[0])
-                    if x.month == mon and x.year == yr]
-            
-            if mon_inds:
-                item = collection.get_items_by_name('%s_%d_%02d'%(ptID, yr, mon))[0]
-                
-                if any([newLayer in i.name for i in item.layers]):
-                    old_labels = [annot.label for annot in item.get_layer(newLayer).annotations()]
-                    new_labels_i = [count for count, i in  enumerate([annot_str[i] for i in mon_inds]) if i not in old_labels]
-                    mon_inds = [mon_inds[i] for i in new_labels_i]
-                
-                logging.info('Uploading %d new annotations to layer %s in %s'%(len(mon_inds), newLayer, item.name))
-                
-                for i in mon_inds:
-                    item.insert_annotation(newLayer, annot_str[i], 
-                                           start = int(round(annots[i,0]/1000, 0)*1000), 
-                                           end = int(round(annots[i,1]/1000, 0)*1000))
+    return _annotate_by_month(ptID, config, pnsv, newLayer, annots[:,0], annots[:,1], 
+                              descriptions, sync)
                     
                     
-def annotate_UTC_from_dataframe(ptID, config, newLayer, annot_df, pnsv):
+def annotate_UTC_from_dataframe(ptID, config, newLayer, annot_df, pnsv, sync='stale'):
     '''
     Args:
         ptID (String): Patient ID (e.g. 'HUP1234')
@@ -248,148 +494,196 @@ def annotate_UTC_from_dataframe(ptID, config, newLayer, annot_df, pnsv):
                 - annot_end
                 - descriptions
         pnsv (TYPE): DESCRIPTION.
+        sync (str, optional): 'stale' to only fetch existing labels not in
+            the local label cache, 'full' to always fetch. Defaults to 'stale'.
 
     Returns:
-        None.
+        summary (dict): number of 'inserted', 'skipped' and 'failed' annotations
 
     '''
     
-    collection = get_pt_collection(ptID, config, pnsv)
-    
     logging.info('Adding new annotations to %s layer for %s'%(newLayer, ptID))
 
-    annotstart = annot_df['annot_start']  # Get annots, should be stored in posixtime microseconds
-    annotend = annot_df['annot_end'] 
-    
-    annots_dt= []
-    annots_dt.append(utils.posix2dt_UTC(annotstart))  # Clunky but I don't know how to do this better... 
-    annots_dt.append(utils.posix2dt_UTC(annotend))
+    annotstart = annot_df['annot_start'].values  # Get annots, should be stored in posixtime microseconds
+    annotend = annot_df['annot_end'].values
     
     try: 
-         descriptions = annot_df['descriptions']
+         descriptions = annot_df['descriptions'].tolist()
     except: 
         descriptions = [newLayer] * len(annotstart)
 
-    annot_time_str = [DT.datetime.strftime(annot, "%Y-%m-%d %H:%M:%S.%f")[:-3]for annot in annots_dt[0]]
-    annot_str = ['%s-- %s'%(i,j) for i,j in zip(descriptions, annot_time_str)]
-    
-    yrmin= min(y.year for y in annots_dt[0])
-    yrmax = max(y.year for y in annots_dt[1])
-    
-    # Upload annotations to layer
-    for yr in range(yrmin,yrmax+1):
-        for mon in range (1,13):
-            
-            mon_inds = [i for i, x in enumerate(annots_dt[0])
-                    if x.month == mon and x.year == yr]
-            
-            if mon_inds:
-                item = collection.get_items_by_name('%s_%d_%02d'%(ptID, yr, mon))[0]
-                
-                if any([newLayer in i.name for i in item.layers]):
-                    old_labels = [annot.label for annot in item.get_layer(newLayer).annotations()]
-                    new_labels_i = [count for count, i in  enumerate([annot_str[i] for i in mon_inds]) if i not in old_labels]
-                    mon_inds = [mon_inds[i] for i in new_labels_i]
-                
-                logging.info('Uploading %d new annotations to layer %s in %s'%(len(mon_inds), newLayer, item.name))
-                
-                for i in mon_inds:
-                    item.insert_annotation(newLayer, annot_str[i], 
-                                           start = int(round(annotstart[i]/1000, 0)*1000), 
-                                           end = int(round(annotend[i]/1000, 0)*1000))
+    return _annotate_by_month(ptID, config, pnsv, newLayer, annotstart, annotend, 
+                              descriptions, sync)
                     
 
 def annotate_timeseries_from_dataframe(newLayer, annot_df, ts):
     
-    annotstart = annot_df['annot_start']  # Get annots, should be stored in posixtime microseconds
-    annotend = annot_df['annot_end'] 
-    
-    annots_dt= []
-    annots_dt.append(utils.posix2dt_UTC(annotstart))  # Clunky but I don't know how to do this better... 
-    annots_dt.append(utils.posix2dt_UTC(annotend))
+    annotstart = annot_df['annot_start'].values  # Get annots, should be stored in posixtime microseconds
+    annotend = annot_df['annot_end'].values
     
     try: 
-         descriptions = annot_df['descriptions']
+         descriptions = annot_df['descriptions'].tolist()
     except: 
         descriptions = [newLayer] * len(annotstart)
         
-    annot_time_str = [DT.datetime.strftime(annot, "%Y-%m-%d %H:%M:%S.%f")[:-3]for annot in annots_dt[0]]
+    annot_time_str = utils.usec2str(annotstart)
     annot_str = ['%s-- %s'%(i,j) for i,j in zip(descriptions, annot_time_str)]
 
-    for i in annot_df.index:
-        ts.insert_annotation(newLayer, annot_str[i], 
-                               start = int(round(annotstart[i]/1000, 0)*1000), 
-                               end = int(round(annotend[i]/1000, 0)*1000))
+    annots = [(newLayer, annot_str[i], _round_ms(annotstart[i]), _round_ms(annotend[i]))
+              for i in range(len(annot_str))]
+    
+    return insert_annotations(ts, annots)
     
 
-def annotate_UTC_from_catalog(ptID, config, pnsv):
+def annotate_UTC_from_catalog(ptID, config, pnsv, sync='stale'):
     ''' Uploads all annotations from ecog_catalog to a patient's data. Does not 
         upload duplicate annotations, skips upload if a timeseries is not processed. 
+        Existing labels are fetched only if not in the local label cache, or 
+        always with sync='full'.
     '''
     
     logging.info('Adding annotations from catalog for %s'%ptID)
     
-    collection = get_pt_collection(ptID, config, pnsv)
+    listing = get_pt_listing(ptID, config, pnsv)
     
     # Error if collection doesn't exist!
     
-    catalog_csv = npdh.NPgetDataPath(ptID, config, 'ECoG Catalog')
-    
-    try:
-        ecog_df= pd.read_csv(catalog_csv)
-    except TimeoutError:
-        logging.info('Timeout error reading EcoG Catalog, trying again')
-        ecog_df= pd.read_csv(catalog_csv)
-    
-    utc_dt = [DT.datetime.strptime(s,"%Y-%m-%d %H:%M:%S.%f") for s in ecog_df['Raw UTC timestamp']]
+    catalog = _read_catalog(ptID, config)
+    months = _monthGroups(catalog.trigger_usec)
     
     # Get the timeseries corresponding to each month/year, and upload
     # corresponding annotations to that month. 
     
     itemsProcessed = True
+    processed = False
+    summary = {'inserted': 0, 'skipped': 0, 'failed': 0}
+    cache = _label_cache(ptID, config, sync)
     
-    for item in collection.items:
+    for item in listing.items:
         
         # First check that item has been procesed:
         if not item.state=='READY':
             if item.state=='UPLOADED':
                 item.process() 
+                processed = True
             itemsProcessed = False
             logging.warning('Item %s not processed, current status %s'%(item.name, item.state))
          
             continue
         
-        # Get event indexes corresponding to year and month
-        [ID, yr, mon] = item.name.split('_')
-        mon_inds = [i for i, x in enumerate(utc_dt)
-                    if x.month == int(mon) and x.year == int(yr)]
-        if mon_inds:
-            trigger_utc_datetime = ecog_df['Raw UTC timestamp'].iloc[mon_inds]
-            trigger_utc = utils.str2dt_usec(trigger_utc_datetime.tolist())
-            trigger_local = utils.str2dt_usec(ecog_df['Raw local timestamp'].iloc[mon_inds].tolist())
-            start_local =  utils.str2dt_usec(ecog_df['Timestamp'].iloc[mon_inds].tolist())
-            ecog_len  =  ecog_df['ECoG length'].iloc[mon_inds]
-            trigger_types = ecog_df['ECoG trigger'].iloc[mon_inds]
-
-            tz_offset = np.subtract(trigger_utc,trigger_local)
-            starttimes = np.add(start_local,tz_offset)
-            endtimes = list(ecog_len*1000000 + starttimes)
-            
-            all_descriptions = [i+' '+str(j)+'--'+k for i, j,k in zip(trigger_types, mon_inds, trigger_utc_datetime)]
-            
-            # only upload descriptions not in current annotation labels to prevent duplicates
-            annotlist = [l.annotations() for l in item.layers]
-            labels = [annot.label for annot in [i for sub in annotlist for i in sub]]
-            descriptions = [i for i in all_descriptions if i not in labels]
-            
-            for i_annot in range(0,len(descriptions)):
-                
-                #logging.info('Uploading %d new annotations to %s'%(len(descriptions), item.name))
-                item.insert_annotation(trigger_types.iloc[i_annot], descriptions[i_annot],
-                                       start=int(starttimes[i_annot]), 
-                                       end=int(endtimes[i_annot]))
+        _add_summary(summary, _annotate_catalog_month(listing, cache, item, catalog, months))
+    
+    if processed:
+        listing.refresh()
+    cache.save()
+    logging.info('%s catalog annotations: %d inserted, %d skipped, %d failed'
+                 %(ptID, summary['inserted'], summary['skipped'], summary['failed']))
         
     return itemsProcessed
+
+
+def poll_catalog_annotations(ptList, config, pnsv, deadline=POLL_DEADLINE, 
+                             min_wait=POLL_MIN_WAIT, max_wait=POLL_MAX_WAIT, 
+                             n_threads=4, sync='stale'):
+    '''
+    Uploads catalog annotations (see annotate_UTC_from_catalog) for several 
+    patients concurrently, annotating each month's timeseries as soon as 
+    Pennsieve has processed it. Each patient's processing states are polled 
+    with exponential backoff, from min_wait up to max_wait seconds, reset 
+    whenever a timeseries changes state. Polling stops at the deadline.
+    
+    Args:
+        ptList (list): patient IDs
+        config (dict): config dictionary
+        pnsv (Pennsieve): Pennsieve object
+        deadline (float, optional): seconds until polling stops for all 
+            patients. Defaults to POLL_DEADLINE.
+        min_wait (float, optional): first wait between polls, seconds. 
+            Defaults to POLL_MIN_WAIT.
+        max_wait (float, optional): longest wait between polls, seconds.
+            Defaults to POLL_MAX_WAIT.
+        n_threads (int, optional): patients polled concurrently. Defaults to 4.
+        sync (str, optional): label cache sync mode, 'stale' or 'full'. 
+            Defaults to 'stale'.
+            
+    Returns:
+        ptDone (dict): ptID: True if all of the patient's timeseries were 
+        annotated before the deadline
+        
+    Example:
+        ptDone = poll_catalog_annotations(['HUP123', 'HUP124'], config, pnsv)
+    '''
+    
+    t_end = time.monotonic() + deadline
+    
+    def poll(ptID):
+        try:
+            return _poll_patient(ptID, config, pnsv, t_end, min_wait, max_wait, sync)
+        except Exception:
+            logging.exception('%s catalog annotation failed'%ptID)
+            return False
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(n_threads, len(ptList)))) as ex:
+        ptDone = dict(zip(ptList, ex.map(poll, ptList)))
+    
+    return ptDone
+
+
+def insert_annotations(item, annots, layers=None, n_threads=ANNOT_THREADS, 
+                       retries=ANNOT_RETRIES):
+    '''
+    Inserts annotations into a timeseries concurrently, with a bounded thread 
+    pool. Transient errors (connection errors, timeouts, 429 and 5xx 
+    responses) are retried with exponential backoff, other errors fail the 
+    annotation immediately. The first annotation of each new layer is 
+    inserted on its own so concurrent inserts don't race to create the layer.
+    
+    Args:
+        item: Pennsieve timeseries package
+        annots (list): (layer, label, start, end) tuples, start and end in 
+            posix usec
+        layers (list, optional): names of existing layers in item. Defaults to
+            None, read from item.
+        n_threads (int, optional): maximum concurrent inserts. Defaults to 
+            ANNOT_THREADS.
+        retries (int, optional): retries per annotation. Defaults to ANNOT_RETRIES.
+        
+    Returns:
+        summary (dict): number of 'inserted' and 'failed' annotations
+        
+    Example:
+        annots = [('Seizures', 'Seizure 1', 1580972555964000, 1580972585964000)]
+        summary = insert_annotations(ts, annots)
+    '''
+    
+    summary = {'inserted': 0, 'failed': 0}
+    if not annots:
+        return summary
+    
+    if layers is None:
+        layers = [l.name for l in item.layers]
+    
+    # Split off first annotation of each new layer
+    new_layers = set()
+    first = []
+    rest = []
+    for annot in annots:
+        if annot[0] in layers or annot[0] in new_layers:
+            rest.append(annot)
+        else:
+            new_layers.add(annot[0])
+            first.append(annot)
+    
+    for annot in first:
+        summary[_insert_annotation(item, annot, retries)] += 1
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(n_threads, len(rest)))) as ex:
+        for result in ex.map(lambda a: _insert_annotation(item, a, retries), rest):
+            summary[result] += 1
+    
+    logging.info('Inserted %d annotations in %s, %d failed'%(summary['inserted'], 
+                                                             item.name, summary['failed']))
+    return summary
         
 
 
@@ -408,6 +702,8 @@ def _upload_prep(ptID, config, pnsv, ecog_catalog_inds):
     # Only upload data specified by ecog_catalog_inds
     if ecog_catalog_inds:
         ecog_df = ecog_df.iloc[ecog_catalog_inds]
+    
+    catalog = EcogCatalog(ecog_df, npdh.NPgetDataPath(ptID, config, 'Dat Folder'))
         
     tmpdir = tempfile.gettempdir()
     tmpPath = os.path.join(tmpdir,'RNS_RAW_Folder','tmp_%s'%ptID)
@@ -417,34 +713,341 @@ def _upload_prep(ptID, config, pnsv, ecog_catalog_inds):
         shutil.rmtree(tmpPath)
     os.makedirs(tmpPath)     
     
-    return ecog_df, tmpPath
+    return catalog, tmpPath
+
+
+def _read_catalog(ptID, config):
+    # Patient's ECoG catalog
+    
+    catalog_csv = npdh.NPgetDataPath(ptID, config, 'ECoG Catalog')
+    
+    try:
+        ecog_df= pd.read_csv(catalog_csv)
+    except TimeoutError:
+        logging.info('Timeout error reading EcoG Catalog, trying again')
+        ecog_df= pd.read_csv(catalog_csv)
+        
+    return EcogCatalog(ecog_df)
+
+
+def _annotate_catalog_month(listing, cache, item, catalog, months):
+    # Uploads catalog annotations of the month of processed timeseries item
+    
+    # Get event indexes corresponding to year and month
+    [ID, yr, mon] = item.name.split('_')
+    mon_inds = months.get((int(yr), int(mon)), [])
+    if not len(mon_inds):
+        return {}
+    
+    ecog_df = catalog.df
+    trigger_utc_datetime = ecog_df['Raw UTC timestamp'].values[mon_inds]
+    ecog_len  =  ecog_df['ECoG length'].values[mon_inds]
+    trigger_types = ecog_df['ECoG trigger'].values[mon_inds]
+
+    starttimes = catalog.timestamp_usec[mon_inds]
+    endtimes = ecog_len*1000000 + starttimes
+    
+    all_annots = [(i, i+' '+str(j)+'--'+k, int(s), int(e)) for i, j, k, s, e in 
+                  zip(trigger_types, mon_inds, trigger_utc_datetime, starttimes, endtimes)]
+    
+    # only upload descriptions not in current annotation labels to prevent duplicates
+    labels = set().union(*[cache.labels(listing, item, l) 
+                           for l in cache.layers(listing, item)])
+    annots = [a for a in all_annots if a[1] not in labels]
+    
+    summary = _insert_and_cache(listing, cache, item, annots)
+    _add_summary(summary, {'skipped': len(all_annots) - len(annots)})
+    
+    return summary
+
+
+def _poll_patient(ptID, config, pnsv, t_end, min_wait, max_wait, sync='stale'):
+    # Polls a patient's timeseries states until all are annotated or time 
+    # t_end (time.monotonic), annotating each as soon as it is READY. The 
+    # collection is fetched again from pnsv on each poll, and processing is
+    # triggered once per uploaded timeseries. Returns True if all timeseries 
+    # were annotated.
+    
+    listing = get_pt_listing(ptID, config, pnsv)
+    catalog = _read_catalog(ptID, config)
+    months = _monthGroups(catalog.trigger_usec)
+    cache = _label_cache(ptID, config, sync)
+    summary = {'inserted': 0, 'skipped': 0, 'failed': 0}
+    
+    states = {}
+    done = set()
+    processed = set()
+    wait_s = min_wait
+    
+    try:
+        while True:
+            changed = False
+            
+            for item in listing.items:
+                if item.type != 'TimeSeries' or item.name in done:
+                    continue
+                
+                if item.state != states.get(item.name):
+                    logging.info('%s state %s'%(item.name, item.state))
+                    states[item.name] = item.state
+                    changed = True
+                
+                if item.state == 'READY':
+                    _add_summary(summary, _annotate_catalog_month(listing, cache, item, catalog, months))
+                    done.add(item.name)
+                elif item.state == 'UPLOADED' and item.name not in processed:
+                    item.process()
+                    processed.add(item.name)
+                elif item.state in ['ERROR', 'FAILED']:
+                    logging.error('%s processing failed, not annotating'%item.name)
+                    done.add(item.name)
+            
+            pending = [name for name in states if name not in done]
+            if not pending:
+                return not any(states[name] in ['ERROR', 'FAILED'] for name in done)
+            
+            # Back off while nothing changes
+            wait_s = min_wait if changed else min(wait_s*2, max_wait)
+            t_left = t_end - time.monotonic()
+            if t_left <= 0:
+                logging.warning('%s timed out, %s are not annotated'%(ptID, pending))
+                return False
+            
+            time.sleep(min(wait_s, t_left))
+            listing.refresh()
+    finally:
+        cache.save()
+        logging.info('%s catalog annotations: %d inserted, %d skipped, %d failed'
+                     %(ptID, summary['inserted'], summary['skipped'], summary['failed']))
 
 
-def _upload_dir_to_pnsv(ptID, tmpPath, collection):
-    #Upload folder with datasets if directory contains files
-    if os.listdir(tmpPath):
+def _annotate_by_month(ptID, config, pnsv, newLayer, annotstart, annotend, descriptions, 
+                       sync='stale'):
+    # Uploads new annotations to layer of the timeseries of the month they start
+    # in, skipping annotations whose label is already in the layer
+    
+    listing = get_pt_listing(ptID, config, pnsv)
+    cache = _label_cache(ptID, config, sync)
+    
+    annot_time_str = utils.usec2str(annotstart)
+    annot_str = ['%s-- %s'%(i,j) for i,j in zip(descriptions, annot_time_str)]
+    
+    summary = {'inserted': 0, 'skipped': 0, 'failed': 0}
+    
+    # Upload annotations to layer
+    for (yr, mon), mon_inds in _monthGroups(annotstart).items():
+        
+        item = listing.get('%s_%d_%02d'%(ptID, yr, mon))
+        if item is None:
+            logging.warning('No timeseries for %s_%d_%02d, skipping %d annotations'
+                            %(ptID, yr, mon, len(mon_inds)))
+            summary['skipped'] += len(mon_inds)
+            continue
+        
+        old_labels = cache.labels(listing, item, newLayer)
+        new_inds = [i for i in mon_inds if annot_str[i] not in old_labels]
+        summary['skipped'] += len(mon_inds) - len(new_inds)
+        
+        logging.info('Uploading %d new annotations to layer %s in %s'%(len(new_inds), newLayer, item.name))
+        
+        annots = [(newLayer, annot_str[i], _round_ms(annotstart[i]), _round_ms(annotend[i]))
+                  for i in new_inds]
+        _add_summary(summary, _insert_and_cache(listing, cache, item, annots))
+    
+    cache.save()
+    logging.info('%s %s annotations: %d inserted, %d skipped, %d failed'
+                 %(ptID, newLayer, summary['inserted'], summary['skipped'], summary['failed']))
+    
+    return summary
+
+
+def _label_cache(ptID, config, sync='stale'):
+    # Patient's persisted annotation label cache
+    
+    return LabelCache(utils.getDataPath(ptID, config, 'pennsieve label cache'), sync=sync)
+
+
+def _insert_and_cache(listing, cache, item, annots):
+    # Inserts annotations into item and adds their labels to cache. Layers 
+    # with failed inserts are dropped from cache, to be fetched next time
+    
+    if not annots:
+        return {}
+    
+    summary = insert_annotations(item, annots, cache.layers(listing, item))
+    listing.refresh(item.name)
+    
+    for layer in set(a[0] for a in annots):
+        if summary['failed']:
+            cache.drop(item, layer)
+        else:
+            cache.add(item, layer, [a[1] for a in annots if a[0] == layer])
+            
+    return summary
+
+
+def _insert_annotation(item, annot, retries):
+    # Inserts a single (layer, label, start, end) annotation, retrying on 
+    # transient errors. Returns 'inserted' or 'failed'
+    
+    [layer, label, start, end] = annot
+    
+    for i_try in range(retries + 1):
         try:
+            item.insert_annotation(layer, label, start=int(start), end=int(end))
+            return 'inserted'
+        except Exception as err:
+            if i_try == retries or not _is_transient(err):
+                logging.error('Failed to insert annotation %s in %s: %s'%(label, item.name, err))
+                return 'failed'
+            time.sleep(ANNOT_RETRY_WAIT * 2**i_try)
+
+
+def _is_transient(err):
+    # True for errors worth retrying: connection errors, timeouts, rate 
+    # limits (429) and server errors (5xx). Other HTTP errors (4xx) won't 
+    # succeed on retry
+    
+    status = getattr(getattr(err, 'response', None), 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    
+    return isinstance(err, (ConnectionError, TimeoutError, 
+                            requests.ConnectionError, requests.Timeout))
+
+
+def _add_summary(summary, new):
+    # Adds annotation counts in new to summary
+    
+    for key, val in new.items():
+        summary[key] = summary.get(key, 0) + val
+        
+
+def _round_ms(usec):
+    # Rounds posix usec time to the nearest ms
+    
+    return int(round(usec/1000, 0)*1000)
+
+
+def _monthGroups(usec):
+    # Dictionary of (year, month) to positions of posix usec times in that 
+    # month, in chronological order
+    
+    utc_dt = pd.DatetimeIndex(utils.usec2dt64(usec))
+    groups = pd.Series(np.arange(len(utc_dt))).groupby([utc_dt.year, utc_dt.month]).indices
+    
+    return {(int(yr), int(mon)): inds for (yr, mon), inds in sorted(groups.items())}
+
+
+def _monthBytes(catalog, mon_inds):
+    # Upper bound on size of a month's concatenated .dat file, off channels padded
+    
+    return int((np.maximum(catalog.nbytes[mon_inds], 0) // catalog.n_enabled[mon_inds]).sum()*npdh.NUM_CHANNELS)
+
+
+def _pipelineMonths(ptID, config, catalog, months, tmpPath, listing, 
+                    n_jobs=1, max_tmp_bytes=None):
+    # Builds each month (ts_name: catalog positions) in its own folder under
+    # tmpPath, uploads and deletes it as soon as it is built. New builds are
+    # started while the estimated bytes in flight stay under max_tmp_bytes.
+    # Returns names of months that failed.
+    
+    pending = list(months.keys())
+    sizes = {ts_name: _monthBytes(catalog, months[ts_name]) for ts_name in pending}
+    running = {}
+    in_flight = 0
+    failed = []
+    
+    # A single build thread still overlaps building with uploading
+    if n_jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=min(n_jobs, len(pending)))
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+    
+    with executor as ex:
+        while pending or running:
+            
+            while (pending and len(running) < max(n_jobs, 1) and 
+                   (not running or max_tmp_bytes is None or 
+                    in_flight + sizes[pending[0]] <= max_tmp_bytes)):
+                ts_name = pending.pop(0)
+                monPath = os.path.join(tmpPath, ts_name)
+                os.makedirs(monPath)
+                fut = ex.submit(_buildMonth, ptID, config, 
+                                catalog.subset(months[ts_name]), ts_name, monPath)
+                running[fut] = ts_name
+                in_flight += sizes[ts_name]
+                
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            
+            for fut in done:
+                ts_name = running.pop(fut)
+                monPath = os.path.join(tmpPath, ts_name)
+                try:
+                    fut.result()
+                    logging.info('Built %s'%ts_name)
+                    _upload_dir_to_pnsv(ptID, monPath, listing, process=False)
+                except Exception:
+                    logging.exception('Failed to build or upload %s'%ts_name)
+                    shutil.rmtree(monPath, ignore_errors=True)
+                    failed.append(ts_name)
+                in_flight -= sizes[ts_name]
+                
+    return failed
+
+
+def _buildMonth(ptID, config, catalog, ts_name, monPath):
+    # Builds a month's concatenated .dat and .lay files in monPath, and its
+    # min/max pyramid outside of monPath, which is uploaded and deleted. 
+    # Pyramid errors are logged but don't fail the build
+    
+    npdh.createConcatDatLayFiles(ptID, config, catalog, ts_name, monPath)
+    
+    try:
+        pyrPath = utils.getDataPath(ptID, config, 'month pyramid folder')
+        os.makedirs(pyrPath, exist_ok=True)
+        minmax_pyramid.buildDatPyramid(os.path.join(monPath, '%s.dat'%ts_name),
+                                       os.path.join(pyrPath, '%s_pyramid.h5'%ts_name),
+                                       rebuild=True)
+    except Exception:
+        logging.exception('Failed to build %s min/max pyramid'%ts_name)
+
+
+def _processUploaded(listing):
+    # Trigger processing of uploaded items (might be able to use process 
+    # method of collection item)
+    
+    logging.info('processing uploaded items')
+    for item in listing.items:
+        if item.state == 'UPLOADED':
+            item.process()
+    listing.refresh()
+    
+
+def _upload_dir_to_pnsv(ptID, tmpPath, listing, process=True):
+    #Upload folder with datasets if directory contains files, then delete it.
+    #Upload errors are raised after the folder is deleted
+    try:
+        if os.listdir(tmpPath):
             logging.info('Uploading %s data to Pennsieve at %s' % (ptID, tmpPath))
             
             try:
-                collection.upload(tmpPath, display_progress=True)
+                listing.collection.upload(tmpPath, display_progress=True)
             except TimeoutError:
                 logging.info('Upload Timeout error, trying again')
-                collection.upload(tmpPath)
+                listing.collection.upload(tmpPath)
+            listing.refresh()
             
-            # Trigger processing of data (might be able to use process 
-            # method of collection item)
-            logging.info('processing uploaded items')
-            for item in collection.items:
-                if item.state == 'UPLOADED':
-                    item.process()
-                
-        except:
-            logging.exception('')
-    else:
-        print('No new data to upload for %s'%ptID)
-                        
-    shutil.rmtree(tmpPath)
+            if process:
+                _processUploaded(listing)
+        else:
+            print('No new data to upload for %s'%ptID)
+            
+    except Exception:
+        logging.error('%s upload from %s failed'%(ptID, tmpPath))
+        raise
+    finally:
+        shutil.rmtree(tmpPath)
     
                 
             
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Stim Detection
+(RNS Processing Toolbox)
+
+Purpose: Find stimulation periods in AllData, ported from
+matlab_tools/ecog/findStim.m. Stimulation shows up as runs of zero slope
+(flat signal) on at least 3 channels. Data is processed in event-aligned
+chunks, in parallel threads, so AllData can be a memmap or DeviceData.
+
+Functions in this file:
+    findStim(AllData, eventStarts, Min, n_jobs)
+    findPatientStims(ptID, config, Min, n_jobs)
+
+Note: indices are 0-indexed, findStim.m's StimStartStopIndex - 1.
+
+"""
+
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functions import utils
+from functions import device_data
+
+# Constants
+NUM_CHANNELS = 4
+MID_RAIL = 512
+RAIL_LOW = 100 - MID_RAIL       # rails in findStim.m are on AllData + 512
+RAIL_HIGH = 900 - MID_RAIL
+STIM_MIN_RUN = 15
+STIM_MIN_CHANNELS = 3
+STIM_MERGE_GAP = 100
+STIM_CHUNK_SAMPLES = 2**20
+
+
+def findStim(AllData, eventStarts, Min=STIM_MIN_RUN, n_jobs=1):
+    '''
+    Find stimulation group periods in RNS data: runs of at least Min zero
+    slope samples, found on at least STIM_MIN_CHANNELS channels, merged when
+    less than STIM_MERGE_GAP samples apart within an event. Rail flatlines
+    shorter than Min samples and event starts break zero slope runs.
+
+    Args:
+        AllData (np.array, np.memmap or DeviceData): (n_samples, 4) or
+            (4, n_samples) data, as in Device_Data.mat
+        eventStarts (np.array): first AllData index of each event (0-indexed,
+            EventIdx[:,0])
+        Min (int, optional): minimum number of consecutive zero slope points
+            in a stimulation. Defaults to 15.
+        n_jobs (int, optional): threads processing chunks. Defaults to 1.
+
+    Returns:
+        StimStartStopIndex: (n_stims, 2) first and last index of each stim
+        stats (dict):
+            StimLengths: length of each stimulation group in samples
+            MaxStimLength, MinStimLength: longest and shortest length
+            MaxStimIndex, MinStimIndex: stims with the longest and shortest
+                length (None if no stims were found)
+
+    Example:
+        with device_data.openDeviceData(ptID, config) as dd:
+            [StimStartStopIndex, stats] = findStim(dd, dd.eventIdx[:,0], n_jobs=4)
+    '''
+
+    data = _asSamples(AllData)
+    n_samples = data.shape[0]
+    eventStarts = np.unique(np.asarray(eventStarts, dtype=np.int64))
+
+    bounds = _chunkBounds(eventStarts, n_samples)
+
+    def run(i):
+        [i_start, i_end] = bounds[i:i+2]
+        starts = eventStarts[(eventStarts >= i_start) & (eventStarts < i_end)]
+        return _chunkStims(data, i_start, i_end, starts, Min)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as ex:
+        SSI = list(ex.map(run, range(len(bounds) - 1)))
+
+    SSI = np.concatenate(SSI + [np.empty((0, 2), dtype=np.int64)])
+    StimStartStopIndex = _mergeStims(SSI, eventStarts)
+
+    logging.info('Found %d stims in %d samples'%(StimStartStopIndex.shape[0], n_samples))
+
+    return StimStartStopIndex, _stimStats(StimStartStopIndex)
+
+
+def findPatientStims(ptID, config, Min=STIM_MIN_RUN, n_jobs=1):
+    '''
+    Find stims in a patient's Device_Data.mat, see findStim.
+
+    Returns:
+        StimStartStopIndex, stats (see findStim)
+        StimStartStopTimes: (n_stims, 2) UTC posix usec of stim start and end
+    '''
+
+    with device_data.openDeviceData(ptID, config) as dd:
+        [StimStartStopIndex, stats] = findStim(dd, dd.eventIdx[:,0], Min, n_jobs)
+        StimStartStopTimes = dd.index.usec(StimStartStopIndex)
+
+    return StimStartStopIndex, stats, StimStartStopTimes
+
+
+#### Helper Functions #####
+
+def _chunkStims(data, i_start, i_end, eventStarts, Min):
+    # Stims (union over channels, before merging) starting in AllData
+    # samples i_start:i_end. i_start is an event start, and the first slope
+    # of the next chunk is reset by its event start, so runs end at i_end at
+    # the latest. Rail runs are measured with Min samples of context.
+
+    n_samples = data.shape[0]
+    j_end = min(i_end, n_samples - 1)
+    if j_end <= i_start:
+        return np.empty((0, 2), dtype=np.int64)
+
+    c_start = max(i_start - Min, 0)
+    x = _read(data, c_start, min(i_end + 1 + Min, n_samples)).T
+
+    rail = _shortRuns(x < RAIL_LOW, Min) | _shortRuns(x > RAIL_HIGH, Min)
+
+    # Zero slope between samples j and j+1, for j in i_start:j_end
+    seg = x[:, i_start-c_start:j_end-c_start+1]
+    zero = (seg[:, 1:] == seg[:, :-1]) & ~rail[:, i_start-c_start:j_end-c_start]
+    zero[:, eventStarts[eventStarts < j_end] - i_start] = False
+
+    [ch, run_start, run_end] = _runs(zero)
+
+    # Runs reaching the end of the data have no end
+    if i_end >= n_samples:
+        keep = run_end < zero.shape[1]
+        [ch, run_start, run_end] = [ch[keep], run_start[keep], run_end[keep]]
+
+    keep = run_end - run_start >= Min
+    [ch, run_start, run_end] = [ch[keep], run_start[keep] + i_start, run_end[keep] + i_start]
+
+    return _channelUnion(ch, run_start, run_end)
+
+
+def _channelUnion(ch, run_start, run_end):
+    # Periods where at least STIM_MIN_CHANNELS channels have a run, counted
+    # as in findStim.m: bounds sorted (stable) in channel order, starts then
+    # ends, start taken from the bound before the count reaches the minimum
+
+    vals = np.concatenate([np.concatenate((run_start[ch == c], run_end[ch == c]))
+                           for c in range(NUM_CHANNELS)])
+    signs = np.concatenate([np.repeat([1, -1], (ch == c).sum()) for c in range(NUM_CHANNELS)])
+
+    order = np.argsort(vals, kind='stable')
+    count = np.cumsum(signs[order])
+    vals = vals[order]
+
+    n = STIM_MIN_CHANNELS
+    below = np.nonzero(count[:-1] == n - 1)[0]
+    starts = vals[below[count[below + 1] == n]]
+    below = np.nonzero(count[1:] == n - 1)[0] + 1
+    ends = vals[below[count[below - 1] == n]]
+
+    return np.stack((starts, ends), axis=1).astype(np.int64)
+
+
+def _mergeStims(SSI, eventStarts):
+    # Merge stims less than STIM_MERGE_GAP apart, unless an event starts
+    # in the gap between them
+
+    if SSI.shape[0] < 2:
+        return SSI
+
+    gaps = np.stack((SSI[:-1, 1], SSI[1:, 0]), axis=1)
+    [incl, _, _] = utils.filterWindows(gaps, np.stack((eventStarts, eventStarts), axis=1))
+    i_gp = np.nonzero((gaps[:, 1] - gaps[:, 0] < STIM_MERGE_GAP) & ~incl)[0]
+
+    return np.stack((np.delete(SSI[:, 0], i_gp + 1), np.delete(SSI[:, 1], i_gp)), axis=1)
+
+
+def _stimStats(SSI):
+    # Stim length statistics, as in findStim.m
+
+    lengths = SSI[:, 1] - SSI[:, 0]
+    stats = {'StimLengths': lengths, 'MaxStimLength': None, 'MaxStimIndex': None,
+             'MinStimLength': None, 'MinStimIndex': None}
+
+    if len(lengths):
+        stats['MaxStimLength'] = lengths.max()
+        stats['MaxStimIndex'] = np.nonzero(lengths == lengths.max())[0]
+        stats['MinStimLength'] = lengths.min()
+        stats['MinStimIndex'] = np.nonzero(lengths == lengths.min())[0]
+
+    return stats
+
+
+def _runs(mask):
+    # Channel, start and end (exclusive) of runs of True in each row of a
+    # (n_channels, n) boolean mask, in channel then position order
+
+    d = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    [ch, run_start] = np.nonzero(d == 1)
+    run_end = np.nonzero(d == -1)[1]
+
+    return ch, run_start, run_end
+
+
+def _shortRuns(mask, maxRun):
+    # Mask of runs of True shorter than maxRun samples in each row
+
+    [ch, run_start, run_end] = _runs(mask)
+    short = run_end - run_start < maxRun
+
+    delta = np.zeros((mask.shape[0], mask.shape[1] + 1), dtype=np.int8)
+    delta[ch[short], run_start[short]] = 1
+    delta[ch[short], run_end[short]] = -1
+
+    return np.cumsum(delta, axis=1, dtype=np.int32)[:, :-1] > 0
+
+
+def _chunkBounds(eventStarts, n_samples):
+    # Chunk boundaries on event starts, at least STIM_CHUNK_SAMPLES apart
+
+    bounds = [0]
+    for i_start in eventStarts[(eventStarts > 0) & (eventStarts < n_samples)]:
+        if i_start - bounds[-1] >= STIM_CHUNK_SAMPLES:
+            bounds.append(int(i_start))
+    bounds.append(n_samples)
+
+    return bounds
+
+
+def _asSamples(AllData):
+    # (n_samples, NUM_CHANNELS) view of AllData, or DeviceData
+
+    if hasattr(AllData, 'samples'):
+        return AllData
+    if AllData.shape[0] == NUM_CHANNELS and AllData.shape[1] != NUM_CHANNELS:
+        return AllData.T
+    return AllData
+
+
+def _read(data, i_start, i_end):
+    # Samples of an array, memmap or DeviceData
+
+    if hasattr(data, 'samples'):
+        return data.samples(i_start, i_end)
+    return np.asarray(data[i_start:i_end])
@@ -6,38 +6,75 @@ Utilities
 Functions in this file: 
     str2dt_usec(s)
     posix2dt_UTC(psx)
+    str2usec(s)
+    usec2dt64(usec)
+    usec2str(usec)
     ptIdxLookup(config, ID_field, ID)
 
 """
-import datetime as DT
 import os.path as pth
 import pandas as pd
 import numpy as np
 
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+FILTER_CHUNK = 2**16
+
+
 def str2dt_usec(s):
-    EPOCH = DT.datetime(1970,1,1)
     
     # Either return list or single usec in posixtime
     if type(s) is list:
-        if isinstance(s[0], pd.Timestamp):
-            dt = [x.to_pydatetime() for x in s]
-        else:
-            dt = [DT.datetime.strptime(x,"%Y-%m-%d %H:%M:%S.%f") for x in s]
-        return [int((x - EPOCH).total_seconds() * 1000000) for x in dt]
-    else:
-        if isinstance(s, pd.Timestamp):
-            dt = s.to_pydatetime()
-        dt= DT.datetime.strptime(s,"%Y-%m-%d %H:%M:%S.%f")
-	
-    return int((dt - EPOCH).total_seconds() * 1000000)
+        return str2usec(s).tolist()
+    
+    return int(str2usec(s))
 
 
 def posix2dt_UTC(psx):
-    try:
-        utc= [DT.datetime.utcfromtimestamp(x*10**-6) for x in psx]
-    except:
-        utc = DT.datetime.utcfromtimestamp(psx*10**-6)
-    return utc
+    
+    # Either return list or single datetime
+    if np.ndim(psx) == 0:
+        return pd.Timestamp(usec2dt64(psx)).to_pydatetime()
+    
+    return list(pd.DatetimeIndex(usec2dt64(psx)).to_pydatetime())
+
+
+def str2usec(s):
+    '''
+    Vectorized conversion of timestamps to posix microseconds
+
+    Args:
+        s: timestamp string ("%Y-%m-%d %H:%M:%S.%f"), pd.Timestamp, or a 
+            list/Series/array of either
+
+    Returns:
+        int64 np.array of posix time in microseconds (np.int64 scalar if s
+        is a single timestamp)
+    '''
+    
+    if np.ndim(s) == 0:
+        return str2usec([s])[0]
+    
+    dt = pd.Series(s) if not isinstance(s, pd.Series) else s
+    if not pd.api.types.is_datetime64_any_dtype(dt):
+        dt = pd.to_datetime(dt, format=TIME_FORMAT)
+    
+    return dt.values.astype('datetime64[us]').astype(np.int64)
+
+
+def usec2dt64(usec):
+    ''' Vectorized conversion of posix microseconds to datetime64[us], 
+    non-integer input is rounded to the nearest microsecond '''
+    
+    return np.round(np.asarray(usec)).astype(np.int64).astype('datetime64[us]')
+
+
+def usec2str(usec, unit='ms'):
+    '''
+    Vectorized conversion of posix microseconds to "%Y-%m-%d %H:%M:%S.%f" 
+    strings, truncated to unit precision (milliseconds by default)
+    '''
+    
+    return np.char.replace(np.datetime_as_string(usec2dt64(usec), unit=unit), 'T', ' ')
  
 
 def ptIdxLookup(config, ID_field, ID):
@@ -70,6 +107,11 @@ def getDataPath(ptID, config, dataName):
            * Daily Histogram
            * Hourly Histogram
            * Episode Durations Folder
+           * Device Data
+           * Device Data Manifest
+           * Device Data Pyramid
+           * Month Pyramid Folder
+           * Pennsieve Label Cache
             
     Returns:
         string: path to NeuroPace data file or folder
@@ -81,7 +123,12 @@ def getDataPath(ptID, config, dataName):
         'ecog catalog':     pth.join(fld, 'ECoG_Catalog.csv'),
         'hourly histogram': pth.join(fld, ' Histograms', 'Histogram_Hourly.csv'),
         'daily histogram':  pth.join(fld, ' Histograms', 'Histogram_Daily.csv'),
-        'episode durations folder': pth.join(fld, ' EpisodeDurations')
+        'episode durations folder': pth.join(fld, ' EpisodeDurations'),
+        'device data':      pth.join(fld, 'Device_Data.mat'),
+        'device data manifest': pth.join(fld, 'Device_Data_manifest.csv'),
+        'device data pyramid': pth.join(fld, 'Device_Data_pyramid.h5'),
+        'month pyramid folder': pth.join(fld, 'Month_Pyramids'),
+        'pennsieve label cache': pth.join(fld, 'Pennsieve_Label_Cache.json')
             }
     
     return switcher.get(dataName.lower(), "File/Folder not found")    
@@ -95,6 +142,13 @@ def filterWindows(windowsetOutside, windowsetInside):
     # set1_exclusive_inds: indices of windows in windowsetOutside that have no
     # overlap with windowsetInside
     # set2_included_inds: indices of windowsetInside that are fully contained by 
+    # exactly one window of windowsetOutside
+    #
+    # Windows are sorted once and each query is answered with np.searchsorted,
+    # O((N+M) log(N+M)), in chunks of FILTER_CHUNK windows.
+    
+    windowsetOutside = np.asarray(windowsetOutside)
+    windowsetInside = np.asarray(windowsetInside)
     
     if np.ndim(windowsetInside) == 1:
         if len(windowsetInside) == 2:
@@ -102,20 +156,77 @@ def filterWindows(windowsetOutside, windowsetInside):
                 'Input a 2D numpy array if the input should be interpreted as a single window')
         windowsetInside = np.stack((windowsetInside, windowsetInside), axis=1)
     
-    # window start is between stim bounds
-    noStim_inds1 = np.array([np.sum((x >= windowsetInside[:, 0]) & (x <= windowsetInside[:, 1]))==0 for x in windowsetOutside[:, 0]])
+    windowsetOutside = windowsetOutside.reshape(-1, 2)
+    windowsetInside = windowsetInside.reshape(-1, 2)
     
-    # window end is between stim bounds
-    noStim_inds2 = np.array([np.sum((x >= windowsetInside[:, 0]) & (x <= windowsetInside[:, 1]))==0 for x in windowsetOutside[:, 1]])
+    # Inside windows sorted by start, with the smallest end among windows 
+    # starting at or after each position (suffix minimum)
+    in_order = np.argsort(windowsetInside[:, 0], kind='stable')
+    in_starts = windowsetInside[in_order, 0]
+    in_ends_min = np.minimum.accumulate(windowsetInside[in_order, 1][::-1])[::-1]
     
-    # window contains both stim bounds
-    noStim_inds3 = np.array([np.sum((windowsetOutside[i, 0] <= windowsetInside[:, 0]) & (windowsetOutside[i, 1] >= windowsetInside[:, 1]))==0 for i in range(windowsetOutside.shape[0])])
+    # Sorted bounds of valid inside windows, for counting windows containing a point
+    valid = windowsetInside[:, 0] <= windowsetInside[:, 1]
+    valid_starts = np.sort(windowsetInside[valid, 0])
+    valid_ends = np.sort(windowsetInside[valid, 1])
+    
+    # Outside windows sorted by start, with the largest and second largest end 
+    # among windows starting at or before each position (prefix maxima)
+    out_order = np.argsort(windowsetOutside[:, 0], kind='stable')
+    out_starts = windowsetOutside[out_order, 0]
+    out_ends = windowsetOutside[out_order, 1]
+    out_ends_max1 = np.maximum.accumulate(out_ends) if len(out_ends) else out_ends
+    prev_max = np.concatenate(([_minValue(out_ends.dtype)], out_ends_max1[:-1]))
+    out_ends_max2 = np.maximum.accumulate(np.minimum(out_ends, prev_max)) if len(out_ends) else out_ends
+    
+    n_out = windowsetOutside.shape[0]
+    n_in = windowsetInside.shape[0]
+    set1_exclusive_inds = np.zeros(n_out, dtype=bool)
+    set2_included_inds = np.zeros(n_in, dtype=bool)
+    
+    for i_beg in range(0, n_out, FILTER_CHUNK):
+        win = windowsetOutside[i_beg:i_beg+FILTER_CHUNK]
+        
+        # window start is between stim bounds
+        noStim_inds1 = _nContaining(valid_starts, valid_ends, win[:, 0]) == 0
+        
+        # window end is between stim bounds
+        noStim_inds2 = _nContaining(valid_starts, valid_ends, win[:, 1]) == 0
+        
+        # window contains both stim bounds
+        k = np.searchsorted(in_starts, win[:, 0], 'left')
+        noStim_inds3 = k == len(in_starts)
+        noStim_inds3[~noStim_inds3] = in_ends_min[k[~noStim_inds3]] > win[~noStim_inds3, 1]
+        
+        set1_exclusive_inds[i_beg:i_beg+FILTER_CHUNK] = (noStim_inds1 & noStim_inds2 & noStim_inds3)
     
-    set1_exclusive_inds = (noStim_inds1 & noStim_inds2 & noStim_inds3)
     set1_inclusive_inds = ~set1_exclusive_inds
     
-    set2_included_inds = np.array([np.sum((windowsetInside[i, 0] >= windowsetOutside[:, 0]) & (windowsetInside[i, 1] <= windowsetOutside[:, 1]))==1 for i in range(windowsetInside.shape[0])])
+    for i_beg in range(0, n_in, FILTER_CHUNK):
+        win = windowsetInside[i_beg:i_beg+FILTER_CHUNK]
+        
+        # Exactly one of the outside windows starting at or before the window 
+        # start ends at or after the window end
+        k = np.searchsorted(out_starts, win[:, 0], 'right') - 1
+        has = k >= 0
+        set2_included_inds[i_beg:i_beg+FILTER_CHUNK][has] = (
+            (out_ends_max1[k[has]] >= win[has, 1]) & (out_ends_max2[k[has]] < win[has, 1]))
     
     return set1_inclusive_inds, set1_exclusive_inds, set2_included_inds
 
 
+#### Helper Functions #####
+
+def _nContaining(starts, ends, x):
+    # Number of windows [starts, ends] containing each point of x, from the
+    # sorted starts and ends of windows with start <= end
+    
+    return np.searchsorted(starts, x, 'right') - np.searchsorted(ends, x, 'left')
+
+
+def _minValue(dtype):
+    # Smallest value of dtype, used as the max of an empty set of windows
+    
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).min
+    return -np.inf
@@ -4,54 +4,243 @@
 Visualization
 (RNS Processing Toolbox)
 
-Functions in this file: 
+Functions in this file:
     vis_event(AllData, AllTime, Ecog_Events, datapoints)
-    
+    vis_span(AllData, AllTime, i_start, i_end)
+    renderEvents(ptID, config, events, out_folder)
+    decimateMinMax(data, width)
+
 """
+import os
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from functions import utils
+from functions import device_data
+from functions import event_index
+from functions.event_index import EventIndex
+
+# Constants
+NUM_CHANNELS = 4
+CH_SPACING = 100
+
 
-def vis_event(AllData, AllTime, Ecog_Events, datapoints):
+def vis_event(AllData, AllTime, Ecog_Events, datapoints, width=None):
     '''
     Args:
-        AllData (npArray): patient's AllData array
-        AllTime (npArray): patient's AllTime array
+        AllData (npArray or DeviceData): patient's AllData array, (4, n) or
+            (n, 4), or an open DeviceData
+        AllTime (npArray or EventIndex): patient's AllTime array, or their
+            EventIndex (no dense time vector needed)
         Ecog_Events (table): patient's Ecog_Events table
-        datapoints (list): vector of AllTime indices to plot
+        datapoints (list): vector of AllData indices to plot
+        width (int, optional): number of min/max pairs to decimate each event
+            to. Defaults to None, the figure width in pixels.
 
     Returns:
-        ax (plot.axis): subplot including one plot of the EcoG event containing 
-        each datapoint, respectively. 
-    '''
-    
-    try:
-        dlen = len(datapoints)
-    except TypeError:
-        dlen = 1
-    
-    # If datapoints are indices
-    start= Ecog_Events['Event Start idx']
-    end= Ecog_Events['Event End idx']
-    
-    ievent = [np.argmax(np.where((start-datapoints[i])<0)) for i in range(0,dlen)]
-    
+        ax (plot.axis): subplot including one plot of the EcoG event containing
+        each datapoint, respectively.
+    '''
+
+    datapoints = np.atleast_1d(np.asarray(datapoints, dtype=np.int64))
+    dlen = len(datapoints)
+
+    index = _eventIndex(AllTime, Ecog_Events)
+    ievent = index.event(datapoints)
+
     fig, ax= plt.subplots(dlen, 1, squeeze=False)
-    fig.subplots_adjust(hspace= 0.5)    
-    
+    fig.subplots_adjust(hspace= 0.5)
+    width = width or _pixelWidth(fig)
+
     for i in range(0,dlen):
         idx= ievent[i]
-        dt= utils.posix2dt_UTC(AllTime[start[idx]:end[idx]+1])
-        dat = AllData[:,start[idx]:end[idx]+1].T+np.arange(4)*100
-        
-        ymax = max([i for lis in dat for i in lis])
-        ymin = min([i for lis in dat for i in lis])
-        
-        ax[i][0].plot(dt, dat)
-        ax[i][0].vlines(utils.posix2dt_UTC(AllTime[datapoints[i]]),ymin, ymax)
+        if idx < 0:
+            ax[i][0].set_title('Index %d is not in an event'%datapoints[i])
+            continue
+
+        [i_start, i_end] = index.bounds(idx)
+        _plotSamples(ax[i][0], AllData, AllTime, i_start, i_end, width,
+                     datapoints[i:i+1])
         plt.sca(ax[i][0])
         plt.xticks(rotation=20)
-        plt.title("%s Event"%(Ecog_Events['ECoG trigger'][idx]))
-    
+        plt.title("%s Event"%(Ecog_Events['ECoG trigger'].values[idx]))
+
     return ax
-    
\ No newline at end of file
+
+
+def vis_span(AllData, AllTime, i_start, i_end, ax=None, width=None):
+    '''
+    Plot AllData[i_start:i_end], which may span many events, decimated to
+    min/max pairs per pixel column.
+
+    Args:
+        AllData (npArray or DeviceData): see vis_event
+        AllTime (npArray or EventIndex): see vis_event
+        i_start (int): first AllData index
+        i_end (int): last AllData index + 1
+        ax (plot.axis, optional): axis to plot in. Defaults to None, new figure.
+        width (int, optional): number of min/max pairs. Defaults to None, the
+            figure width in pixels.
+
+    Returns:
+        ax (plot.axis)
+    '''
+
+    if ax is None:
+        fig, ax = plt.subplots(1, 1)
+
+    _plotSamples(ax, AllData, AllTime, i_start, i_end, width or _pixelWidth(ax.figure))
+    ax.tick_params(axis='x', labelrotation=20)
+
+    return ax
+
+
+def renderEvents(ptID, config, events, out_folder, n_jobs=4, fmt='png',
+                 figsize=(12, 4), dpi=100):
+    '''
+    Render events from a patient's Device_Data.mat to image files, in
+    parallel worker processes. Files are named <ptID>_event<i>.<fmt>.
+
+    Args:
+        ptID (str): patient ID
+        config (dict): config.json dictionary
+        events (list): event numbers (rows of the ECoG catalog, 0-indexed)
+        out_folder (str): output folder, created if it does not exist
+        n_jobs (int, optional): worker processes. Defaults to 4.
+        fmt (str, optional): image format. Defaults to 'png'.
+        figsize (tuple, optional): figure size in inches. Defaults to (12, 4).
+        dpi (int, optional): figure resolution. Defaults to 100.
+
+    Returns:
+        files ([str]): image file paths, in the order of events
+
+    Example:
+        files = renderEvents('HUP1234', config, range(100), 'review_packet', n_jobs=8)
+    '''
+
+    os.makedirs(out_folder, exist_ok=True)
+    events = [int(i) for i in events]
+    n_jobs = max(1, min(n_jobs, len(events)))
+
+    batches = [events[i::n_jobs] for i in range(n_jobs)]
+    args = (ptID, config, out_folder, fmt, figsize, dpi)
+
+    if n_jobs == 1:
+        files = [_renderEventBatch(batches[0], *args)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as ex:
+            files = list(ex.map(_renderEventBatch, batches, *[[a]*n_jobs for a in args]))
+
+    paths = {i: f for batch, batch_files in zip(batches, files) for i, f in zip(batch, batch_files)}
+    return [paths[i] for i in events]
+
+
+def decimateMinMax(data, width):
+    '''
+    Min/max decimation of data into width buckets per channel. Each bucket
+    keeps its minimum and maximum sample in time order, so a line plot of the
+    result matches the full data at width pixels.
+
+    Args:
+        data (np.array): (n, n_channels) samples
+        width (int): number of buckets
+
+    Returns:
+        pos: (m, n_channels) positions of the kept samples in data
+        values: (m, n_channels) kept samples, m <= 2*width
+    '''
+
+    [n, n_chs] = data.shape
+
+    if n <= 2*width:
+        pos = np.repeat(np.arange(n)[:, None], n_chs, axis=1)
+        return pos, data
+
+    b = -(-n // width)
+    n_full = n // b * b
+
+    blocks = [(0, data[:n_full].reshape(-1, b, n_chs))]
+    if n_full < n:
+        blocks.append((n_full, data[n_full:][None]))
+
+    pos = []
+    for offset, block in blocks:
+        i_min = block.argmin(axis=1)
+        i_max = block.argmax(axis=1)
+        base = offset + np.arange(block.shape[0])[:, None]*block.shape[1]
+        pos.append(np.stack((base + np.minimum(i_min, i_max),
+                             base + np.maximum(i_min, i_max)), axis=1).reshape(-1, n_chs))
+
+    pos = np.concatenate(pos)
+    return pos, np.take_along_axis(data, pos, axis=0)
+
+
+#### Helper Functions #####
+
+def _plotSamples(ax, AllData, AllTime, i_start, i_end, width, datapoints=()):
+    # Plot AllData[i_start:i_end] against time, decimated to width, with
+    # vertical lines at datapoints
+
+    [pos, dat] = decimateMinMax(_samples(AllData, i_start, i_end), width)
+    pos = pos + i_start
+    dat = dat + np.arange(NUM_CHANNELS)*CH_SPACING
+
+    ax.plot(_times(AllTime, pos), dat)
+
+    if len(datapoints):
+        ax.vlines(_times(AllTime, datapoints), dat.min(), dat.max())
+
+
+def _samples(AllData, i_start, i_end):
+    # (n, NUM_CHANNELS) samples of AllData array or DeviceData
+
+    if hasattr(AllData, 'samples'):
+        return AllData.samples(i_start, i_end)
+    if AllData.shape[0] == NUM_CHANNELS and AllData.shape[1] != NUM_CHANNELS:
+        return AllData[:, i_start:i_end].T
+    return AllData[i_start:i_end]
+
+
+def _times(AllTime, pos):
+    # datetime64 times of AllData positions, from AllTime or EventIndex
+
+    if isinstance(AllTime, EventIndex):
+        return utils.usec2dt64(AllTime.usec(pos))
+    return utils.usec2dt64(np.asarray(AllTime)[pos])
+
+
+def _eventIndex(AllTime, Ecog_Events):
+    # EventIndex given as AllTime, or built from the catalog
+
+    if isinstance(AllTime, EventIndex):
+        return AllTime
+    return event_index.fromCatalog(Ecog_Events)
+
+
+def _pixelWidth(fig):
+    # Figure width in pixels
+
+    return int(fig.get_figwidth()*fig.dpi)
+
+
+def _renderEventBatch(events, ptID, config, out_folder, fmt, figsize, dpi):
+    # Render events to files in a worker process, without pyplot state
+
+    files = []
+    with device_data.openDeviceData(ptID, config) as dd:
+        index = dd.index
+        triggers = dd.catalog['ECoG trigger'].values
+
+        for i_event in events:
+            fig = Figure(figsize=figsize, dpi=dpi)
+            ax = fig.subplots()
+            [i_start, i_end] = index.bounds(i_event)
+            _plotSamples(ax, dd, index, i_start, i_end, _pixelWidth(fig))
+            ax.tick_params(axis='x', labelrotation=20)
+            ax.set_title('%s Event %d: %s'%(ptID, i_event, triggers[i_event]))
+
+            files.append(os.path.join(out_folder, '%s_event%d.%s'%(ptID, i_event, fmt)))
+            fig.savefig(files[-1], bbox_inches='tight')
+
+    return files
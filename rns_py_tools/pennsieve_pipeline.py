@@ -6,41 +6,25 @@ import sys
 import logging
 import traceback
 import glob
-import time
-import numpy as np
 import scipy.io as sio
 import multiprocessing as mp
 from pennsieve import Pennsieve
 from functions import pennsieve_tools
 
 
-def uploadPatientCatalogAnnots(ptList, config):
-    ''' Load annotations from ECoG Catalog for all patient indices in ptID_list '''
+def uploadPatientCatalogAnnots(ptList, config, deadline=pennsieve_tools.POLL_DEADLINE):
+    ''' Load annotations from ECoG Catalog for all patient indices in ptID_list.
+    Each month is annotated as soon as Pennsieve finishes processing it, for 
+    up to deadline seconds '''
     
     pnsv = Pennsieve()
     
-    ptProcessed = np.array([False]*len(ptList))
-    ptList = np.array(ptList)
-
     # Processing may take a while
-    for i_iter in range(0,10):
-        
-        for i_pt in np.where(~ptProcessed)[0]:
-            ptID = ptList[i_pt]
-            try:
-                annotComplete = pennsieve_tools.annotate_UTC_from_catalog(ptID, config, pnsv)
-                ptProcessed[i_pt] = annotComplete
-            except:
-                logging.error('ERROR: %s catalog annotation failed'%ptID)
-                logging.error(traceback.format_exc())
-                pass
-        
-        if all(ptProcessed):
-            return
-        print('Still processing, trying for %d more minutes' % (10-i_iter))
-        time.sleep(60)
+    ptDone = pennsieve_tools.poll_catalog_annotations(ptList, config, pnsv, deadline)
     
-    print('function timed out, %s are not completed' % ptList[~ptProcessed])
+    notDone = [ptID for ptID in ptList if not ptDone[ptID]]
+    if notDone:
+        print('function timed out, %s are not completed' % notDone)
     
         
 
@@ -14,31 +14,99 @@ Created on Wed Sep 16 16:43:22 2020
 import json
 import os
 import sys
+import numpy as np
 import pandas as pd
 import hdf5storage
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from functions import NPDataHandler as npdh
+from functions import utils
+from functions import device_data
+from functions import minmax_pyramid
 import logging
 
 def downloadPatientDataFromBox(ptList, config):
     
-    from boxsdk import Client, OAuth2
-    
-    auth = OAuth2(
-        client_id= config['boxKeys']['CLIENT_ID'],
-        client_secret= config['boxKeys']['CLIENT_SECRET'],
-        access_token= config['boxKeys']['CLIENT_ACCESS_TOKEN']
-    )
-
-    client = Client(auth)
+    client = _boxClient(config)
     
     for ptID in ptList:
         npdh.NPdownloadNewBoxData(ptID, config, client)
     
     return
+
+
+def streamPatientData(ptList, config, client=None, n_workers=2, n_jobs=1):
+    '''
+    Download, deidentify and aggregate patients' data as a pipeline. Each 
+    patient is queued for deidentification and appending to Device_Data 
+    (loadDeviceDataFromFiles with append=True) as soon as their Box download
+    finishes, so downloading later patients overlaps with decoding earlier 
+    ones. Does not prompt for input.
+    
+    Args:
+        ptList ([str]): patient IDs
+        config (dict): config.json dictionary
+        client (boxsdk Client, optional): Box client. Defaults to None, in 
+            which case a client is created from config['boxKeys'] if it has
+            an access token, otherwise local raw data is processed without 
+            downloading.
+        n_workers (int, optional): patients decoded concurrently. Defaults to 2.
+        n_jobs (int, optional): worker processes used to decode each
+            patient's .dat files. Defaults to 1.
+            
+    Returns:
+        errlist ([str]): patients that failed to download or aggregate
+    '''
+    
+    if client is None and config.get('boxKeys', {}).get('CLIENT_ACCESS_TOKEN'):
+        client = _boxClient(config)
+    
+    errlist = []
+    futures = {}
+    
+    with ProcessPoolExecutor(max_workers=max(1, n_workers)) as ex:
+        
+        for ptID in ptList:
+            
+            if client is not None:
+                try:
+                    npdh.NPdownloadNewBoxData(ptID, config, client)
+                except:
+                    logging.error('ERROR: %s Box download failed'%ptID)
+                    logging.error(traceback.format_exc())
+                    errlist.append(ptID)
+                    continue
+            
+            logging.info('Queueing %s for aggregation'%ptID)
+            futures[ptID] = ex.submit(_deidentifyAndLoad, ptID, config, n_jobs)
+        
+        for ptID, fut in futures.items():
+            try:
+                errlist += fut.result()
+            except:
+                logging.error('ERROR: %s aggregation failed'%ptID)
+                logging.error(traceback.format_exc())
+                errlist.append(ptID)
+    
+    if errlist:
+        logging.warning('ERROR SUMMARY: pipeline failed for %s'%errlist)
+        
+    return errlist
     
 
-def loadDeviceDataFromFiles(ptList, config):
+def loadDeviceDataFromFiles(ptList, config, n_jobs=1, append=False):
+    '''
+    Aggregate each patient's .dat files into Device_Data.mat, and save the 
+    deidentified ECoG_Catalog.csv with event indices into AllData.
+    
+    Args:
+        ptList ([str]): patient IDs
+        config (dict): config.json dictionary
+        n_jobs (int, optional): worker processes used to decode .dat files
+        append (bool, optional): only decode .dat files that are not yet in
+            Device_Data.mat (see appendDeviceDataFromFiles). Falls back to a
+            full rebuild if the existing data can't be extended.
+    '''
 
     errlist= [];
     
@@ -47,11 +115,14 @@ def loadDeviceDataFromFiles(ptList, config):
        try:
 
            logging.info('loading data for patient %s ...'%ptID)
-          
-           savepath = os.path.join(config['paths']['RNS_DATA_Folder'], ptID);
+           
+           if append and appendDeviceDataFromFiles(ptID, config, n_jobs):
+               _updatePyramid(ptID, config)
+               print('complete')
+               continue
            
            # Get converted Data and Time vectors 
-           [AllData, eventIdx, dneIdx] = npdh.NPdat2mat(ptID, config)
+           [AllData, eventIdx, dneIdx] = npdh.NPdat2mat(ptID, config, n_jobs=n_jobs)
         
            #Update (and deidentify) ECoG Catalog:
            catalog_csv= npdh.NPgetDataPath(ptID, config, 'ECoG Catalog')
@@ -63,30 +134,186 @@ def loadDeviceDataFromFiles(ptList, config):
                Ecog_Events.reset_index(drop=True, inplace=True)
                logging.info('Removing %d entries from deidentified ECoG_Catalog.csv due to missing data'%(len(dneIdx)))
     
-           Ecog_Events = Ecog_Events.drop(columns=['Initials', 'Device ID'])
-           Ecog_Events['Patient ID']= ptID
+           _saveEcogEvents(ptID, config, Ecog_Events, eventIdx)
            
-           # Add event index to ecog_events file, add +1 for matlab 1-indexing
-           Ecog_Events['Event Start idx'] = [row[0]+1 for row in eventIdx]; 
-           Ecog_Events['Event End idx'] = [row[1]+1 for row in eventIdx];
+           _saveDeviceData(ptID, config, AllData, eventIdx)
            
-                  # Save updated csv and all events
-           Ecog_Events.to_csv(os.path.join(savepath,'ECoG_Catalog.csv'), index=False)
+           # Record aggregated files so later runs can append new files only
+           manifest = npdh._datManifest(npdh.NPgetDataPath(ptID, config, 'Dat Folder'), 
+                                        Ecog_Events['Filename'], eventIdx)
+           manifest.to_csv(utils.getDataPath(ptID, config, 'device data manifest'), index=False)
            
-           hdf5storage.savemat(os.path.join(savepath, 'Device_Data.mat'), {"AllData": AllData, "EventIdx":eventIdx}, 
-                               format ='7.3', oned_as='column', store_python_metadata=True)
+           _updatePyramid(ptID, config, rebuild=True)
         
            print('complete')
        
        except:
-           logging.error('ERROR: %s catalog annotation failed'%ptID)
+           logging.error('ERROR: %s load data failed'%ptID)
            logging.error(traceback.format_exc())
            errlist.append(ptID)
            pass
        
-       if errlist:
-            logging.warning('ERROR SUMMARY: load data failed for %s'%errlist)
+    if errlist:
+        logging.warning('ERROR SUMMARY: load data failed for %s'%errlist)
+            
+    return errlist
        
+
+def appendDeviceDataFromFiles(ptID, config, n_jobs=1):
+    '''
+    Incrementally update a patient's Device_Data.mat. Only catalog rows whose
+    .dat files are not in the Device_Data manifest are decoded, and are 
+    appended in place to the AllData and EventIdx datasets. The deidentified ECoG_Catalog.csv is 
+    rewritten with Event Start/End idx columns taken from the manifest. 
+
+    Args:
+        ptID (str): patient ID
+        config (dict): config.json dictionary
+        n_jobs (int, optional): worker processes used to decode .dat files
+
+    Returns:
+        True if Device_Data is up to date, False if it needs a full rebuild 
+        (no manifest, Device_Data doesn't match the manifest, aggregated files 
+        changed on disk, or new files are not at the end of the ecog catalog)
+    '''
+    
+    dataFolder = npdh.NPgetDataPath(ptID, config, 'Dat Folder')
+    manifest_pth = utils.getDataPath(ptID, config, 'device data manifest')
+    
+    if not (os.path.exists(manifest_pth) and 
+            os.path.exists(utils.getDataPath(ptID, config, 'device data'))):
+        logging.info('No Device_Data manifest for %s, rebuilding'%ptID)
+        return False
+    
+    manifest = pd.read_csv(manifest_pth)
+    
+    if not npdh._checkManifest(dataFolder, manifest):
+        logging.warning('Aggregated .dat files changed for %s, rebuilding'%ptID)
+        return False
+    
+    # Device_Data extended without updating the manifest (interrupted append)
+    with device_data.DeviceData(utils.getDataPath(ptID, config, 'device data')) as dd:
+        n_samples = dd.shape[0]
+        n_events = dd.eventIdx.shape[0]
+    if (n_events != manifest.shape[0] or 
+        n_samples != np.max(manifest['End idx'].values, initial=-1) + 1):
+        logging.warning('Device_Data does not match its manifest for %s, rebuilding'%ptID)
+        return False
+    
+    catalog_csv= npdh.NPgetDataPath(ptID, config, 'ECoG Catalog')
+    Ecog_Events = pd.read_csv(catalog_csv);
+    
+    fname_pos = {f: i for i, f in enumerate(Ecog_Events['Filename'])}
+    if not all(f in fname_pos for f in manifest['Filename']):
+        logging.warning('Aggregated .dat files missing from %s catalog, rebuilding'%ptID)
+        return False
+    
+    # Rows before the last aggregated row may only be skipped if still missing
+    last_pos = max([fname_pos[f] for f in manifest['Filename']], default=-1)
+    aggregated = set(manifest['Filename'])
+    skipped = [f for f in Ecog_Events['Filename'][:last_pos+1] if f not in aggregated]
+    if any(os.path.exists(os.path.join(dataFolder, f)) for f in skipped):
+        logging.warning('Out of order .dat files found for %s, rebuilding'%ptID)
+        return False
+    
+    new_inds = list(range(last_pos+1, Ecog_Events.shape[0]))
+    
+    if not new_inds:
+        logging.info('Device_Data for %s is up to date'%ptID)
+        return True
+    
+    # Decode new files only
+    [NewData, newIdx, dneIdx] = npdh.NPdat2mat(ptID, config, n_jobs=n_jobs, 
+                                               catalog_inds=new_inds)
+    new_inds = [i for i in new_inds if i not in dneIdx]
+    
+    logging.info('Appending %d new events to %s Device_Data'%(len(new_inds), ptID))
+    
+    if new_inds:
+        mat_pth = utils.getDataPath(ptID, config, 'device data')
+        
+        if device_data.isAppendable(mat_pth):
+            newIdx = device_data.appendDeviceData(mat_pth, NewData, newIdx)
+        else:
+            # Device_Data written by older versions can't be resized in place
+            [AllData, eventIdx] = _loadDeviceData(ptID, config)
+            newIdx = newIdx + AllData.shape[0]
+            
+            _saveDeviceData(ptID, config, np.concatenate((AllData, NewData)), 
+                            np.concatenate((eventIdx, newIdx)).astype('int32'))
+        
+        manifest = pd.concat((manifest, npdh._datManifest(
+            dataFolder, Ecog_Events['Filename'].iloc[new_inds], newIdx)), ignore_index=True)
+    
+    Ecog_Events = Ecog_Events.iloc[[fname_pos[f] for f in manifest['Filename']]]
+    Ecog_Events = Ecog_Events.reset_index(drop=True)
+    _saveEcogEvents(ptID, config, Ecog_Events, manifest[['Start idx', 'End idx']].values)
+    
+    manifest.to_csv(manifest_pth, index=False)
+    
+    return True
+
+
+def _deidentifyAndLoad(ptID, config, n_jobs=1):
+    # Deidentify and aggregate a single patient, returns [ptID] on failure
+    
+    logging.info('Creating deidentified files for %s'%ptID)
+    npdh.NPdeidentifier(ptID, config)
+    
+    return loadDeviceDataFromFiles([ptID], config, n_jobs=n_jobs, append=True)
+
+
+def _boxClient(config):
+    # Box client authenticated with config['boxKeys']
+    
+    from boxsdk import Client, OAuth2
+    
+    auth = OAuth2(
+        client_id= config['boxKeys']['CLIENT_ID'],
+        client_secret= config['boxKeys']['CLIENT_SECRET'],
+        access_token= config['boxKeys']['CLIENT_ACCESS_TOKEN']
+    )
+
+    return Client(auth)
+
+
+def _saveEcogEvents(ptID, config, Ecog_Events, eventIdx):
+    # Deidentify ECoG catalog and save with event indices into AllData
+    
+    Ecog_Events = Ecog_Events.drop(columns=['Initials', 'Device ID'])
+    Ecog_Events['Patient ID']= ptID
+    
+    # Add event index to ecog_events file, add +1 for matlab 1-indexing
+    Ecog_Events['Event Start idx'] = [row[0]+1 for row in eventIdx]; 
+    Ecog_Events['Event End idx'] = [row[1]+1 for row in eventIdx];
+    
+    # Save updated csv
+    Ecog_Events.to_csv(utils.getDataPath(ptID, config, 'ecog catalog'), index=False)
+    
+    
+def _saveDeviceData(ptID, config, AllData, eventIdx):
+    
+    device_data.writeDeviceData(utils.getDataPath(ptID, config, 'device data'), 
+                                AllData, eventIdx)
+
+
+def _updatePyramid(ptID, config, rebuild=False):
+    # Update the Device_Data min/max pyramid. Failures are logged but don't 
+    # fail the load, the pyramid is rebuilt on the next full load
+    
+    try:
+        minmax_pyramid.updateDeviceDataPyramid(ptID, config, rebuild)
+    except Exception:
+        logging.warning('%s min/max pyramid update failed, continuing without it'%ptID)
+        logging.warning(traceback.format_exc())
+
+
+def _loadDeviceData(ptID, config):
+    
+    mat = hdf5storage.loadmat(utils.getDataPath(ptID, config, 'device data'), 
+                              variable_names=['AllData', 'EventIdx'])
+    
+    return mat['AllData'], mat['EventIdx']
     
        
 def createDeidentifiedFiles(ptList, config):
@@ -102,7 +329,12 @@ if __name__ == "__main__":
     with open('../config_test.JSON') as f:
         config= json.load(f)
         
-    ptList = [pt['ID'] for pt in config['patients']]
+    # Run "python process_raw.py --stream [ptIDs]" to download and aggregate
+    # without prompts
+    stream = '--stream' in sys.argv
+    ptList = [a for a in sys.argv[1:] if a != '--stream']
+    if not ptList:
+        ptList = [pt['ID'] for pt in config['patients']]
     
     # Set up logging
     logfile = os.path.join(config['paths']['RNS_RAW_Folder'],'logfile.log');
@@ -122,6 +354,10 @@ if __name__ == "__main__":
     
     if not os.path.exists(config['paths']['RNS_DATA_Folder']):
         os.makedirs(config['paths']['RNS_DATA_Folder'])
+        
+    if stream:
+        errlist = streamPatientData(ptList, config)
+        sys.exit(1 if errlist else 0)
     
     # Download latest data from Box
     if config['boxKeys']['CLIENT_ACCESS_TOKEN']:
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+% run_pipeline script
+% ------------------------------------------------------
+% Non-interactive runner for the process_raw and pennsieve_pipeline stages.
+% Patients run in parallel worker processes, each logging to its own file.
+% ------------------------------------------------------
+
+Stages (run in this order for each patient):
+    download:        download new data from Box
+    deidentify:      create deidentified copies of NeuroPace files
+    aggregate:       aggregate .dat files into Device_Data.mat
+    upload:          upload new monthly .dat files to Pennsieve
+    annotate:        upload ECoG catalog annotations to Pennsieve
+    annotate_files:  upload annotations from patient's Annotations folder
+
+Example:
+    python run_pipeline.py --config ../config.JSON --stages deidentify aggregate \
+        --patients HUP123 HUP124 --jobs 4
+
+Exits with status 1 if any patient fails.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# Constants
+STAGES = ['download', 'deidentify', 'aggregate', 'upload', 'annotate', 'annotate_files']
+LOG_FORMAT = '%(asctime)s %(funcName)s: %(message)s'
+
+
+def runPatient(ptID, config, stages, log_dir=None, append=False):
+    '''
+    Run pipeline stages for a single patient, logging to log_dir/<ptID>.log.
+    Stops at the first failed stage.
+
+    Args:
+        ptID (str): patient ID
+        config (dict): config.json dictionary
+        stages ([str]): stages to run, see STAGES
+        log_dir (str, optional): folder for patient log files. Defaults to
+            None, logs/ in RNS_RAW_Folder.
+        append (bool, optional): only aggregate new .dat files. Defaults to False.
+
+    Returns:
+        failed_stage (str): first stage that failed, None if all succeeded
+    '''
+
+    if log_dir is None:
+        log_dir = os.path.join(config['paths']['RNS_RAW_Folder'], 'logs')
+    _setupLogging(os.path.join(log_dir, '%s.log'%ptID))
+
+    logging.info('Running stages %s for %s'%(stages, ptID))
+
+    for stage in [s for s in STAGES if s in stages]:
+        try:
+            if not _runStage(stage, ptID, config, append):
+                raise RuntimeError('%s stage reported a failure'%stage)
+        except Exception:
+            logging.error('ERROR: %s %s failed'%(ptID, stage))
+            logging.error(traceback.format_exc())
+            return stage
+
+    logging.info('%s complete'%ptID)
+    return None
+
+
+def main(argv=None):
+    '''
+    Parse command line arguments and run the pipeline. Returns exit status,
+    0 if all patients succeeded, 1 otherwise.
+    '''
+
+    parser = argparse.ArgumentParser(description='Run RNS processing pipeline stages')
+    parser.add_argument('--config', default='../config.JSON', help='path to config.JSON')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES[:3],
+                        help='stages to run (default: download deidentify aggregate)')
+    parser.add_argument('--patients', nargs='+', default=None,
+                        help='patient IDs (default: all patients in config)')
+    parser.add_argument('--jobs', type=int, default=1, help='patients run in parallel')
+    parser.add_argument('--append', action='store_true',
+                        help='only aggregate .dat files not yet in Device_Data.mat')
+    parser.add_argument('--log-dir', default=None,
+                        help='folder for per-patient logs (default: RNS_RAW_Folder/logs)')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    ptList = args.patients or [pt['ID'] for pt in config['patients']]
+
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    logging.info('Running stages %s for %s with %d jobs'%(args.stages, ptList, args.jobs))
+
+    if not os.path.exists(config['paths']['RNS_DATA_Folder']):
+        os.makedirs(config['paths']['RNS_DATA_Folder'])
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as ex:
+        futures = {ptID: ex.submit(runPatient, ptID, config, args.stages,
+                                   args.log_dir, args.append) for ptID in ptList}
+        for ptID, fut in futures.items():
+            try:
+                results[ptID] = fut.result()
+            except Exception:
+                logging.error(traceback.format_exc())
+                results[ptID] = 'worker'
+
+    failed = {ptID: stage for ptID, stage in results.items() if stage}
+    for ptID, stage in results.items():
+        print('%s: %s'%(ptID, 'failed at %s'%stage if stage else 'complete'))
+
+    if failed:
+        logging.warning('ERROR SUMMARY: failed patients %s'%failed)
+        return 1
+    return 0
+
+
+#### Helper Functions #####
+
+def _runStage(stage, ptID, config, append=False):
+    # Run one stage for ptID, returns False if the stage reported a failure
+
+    import process_raw
+    from functions import NPDataHandler as npdh
+
+    if stage == 'download':
+        npdh.NPdownloadNewBoxData(ptID, config, process_raw._boxClient(config))
+
+    elif stage == 'deidentify':
+        npdh.NPdeidentifier(ptID, config)
+
+    elif stage == 'aggregate':
+        return not process_raw.loadDeviceDataFromFiles([ptID], config, append=append)
+
+    else:
+        from pennsieve import Pennsieve
+        from functions import pennsieve_tools
+        import pennsieve_pipeline
+
+        if stage == 'upload':
+            return not pennsieve_tools.uploadNewDatByMonth(ptID, config, Pennsieve())
+        elif stage == 'annotate':
+            return pennsieve_tools.poll_catalog_annotations([ptID], config, Pennsieve())[ptID]
+        elif stage == 'annotate_files':
+            pennsieve_pipeline.uploadPatientAnnots([ptID], config)
+
+    return True
+
+
+def _setupLogging(logfile):
+    # Send this process's logging to logfile only
+
+    os.makedirs(os.path.dirname(logfile), exist_ok=True)
+
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+
+    handler = logging.FileHandler(logfile)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.root.addHandler(handler)
+    logging.root.setLevel(logging.INFO)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,10 +19,26 @@ import pandas as pd
 import os
 from functions import utils
 from functions import NPDataHandler as npdh
+import process_raw
+import run_pipeline
+import json
 from process_raw import loadDeviceDataFromFiles
+import hdf5storage
 from functions import pennsieve_tools
+from functions import device_data
+from functions import ecog_catalog
+from functions import box_sync
+from functions import event_index
+from functions import visualize
+from functions import minmax_pyramid
+from functions import stim_detection
+import hashlib
+import h5py
 import logging
 import sys
+import threading
+import time
+import requests
 from pennsieve import Pennsieve
 
 
@@ -175,9 +191,58 @@ def test_filterWindows():
     assert(np.all(set3 == [1,0]))
 
 
-    
+@pytest.mark.parametrize('chunk', [utils.FILTER_CHUNK, 3])
+def test_filterWindows_random(monkeypatch, chunk):
+    # Compare against a brute force count over all window pairs, including
+    # reversed windows, duplicates and point inputs
+
+    monkeypatch.setattr(utils, 'FILTER_CHUNK', chunk)
+    rng = np.random.default_rng(0)
+
+    for _ in range(200):
+        outside = rng.integers(0, 40, (rng.integers(0, 15), 2))
+        inside = rng.integers(0, 40, (rng.integers(0, 15), 2))
+        points = inside[:, 0]
+
+        for ins in [inside, points]:
+            win = ins if ins.ndim == 2 else np.stack((ins, ins), axis=1)
+            contains = ((outside[:, None, 0] <= win[None, :, 0])
+                        & (outside[:, None, 1] >= win[None, :, 1]))
+            start_in = ((outside[:, None, 0] >= win[None, :, 0])
+                        & (outside[:, None, 0] <= win[None, :, 1]))
+            end_in = ((outside[:, None, 1] >= win[None, :, 0])
+                      & (outside[:, None, 1] <= win[None, :, 1]))
+
+            [incl, excl, set2] = utils.filterWindows(outside, ins)
+
+            assert np.array_equal(incl, (contains | start_in | end_in).any(axis=1))
+            assert np.array_equal(excl, ~incl)
+            assert np.array_equal(set2, contains.sum(axis=0) == 1)
+
+
+
 
-#TODO: Test single and list input for converters
+def test_time_converters(ecog_df):
+    
+    utc_str = ecog_df['Raw UTC timestamp']
+    expected = [1580972555980000, 1580972615980000, 1580972616004000, 
+                1580972616020000, 1580972616080000, 1580972555980000]
+    
+    # Single and list input
+    assert utils.str2dt_usec(utc_str[0]) == expected[0]
+    assert utils.str2dt_usec(pd.Timestamp(utc_str[0])) == expected[0]
+    assert utils.str2dt_usec(utc_str.tolist()) == expected
+    assert utils.posix2dt_UTC(expected[0]) == pd.Timestamp(utc_str[0]).to_pydatetime()
+    assert utils.posix2dt_UTC(expected[:2]) == [pd.Timestamp(x).to_pydatetime() for x in utc_str[:2]]
+    
+    # Vectorized column input
+    usec = utils.str2usec(utc_str)
+    assert usec.dtype == np.int64 and (usec == expected).all()
+    assert (utils.str2usec(pd.to_datetime(utc_str)) == expected).all()
+    assert isinstance(utils.str2usec(utc_str[0]), np.int64) and utils.str2usec(utc_str[0]) == expected[0]
+    assert (utils.usec2dt64(usec) == pd.to_datetime(utc_str).values).all()
+    assert (utils.usec2str(usec) == utc_str).all()
+    assert utils.usec2str(usec + 999)[0] == '2020-02-06 07:02:35.980'
     
 
 ## NPDataHandler TESTS ##
@@ -193,6 +258,149 @@ def test_NPdeidentifier(tstlogger, tmpdir,tst_config, ecog_df, exmpl_dat):
     npdh.NPdeidentifier(ptID, tst_config)
     loadDeviceDataFromFiles([ptID], tst_config)
 
+def test_loadDeviceData_append(tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    ptID = 'RNS001'
+    ecog_df = _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    ecog_pth = npdh.NPgetDataPath(ptID, tst_config, 'ecog catalog')
+    os.makedirs(os.path.join(tst_config['paths']['RNS_DATA_Folder'], ptID))
+    
+    # Aggregate first three events, then append the rest
+    ecog_df.iloc[:3].to_csv(ecog_pth, index=False)
+    loadDeviceDataFromFiles([ptID], tst_config, append=True)
+    
+    manifest_pth = utils.getDataPath(ptID, tst_config, 'device data manifest')
+    assert pd.read_csv(manifest_pth).Filename.tolist() == ecog_df.Filename[:3].tolist()
+    
+    ecog_df.to_csv(ecog_pth, index=False)
+    loadDeviceDataFromFiles([ptID], tst_config, append=True)
+    
+    appended = hdf5storage.loadmat(utils.getDataPath(ptID, tst_config, 'device data'))
+    appended_cat = pd.read_csv(utils.getDataPath(ptID, tst_config, 'ecog catalog'))
+    assert pd.read_csv(manifest_pth).Filename.tolist() == ecog_df.Filename.tolist()
+    
+    # Min/max pyramid was extended with the appended data
+    with minmax_pyramid.openPyramid(ptID, tst_config) as pyr:
+        assert pyr.n_samples == appended['AllData'].shape[0]
+        assert (pyr.level(16)[1][0] == appended['AllData'][:16].max(axis=0)).all()
+    
+    # Running again without new data is a no-op
+    assert process_raw.appendDeviceDataFromFiles(ptID, tst_config)
+    
+    # Compare to a full rebuild
+    loadDeviceDataFromFiles([ptID], tst_config)
+    
+    rebuilt = hdf5storage.loadmat(utils.getDataPath(ptID, tst_config, 'device data'))
+    rebuilt_cat = pd.read_csv(utils.getDataPath(ptID, tst_config, 'ecog catalog'))
+    
+    assert (appended['AllData'] == rebuilt['AllData']).all()
+    assert (appended['EventIdx'] == rebuilt['EventIdx']).all()
+    assert appended_cat.equals(rebuilt_cat)
+    
+    # Appends interrupted before the manifest is written require a full rebuild
+    mat_pth = utils.getDataPath(ptID, tst_config, 'device data')
+    device_data.appendDeviceData(mat_pth, rebuilt['AllData'][:10], [[0, 9]])
+    assert not process_raw.appendDeviceDataFromFiles(ptID, tst_config)
+    loadDeviceDataFromFiles([ptID], tst_config, append=True)
+    assert (hdf5storage.loadmat(mat_pth)['AllData'] == rebuilt['AllData']).all()
+    
+    # Modified .dat files require a full rebuild
+    with open(os.path.join(npdh.NPgetDataPath(ptID, tst_config, 'dat folder'), '12345.dat'), 'ab') as f:
+        f.write(bytes(exmpl_dat.T.reshape(-1,1)))
+    assert not process_raw.appendDeviceDataFromFiles(ptID, tst_config)
+
+
+def test_loadDeviceData_pyramidError(monkeypatch, tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    ptID = 'RNS001'
+    ecog_df = _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    os.makedirs(os.path.join(tst_config['paths']['RNS_DATA_Folder'], ptID))
+    
+    def fail(*args, **kwargs):
+        raise OSError('Fake error')
+    monkeypatch.setattr(minmax_pyramid, 'updateDeviceDataPyramid', fail)
+    
+    # Failed pyramid updates don't fail the load, and the manifest is current
+    assert loadDeviceDataFromFiles([ptID], tst_config) == []
+    manifest_pth = utils.getDataPath(ptID, tst_config, 'device data manifest')
+    assert pd.read_csv(manifest_pth).Filename.tolist() == ecog_df.Filename.tolist()
+    assert process_raw.appendDeviceDataFromFiles(ptID, tst_config)
+
+
+def test_run_pipeline(tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    for ptID in ['RNS001', 'RNS002']:
+        _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    config_pth = os.path.join(tmpdir, 'config.JSON')
+    with open(config_pth, 'w') as f:
+        json.dump(tst_config, f)
+    
+    status = run_pipeline.main(['--config', config_pth, '--stages', 'deidentify', 'aggregate',
+                                '--jobs', '2'])
+    assert status == 0
+    
+    log_dir = os.path.join(tst_config['paths']['RNS_RAW_Folder'], 'logs')
+    assert sorted(os.listdir(log_dir)) == ['RNS001.log', 'RNS002.log']
+    with open(os.path.join(log_dir, 'RNS002.log')) as f:
+        assert 'RNS001' not in f.read()
+    for ptID in ['RNS001', 'RNS002']:
+        assert os.path.exists(utils.getDataPath(ptID, tst_config, 'device data'))
+    
+    # Missing patient fails without stopping the others
+    status = run_pipeline.main(['--config', config_pth, '--stages', 'aggregate', '--append',
+                                '--patients', 'RNS001', 'RNS003', '--jobs', '2'])
+    assert status == 1
+    
+
+def test_writeDeviceData(tmpdir):
+    
+    rng = np.random.default_rng(0)
+    AllData = rng.integers(-512, 512, size=(5000, 4)).astype(np.int16)
+    eventIdx = np.array([[0, 1999], [2000, 3499], [3500, 4999]], dtype=np.int32)
+    mat_pth = os.path.join(tmpdir, 'Device_Data.mat')
+    
+    device_data.writeDeviceData(mat_pth, AllData[:3500], eventIdx[:2])
+    assert device_data.isAppendable(mat_pth)
+    
+    appendIdx = device_data.appendDeviceData(mat_pth, AllData[3500:], eventIdx[2:]-3500)
+    assert (appendIdx == eventIdx[2:]).all()
+    
+    with open(mat_pth, 'rb') as f:
+        header = f.read(128)
+    assert header.startswith(b'MATLAB 7.3 MAT-file')
+    assert header[-4:] == b'\x00\x02IM'
+    
+    with h5py.File(mat_pth, 'r') as f:
+        assert f['AllData'].shape == (4, 5000)
+        assert f['AllData'].chunks[1] == 1750  # median event length
+        assert f['AllData'].compression == 'gzip'
+        assert (f['AllData'][:, 2000:3500] == AllData[2000:3500].T).all()
+        
+    mat = hdf5storage.loadmat(mat_pth)
+    assert (mat['AllData'] == AllData).all()
+    assert (mat['EventIdx'] == eventIdx).all()
+    
+    # Lazy reader, with joined catalog
+    catalog = pd.DataFrame({'ECoG trigger': ['Scheduled', 'Magnet', 'Long Episode'],
+                            'Event Start idx': eventIdx[:,0]+1})
+    with device_data.DeviceData(mat_pth, catalog) as dd:
+        assert len(dd) == 3
+        assert dd.shape == AllData.shape
+        assert (dd[1] == AllData[2000:3500]).all()
+        assert (dd[-1] == AllData[3500:]).all()
+        assert len(dd[0:2]) == 2 and (dd[[2]][0] == dd[2]).all()
+        assert (dd.samples(1990, 2010) == AllData[1990:2010]).all()
+        assert (np.concatenate([x for x in dd]) == AllData).all()
+        assert dd.catalog['ECoG trigger'][1] == 'Magnet'
+    
+    # Files written without chunking can't be appended to
+    hdf5storage.savemat(mat_pth, {"AllData": AllData, "EventIdx":eventIdx}, 
+                        format ='7.3', oned_as='column', store_python_metadata=True)
+    assert not device_data.isAppendable(mat_pth)
+    with pytest.raises(ValueError):
+        device_data.appendDeviceData(mat_pth, AllData, eventIdx)
+    
+
 def test_NPgetDataPath(tmpdir,tst_config, ecog_df, exmpl_dat):
     
     ptID = 'RNS001'
@@ -218,11 +426,38 @@ def test_dat2mat(tst_config, tmpdir, ecog_df, exmpl_dat):
     ptID = 'RNS001'
     
     _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
-    npdh.NPdat2mat(ptID, tst_config)
+    [AllData, eventIdx, dneIdx] = npdh.NPdat2mat(ptID, tst_config)
     
     print(tmpdir)
     
-    # TODO: test case where some .dat files are missing
+    # Note, last file has 2 channels on, so it is read as 2n samples long
+    n = exmpl_dat.shape[1]
+    assert AllData.dtype == np.int16
+    assert AllData.flags['C_CONTIGUOUS']
+    assert AllData.shape == (6*n, 4)
+    assert (AllData[:n] == exmpl_dat.T-512).all()
+    assert (AllData[4*n:, [1,2]] == 0).all()
+    assert (eventIdx == np.array([[0,n-1], [n,2*n-1], [2*n,3*n-1], [3*n,4*n-1], [4*n,6*n-1]])).all()
+    assert dneIdx == []
+    
+    # Test case where some .dat files are missing, with disk-backed AllData
+    os.remove(os.path.join(npdh.NPgetDataPath(ptID, tst_config, 'dat folder'), '23456.dat'))
+    mmap_pth = os.path.join(tmpdir, 'AllData.bin')
+    [AllData2, eventIdx2, dneIdx2] = npdh.NPdat2mat(ptID, tst_config, memmap_path=mmap_pth)
+    
+    assert isinstance(AllData2, np.memmap)
+    assert dneIdx2 == [1]
+    assert (AllData2 == np.delete(AllData, np.s_[n:2*n], axis=0)).all()
+    assert (eventIdx2 == np.array([[0,n-1], [n,2*n-1], [2*n,3*n-1], [3*n,5*n-1]])).all()
+    
+    # Parallel decoding gives the same result, in memory and disk-backed
+    [AllData3, eventIdx3, dneIdx3] = npdh.NPdat2mat(ptID, tst_config, n_jobs=2)
+    [AllData4, eventIdx4, dneIdx4] = npdh.NPdat2mat(ptID, tst_config, n_jobs=3,
+                                                    memmap_path=os.path.join(tmpdir, 'AllData_par.bin'))
+    
+    assert (AllData3 == AllData2).all() and (AllData4 == AllData2).all()
+    assert (eventIdx3 == eventIdx2).all() and (eventIdx4 == eventIdx2).all()
+    assert dneIdx3 == dneIdx4 == dneIdx2
         
 
 def test_readDatFile(tmpdir, ecog_df, exmpl_dat):
@@ -237,6 +472,37 @@ def test_readDatFile(tmpdir, ecog_df, exmpl_dat):
     [fdata1, ftime1, t_conv1]= npdh._readDatFile(p, ecog_df.iloc[[0]])
     assert (fdata1 == exmpl_dat-512).all()
 
+def test_readDatFile_memmap(tmpdir, ecog_df, exmpl_dat):
+    
+    p = tmpdir.mkdir("test_dats")
+    
+    with open(os.path.join(p,"12345.dat"), 'wb') as f:
+        f.write(bytes(exmpl_dat.T.reshape(-1,1)))
+        
+    with open(os.path.join(p,"56789.dat"), 'wb') as f:
+        f.write(bytes(exmpl_dat[[0,3],:].T.reshape(-1,1)))
+    
+    [fdata1, ftime1, t_conv1] = npdh._readDatFile(p, ecog_df.iloc[[0]])
+    [datf1, tinfo1, t_conv1m] = npdh._readDatFile(p, ecog_df.iloc[[0]], memmap=True)
+    
+    assert isinstance(datf1.raw, np.memmap)
+    assert tinfo1 == (1580972555964000, 250, exmpl_dat.shape[1])
+    assert (tinfo1.vector() == ftime1).all()
+    assert t_conv1m == t_conv1
+    assert (datf1.toArray().T == fdata1).all()
+    assert all((datf1.channel(i) == exmpl_dat[i]-512).all() for i in range(4))
+    
+    # Channels 2 and 3 are off, and should be zero-padded
+    [datf2, tinfo2, _] = npdh._readDatFile(p, ecog_df.iloc[[4]], memmap=True)
+    [fdata2, _, _] = npdh._readDatFile(p, ecog_df.iloc[[4]])
+    
+    assert (datf2.rawChannel(3) == exmpl_dat[3]).all()
+    assert datf2.rawChannel(1) is None
+    assert (datf2.channel(2) == 0).all()
+    assert (fdata2[[0,3]] == exmpl_dat[[0,3]]-512).all()
+    assert (fdata2[[1,2]] == 0).all()
+    
+
 def test_readDatFile_empty(tmpdir, ecog_df):
     p = tmpdir.mkdir("test_dats")
     
@@ -285,6 +551,15 @@ def test_createConcatDatLayFiles(tmpdir, tst_config, ecog_df, exmpl_dat):
     rm_dict2 = npdh.createConcatDatLayFiles(ptID, tst_config, ecog_df.iloc[0:-1], 'test02_concat', newpath)
     assert rm_dict2 == {'34567.dat': 40.0, '45678.dat': 32.0}
     assert os.path.getsize(os.path.join(tmpdir,'test_dats','test02_concat.dat')) == 88*4-40 
+    
+    # Plan matches the bytes written and the bytes removed
+    plan = npdh.planConcatDatFiles(ptID, tst_config, ecog_df.iloc[0:-1])
+    kept = plan[plan['Keep']]
+    assert (kept['Samples']*8).sum() == 88*4-40
+    assert (plan['Trim bytes'] % 8 == 0).all()
+    assert (np.diff(kept['Start usec']) > 0).all()
+    assert dict(zip(plan['Filename'][plan['Overlap usec'] >= 0], 
+                    plan['Trim bytes'][plan['Overlap usec'] >= 0])) == rm_dict2
       
     # Test with one file 
     print('test03_concat')
@@ -292,9 +567,321 @@ def test_createConcatDatLayFiles(tmpdir, tst_config, ecog_df, exmpl_dat):
     assert rm_dict3 == {}
     assert os.path.getsize(os.path.join(tmpdir,'test_dats','test03_concat.dat')) == os.path.getsize(os.path.join(p,"12345.dat"))
     
+    # Truncated files with off channels are not silently realigned
+    with open(os.path.join(p,"56789.dat"), 'ab') as f:
+        f.write(b'\x00\x02')
+    with pytest.raises(ValueError):
+        npdh.createConcatDatLayFiles(ptID, tst_config, ecog_df[ecog_df.Filename == '56789.dat'],
+                                     'test04_concat', newpath)
+    
+@pytest.mark.parametrize('kernel_copy', [True, False])
+def test_copyFileRange(tmpdir, monkeypatch, kernel_copy):
+    
+    if not kernel_copy:
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+        monkeypatch.delattr(os, 'sendfile', raising=False)
+    monkeypatch.setattr(npdh, 'COPY_CHUNK_SAMPLES', 3)
+    
+    data = bytes(range(200))
+    src = os.path.join(tmpdir, 'src.dat')
+    dst = os.path.join(tmpdir, 'dst.dat')
+    with open(src, 'wb') as f:
+        f.write(data)
+    
+    with open(dst, 'wb', buffering=0) as out:
+        out.write(b'head')
+        with open(src, 'rb', buffering=0) as infile:
+            npdh._copyFileRange(infile, out, 40)
+        out.write(b'tail')
+        
+    with open(dst, 'rb') as f:
+        assert f.read() == b'head' + data[40:] + b'tail'
+    
+
 def test_getOffChs(ecog_df):
     ch = npdh._getOffChs(ecog_df, "12345.dat")
     print(ch)
+    
+
+def test_EcogCatalog(tmpdir, ecog_df, exmpl_dat):
+    
+    p = tmpdir.mkdir("test_dats")
+    with open(os.path.join(p,"12345.dat"), 'wb') as f:
+        f.write(bytes(exmpl_dat.T.reshape(-1,1)))
+    
+    catalog = ecog_catalog.EcogCatalog(ecog_df, p)
+    
+    assert len(catalog) == ecog_df.shape[0]
+    assert catalog.pos('56789.dat') == 4
+    assert catalog.pos(os.path.join(p, '56789.dat')) == 4
+    assert catalog.offChs('56789.dat') == npdh._getOffChs(ecog_df, '56789.dat') == [2,3]
+    assert npdh._getOffChs(catalog, '12345.dat') == []
+    assert (catalog.n_enabled == [4,4,4,4,2,4]).all()
+    assert catalog.nbytes[0] == exmpl_dat.nbytes and (catalog.nbytes[1:] == -1).all()
+    assert catalog.start_usec[2] == 1580972616004000 - 16000
+    assert catalog.end_usec[2] == catalog.start_usec[2] + 44000
+    
+    # Times match dataframe parsing
+    assert npdh._getTimeStrings(catalog) == npdh._getTimeStrings(ecog_df)
+    
+    # Subsets keep parsed arrays and filename index
+    sub = catalog.subset([4, 0])
+    assert sub.filenames.tolist() == ['56789.dat', '12345.dat']
+    assert sub.pos('12345.dat') == 1 and sub.nbytes[1] == exmpl_dat.nbytes
+    assert npdh._getTimeStrings(sub) == npdh._getTimeStrings(ecog_df.iloc[[4, 0]])
+    assert ecog_catalog.asCatalog(sub) is sub
+    
+    # Single row reads
+    [fdata1, ftime1, t_conv1] = npdh._readDatFile(p, catalog.subset([0]))
+    [fdata2, ftime2, t_conv2] = npdh._readDatFile(p, ecog_df.iloc[[0]])
+    assert (fdata1 == fdata2).all() and (ftime1 == ftime2).all() and t_conv1 == t_conv2
+
+
+def test_EventIndex(tmpdir, tst_config, ecog_df, exmpl_dat):
+
+    ptID = 'RNS001'
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    os.makedirs(os.path.join(tst_config['paths']['RNS_DATA_Folder'], ptID))
+    loadDeviceDataFromFiles([ptID], tst_config)
+
+    # Dense AllTime from the deidentified catalog rows
+    cat = pd.read_csv(utils.getDataPath(ptID, tst_config, 'ecog catalog'))
+    dat_folder = npdh.NPgetDataPath(ptID, tst_config, 'dat folder')
+    times = [npdh._readDatFile(dat_folder, cat.iloc[[i]]) for i in range(cat.shape[0])]
+    AllTime = np.concatenate([t for _, t, _ in times])
+    offsets = np.concatenate([np.full(len(t), c) for _, t, c in times])
+
+    with device_data.openDeviceData(ptID, tst_config) as dd:
+        index = dd.index
+        n_samples = dd.shape[0]
+        eventIdx = dd.eventIdx
+
+    assert len(index) == 5 and n_samples == len(AllTime)
+    assert (index.bounds([0, 4]) == [[0, 11], [44, 66]]).all()  # 2 channel file
+
+    idx = np.arange(n_samples)
+    assert (index.event(idx) == np.repeat(np.arange(5), [11, 11, 11, 11, 22])).all()
+    assert (index.usec(idx) == AllTime).all()
+    assert (index.usec(idx, local=True) == AllTime - offsets).all()
+
+    # Times map back to the same sample, or to a later event overlapping it
+    solo = (idx < 11) | (idx >= 44)
+    assert (index.idx(AllTime)[solo] == idx[solo]).all()
+    assert (index.idx(AllTime - offsets, local=True)[solo] == idx[solo]).all()
+    assert (index.usec(index.idx(AllTime)) == AllTime).all()
+    assert (index.event(index.idx(AllTime[11:44])) >= index.event(idx[11:44])).all()
+    assert (index.idx(AllTime[[3, 7]] + 1000) == [3, 7]).all()
+
+    # Outside of all events
+    assert (index.event([-1, n_samples]) == -1).all()
+    assert np.isnan(index.usec([n_samples])).all()
+    assert (index.idx([AllTime[0] - 10**6, AllTime[10] + 10**6]) == -1).all()
+
+    # Matches a catalog built from a DataFrame and explicit indices
+    index2 = event_index.fromCatalog(cat.drop(columns=['Event Start idx', 'Event End idx']), eventIdx)
+    assert (index2.usec(idx) == AllTime).all()
+    assert (event_index.openEventIndex(ptID, tst_config).event(idx) == index.event(idx)).all()
+
+    # Stim times from the index (no stims in example data)
+    [SSI, stats, times] = stim_detection.findPatientStims(ptID, tst_config)
+    assert SSI.shape == times.shape == (0, 2)
+
+
+def test_decimateMinMax():
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, (1003, 4)).astype(np.int16)
+
+    [pos, vals] = visualize.decimateMinMax(data, 10)
+    assert pos.shape == vals.shape and pos.shape[0] <= 2*10+2
+    assert (np.diff(pos, axis=0) >= 0).all()
+    assert (vals == np.take_along_axis(data, pos, axis=0)).all()
+    assert (vals.min(axis=0) == data.min(axis=0)).all()
+    assert (vals.max(axis=0) == data.max(axis=0)).all()
+
+    # Each bucket keeps its extremes
+    b = -(-1003 // 10)
+    for k in range(1003 // b):
+        bucket = data[k*b:(k+1)*b]
+        assert (np.sort(vals[2*k:2*k+2], axis=0) == [bucket.min(axis=0), bucket.max(axis=0)]).all()
+
+    # Short data is not decimated
+    [pos, vals] = visualize.decimateMinMax(data[:15], 10)
+    assert (vals == data[:15]).all() and (pos[:, 0] == np.arange(15)).all()
+
+
+def test_vis_event(tmpdir, tst_config, ecog_df, exmpl_dat):
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    ptID = 'RNS001'
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    os.makedirs(os.path.join(tst_config['paths']['RNS_DATA_Folder'], ptID))
+    loadDeviceDataFromFiles([ptID], tst_config)
+
+    with device_data.openDeviceData(ptID, tst_config) as dd:
+        AllData = dd.samples(0, dd.shape[0]).T
+        index = dd.index
+        catalog = dd.catalog
+        AllTime = index.usec(np.arange(dd.shape[0]))
+
+        # Event index and dense AllTime give the same plot
+        ax1 = visualize.vis_event(dd, index, catalog, [3, 50])
+        ax2 = visualize.vis_event(AllData, AllTime, catalog, [3, 50], width=4)
+
+    line1 = ax1[1][0].get_lines()[0]
+    line2 = ax2[1][0].get_lines()[0]
+    assert (line1.get_xdata() == utils.usec2dt64(AllTime[44:66])).all()
+    assert (line1.get_ydata() == AllData[0, 44:66]).all()
+    assert len(line2.get_xdata()) == 8
+    assert line2.get_ydata().max() == AllData[0, 44:66].max()
+    assert ax1[0][0].get_title() == 'Scheduled Event'
+
+    ax = visualize.vis_span(AllData, index, 0, 66, width=5)
+    assert len(ax.get_lines()[3].get_xdata()) == 10
+
+    # Parallel batch rendering
+    out = os.path.join(tmpdir, 'packet')
+    files = visualize.renderEvents(ptID, tst_config, [4, 0, 2], out, n_jobs=2)
+    assert [os.path.basename(f) for f in files] == ['RNS001_event4.png', 'RNS001_event0.png',
+                                                    'RNS001_event2.png']
+    assert all(os.path.getsize(f) > 0 for f in files)
+
+
+@pytest.mark.parametrize('block', [minmax_pyramid.PYRAMID_BLOCK_SAMPLES, 8192])
+def test_MinMaxPyramid(tmpdir, monkeypatch, block):
+
+    monkeypatch.setattr(minmax_pyramid, 'PYRAMID_BLOCK_SAMPLES', block)
+    rng = np.random.default_rng(0)
+    data = rng.integers(-512, 512, (50000, 4)).astype(np.int16)
+    dat_file = os.path.join(tmpdir, 'month.dat')
+
+    def expected(level):
+        bins = np.arange(0, data.shape[0], level)
+        return np.minimum.reduceat(data, bins), np.maximum.reduceat(data, bins)
+
+    # Build from the first part of the file, then extend
+    data[:20000].tofile(dat_file)
+    pyr_file = minmax_pyramid.buildDatPyramid(dat_file)
+    assert pyr_file == os.path.join(tmpdir, 'month_pyramid.h5')
+
+    with open(dat_file, 'ab') as f:
+        f.write(data[20000:].tobytes())
+    assert minmax_pyramid.updatePyramid(pyr_file, np.memmap(dat_file, np.int16).reshape(-1, 4)) \
+        == 50000 - 16384
+
+    with minmax_pyramid.MinMaxPyramid(pyr_file) as pyr:
+        assert pyr.n_samples == 50000 and pyr.levels == (16, 256, 4096)
+        for level in pyr.levels:
+            [mins, maxs] = pyr.level(level)
+            assert (mins[()] == expected(level)[0]).all()
+            assert (maxs[()] == expected(level)[1]).all()
+
+        # Coarsest level with enough bins
+        [level, pos, mins, maxs] = pyr.query(0, 50000, 100)
+        assert level == 256 and len(pos) == 196 and (maxs[()] == expected(256)[1]).all()
+
+        [level, pos, mins, maxs] = pyr.query(1000, 9000, 100)
+        assert level == 16 and pos[0] == 992 and pos[-1] == 8992
+        assert (mins == expected(16)[0][62:563]).all()
+
+        # Short ranges read raw samples if given data
+        [level, pos, mins, maxs] = pyr.query(1000, 1100, 200, data)
+        assert level == 1 and (mins == data[1000:1100]).all()
+
+        # Time ranges, two events of 25000 samples at 250 Hz
+        index = event_index.EventIndex([[0, 24999], [25000, 49999]], [0, 200*10**6], [0, 0], 250)
+        [level, pos, mins, maxs] = pyr.queryTime(4*10**6, 200*10**6 + 4*10**6, 100, index)
+        assert level == 16 and pos[0] == 992 and pos[-1] == 25984
+
+    # Shorter data rebuilds
+    minmax_pyramid.updatePyramid(pyr_file, data[:100])
+    with minmax_pyramid.MinMaxPyramid(pyr_file) as pyr:
+        assert pyr.n_samples == 100 and pyr.level(16)[0].shape == (7, 4)
+
+
+def _findStimReference(AllData, eventStarts, Min=15):
+    # Line by line port of findStim.m (0-indexed), for comparison
+
+    def runInds(q, maxRun):
+        s = np.diff(np.concatenate(([0], q.astype(int), [0])))
+        iboth = np.nonzero(np.abs(s) == 1)[0]
+        indOut = np.zeros(len(q), dtype=bool)
+        for i_beg, i_end in zip(iboth[0::2], iboth[1::2]):
+            if i_end - i_beg < maxRun:
+                indOut[i_beg:i_end] = True
+        return indOut
+
+    AllData = AllData.T.astype(int) + 512
+    Slope = np.diff(AllData, axis=1)
+    Slope[:, eventStarts] = 1
+
+    SSI_all = []
+    for Channel in range(4):
+        Slope[Channel, runInds(AllData[Channel] < 100, Min)[:-1]] = 1
+        Slope[Channel, runInds(AllData[Channel] > 900, Min)[:-1]] = 1
+
+        ZeroSlopeInflections = np.diff((Slope[Channel] == 0).astype(int))
+        ZeroSlopeStarts = np.nonzero(ZeroSlopeInflections == 1)[0] + 1
+        ZeroSlopeEnds = np.nonzero(ZeroSlopeInflections == -1)[0] + 1
+        if ZeroSlopeEnds[-1] < ZeroSlopeStarts[-1]:
+            ZeroSlopeStarts = ZeroSlopeStarts[:-1]
+
+        keep = ZeroSlopeEnds - ZeroSlopeStarts >= Min
+        SSI_all += [(x, 1) for x in ZeroSlopeStarts[keep]] + [(x, -1) for x in ZeroSlopeEnds[keep]]
+
+    srted = np.array(sorted(SSI_all, key=lambda x: x[0]))
+    ivl_count = np.cumsum(srted[:, 1])
+    is2 = np.nonzero(ivl_count == 2)[0]
+    SSI_start = list(srted[is2[ivl_count[is2+1] == 3], 0])
+    SSI_end = list(srted[is2[ivl_count[is2-1] == 3], 0])
+
+    StimGap = np.array(SSI_start[1:]) - np.array(SSI_end[:-1])
+    incl = [((e <= eventStarts) & (eventStarts <= s)).any() for e, s in zip(SSI_end[:-1], SSI_start[1:])]
+    i_gp = [i for i in range(len(StimGap)) if StimGap[i] < 100 and not incl[i]]
+    SSI_start = [x for i, x in enumerate(SSI_start) if i-1 not in i_gp]
+    SSI_end = [x for i, x in enumerate(SSI_end) if i not in i_gp]
+
+    return np.stack((SSI_start, SSI_end), axis=1)
+
+
+@pytest.mark.parametrize('chunk, n_jobs', [(None, 1), (5000, 3)])
+def test_findStim(monkeypatch, chunk, n_jobs):
+
+    if chunk:
+        monkeypatch.setattr(stim_detection, 'STIM_CHUNK_SAMPLES', chunk)
+
+    # Noisy events with flat stims on 2-4 channels, some close together or
+    # at event edges, short and long rail flatlines, and an off channel
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(500, 3000, 30)
+    eventStarts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    AllData = rng.integers(-300, 300, (lengths.sum(), 4)).astype(np.int16)
+
+    for i_start in rng.integers(0, AllData.shape[0] - 200, 150):
+        chs = rng.choice(4, rng.integers(2, 5), replace=False)
+        for i_beg in [i_start, i_start + rng.integers(20, 120)]:
+            AllData[i_beg:i_beg + rng.integers(10, 60), chs] = rng.integers(-50, 50)
+    for i_start in rng.integers(0, AllData.shape[0] - 50, 60):
+        AllData[i_start:i_start + rng.integers(3, 40), rng.integers(4)] = rng.choice([-512, 511])
+    for i_start in eventStarts[5:7]:
+        AllData[i_start - 8:i_start + 12, :3] = 7
+    AllData[eventStarts[10]:eventStarts[11], 1] = 0
+
+    expected = _findStimReference(AllData, eventStarts)
+    assert len(expected) > 50
+
+    [SSI, stats] = stim_detection.findStim(AllData, eventStarts, n_jobs=n_jobs)
+    assert (SSI == expected).all()
+    assert (stats['StimLengths'] == expected[:, 1] - expected[:, 0]).all()
+    assert stats['MaxStimLength'] == stats['StimLengths'].max()
+    assert (SSI[stats['MinStimIndex'], 1] - SSI[stats['MinStimIndex'], 0] == stats['MinStimLength']).all()
+
+    # Channels first input, and no stims
+    assert (stim_detection.findStim(AllData.T, eventStarts)[0] == expected).all()
+    [SSI, stats] = stim_detection.findStim(AllData[:200]*0 + rng.integers(-9, 9, (200, 4)), [0])
+    assert SSI.shape == (0, 2) and stats['MaxStimIndex'] is None
 
 
 def test_getTimeStrings(ecog_df):
@@ -328,8 +915,608 @@ def test_getTimeStrings(ecog_df):
     
     
     
+## Box Sync TESTS ##
+
+class _FakeBoxItem:
+    
+    def __init__(self, item_type, item_id, name, data=None):
+        self.type = item_type
+        self.id = item_id
+        self.name = name
+        self.data = data
+        if data is not None:
+            self.size = len(data)
+            self.sha1 = hashlib.sha1(data).hexdigest()
+            self.etag = self.sha1[:8]
+            
+            
+class _FakeBoxClient:
+    # Local stand-in for the boxsdk Client, serving a tree of {name: bytes or
+    # dict} from memory. Downloads take latency seconds. The first download of
+    # files in interrupt stops halfway with an error, the first download of 
+    # files in corrupt returns altered data.
+    
+    def __init__(self, tree, latency=0, interrupt=(), corrupt=()):
+        self.items = {}
+        self.children = {}
+        self._addFolder('0', 'All Files', tree)
+        self.latency = latency
+        self.interrupt = set(interrupt)
+        self.corrupt = set(corrupt)
+        self.n_listings = {}
+        self.byte_ranges = []
+        self.n_active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        
+    def _addFolder(self, folder_id, name, tree):
+        
+        # Folders are modified when anything they contain changes
+        self.items[folder_id] = _FakeBoxItem('folder', folder_id, name)
+        self.items[folder_id].modified_at = hashlib.sha1(repr(tree).encode()).hexdigest()
+        self.children[folder_id] = []
+        for i, (child, val) in enumerate(tree.items()):
+            child_id = '%s.%d'%(folder_id, i)
+            if isinstance(val, dict):
+                self._addFolder(child_id, child, val)
+            else:
+                self.items[child_id] = _FakeBoxItem('file', child_id, child, val)
+            self.children[folder_id].append(self.items[child_id])
+            
+    def folder(self, folder_id):
+        client = self
+        class Folder:
+            def get(self, fields=None):
+                return client.items[folder_id]
+            def get_items(self, fields=None):
+                client.n_listings[folder_id] = client.n_listings.get(folder_id, 0) + 1
+                return iter(client.children[folder_id])
+        return Folder()
+    
+    def file(self, file_id):
+        client = self
+        item = self.items[file_id]
+        class File:
+            def download_to(self, f, byte_range=None):
+                with client._lock:
+                    client.n_active += 1
+                    client.max_active = max(client.max_active, client.n_active)
+                    interrupt = item.name in client.interrupt
+                    corrupt = item.name in client.corrupt
+                    client.interrupt.discard(item.name)
+                    client.corrupt.discard(item.name)
+                    if byte_range:
+                        client.byte_ranges.append((item.name, byte_range))
+                time.sleep(client.latency)
+                with client._lock:
+                    client.n_active -= 1
+                data = item.data if byte_range is None else item.data[byte_range[0]:byte_range[1]+1]
+                if interrupt:
+                    f.write(data[:len(data)//2])
+                    raise ConnectionError('Fake connection reset')
+                f.write(bytes(len(data)) if corrupt else data)
+        return File()
+    
+    
+def test_downloadFolder(tmpdir, monkeypatch):
+    
+    monkeypatch.setattr(box_sync, 'DOWNLOAD_RETRY_WAIT', 0)
+    files = {'%02d.dat'%i: bytes(range(i, 100+i)) for i in range(12)}
+    tree = {'pt': {'Data': files, 'catalog.csv': b'a,b\n1,2\n'}}
+    client = _FakeBoxClient(tree, latency=0.01, interrupt=['03.dat', '07.dat'], corrupt=['05.dat'])
+    
+    # Truncated file left by an earlier run is replaced
+    os.makedirs(os.path.join(tmpdir, 'pt', 'Data'))
+    with open(os.path.join(tmpdir, 'pt', 'Data', '01.dat'), 'wb') as f:
+        f.write(files['01.dat'][:10])
+    
+    summary = box_sync.downloadFolder(client, '0.0', tmpdir, n_threads=4)
+    assert summary == {'downloaded': 13, 'skipped': 0, 'failed': []}
+    assert client.max_active == 4
+    assert set(client.n_listings.values()) == {1}
+    
+    # Interrupted downloads resumed from where they stopped
+    assert sorted(client.byte_ranges) == [('03.dat', (50, 99)), ('07.dat', (50, 99))]
+    for name, data in files.items():
+        with open(os.path.join(tmpdir, 'pt', 'Data', name), 'rb') as f:
+            assert f.read() == data
+    assert not [f for f in os.listdir(os.path.join(tmpdir, 'pt', 'Data')) if f.endswith('.part')]
+    
+    # Only missing files are downloaded again
+    os.remove(os.path.join(tmpdir, 'pt', 'Data', '02.dat'))
+    summary = box_sync.downloadFolder(client, '0.0', tmpdir, n_threads=4)
+    assert summary == {'downloaded': 1, 'skipped': 12, 'failed': []}
+    
+    # Persistent failures are reported, and leave no file behind
+    client.corrupt = set(['04.dat'])
+    os.remove(os.path.join(tmpdir, 'pt', 'Data', '04.dat'))
+    assert not box_sync.downloadFile(client, client.items['0.0.0.4'], 
+                                     os.path.join(tmpdir, 'pt', 'Data', '04.dat'), retries=0)
+    assert not os.path.exists(os.path.join(tmpdir, 'pt', 'Data', '04.dat'))
+    
+    
+def test_NPdownloadNewBoxData(tmpdir, tst_config, monkeypatch):
+    
+    monkeypatch.setattr(box_sync, 'DOWNLOAD_RETRY_WAIT', 0)
+    ptID = 'RNS001'
+    tst_config['boxKeys'] = {'Folder_ID': '0'}
+    
+    root = os.path.basename(npdh.NPgetDataPath(ptID, tst_config, 'root folder'))
+    pre = root.replace(' EXTERNAL #PHI', '')
+    tree = {root: {pre + '_ECoG_Catalog.csv': b'a,b\n',
+                   pre + ' Histograms EXTERNAL #PHI': {pre + '_Histogram_Daily.csv': b'1'},
+                   pre + ' EpisodeDurations EXTERNAL #PHI': {'ep.csv': b'2'},
+                   pre + ' Data EXTERNAL #PHI': {'12345.dat': b'1234', '23456.dat': b'5678'}}}
+    client = _FakeBoxClient(tree)
+    
+    # New patient, then update with a new .dat file
+    npdh.NPdownloadNewBoxData(ptID, tst_config, client)
+    assert sorted(os.listdir(npdh.NPgetDataPath(ptID, tst_config, 'dat folder'))) == ['12345.dat', '23456.dat']
+    
+    tree[root][pre + ' Data EXTERNAL #PHI']['34567.dat'] = b'9012'
+    client = _FakeBoxClient(tree, interrupt=['34567.dat'])
+    npdh.NPdownloadNewBoxData(ptID, tst_config, client)
+    
+    with open(os.path.join(npdh.NPgetDataPath(ptID, tst_config, 'dat folder'), '34567.dat'), 'rb') as f:
+        assert f.read() == b'9012'
+    assert os.path.exists(npdh.NPgetDataPath(ptID, tst_config, 'daily histogram'))
+    assert os.path.exists(npdh.NPgetDataPath(ptID, tst_config, 'ecog catalog'))
+    
+
+def test_streamPatientData(tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    # Raw data for both patients served by a fake Box client
+    tree = {}
+    for ptID in ['RNS001', 'RNS002']:
+        root = os.path.basename(npdh.NPgetDataPath(ptID, tst_config, 'root folder'))
+        pre = root.replace(' EXTERNAL #PHI', '')
+        tree[root] = {pre + '_ECoG_Catalog.csv': ecog_df[:-1].to_csv(index=False).encode(),
+                      pre + ' Data EXTERNAL #PHI': {f: bytes(exmpl_dat.T.reshape(-1,1)) 
+                                                    for f in ecog_df.Filename[:-1]}}
+    tree['other'] = {}
+    tst_config['boxKeys'] = {'Folder_ID': '0'}
+    
+    errlist = process_raw.streamPatientData(['RNS001', 'RNS002', 'RNS003'], tst_config,
+                                            _FakeBoxClient(tree), n_workers=2)
+    assert errlist == ['RNS003']
+    
+    for ptID in ['RNS001', 'RNS002']:
+        with device_data.openDeviceData(ptID, tst_config) as dd:
+            assert len(dd) == 5
+            assert 'Initials' not in dd.catalog
+            assert (dd.catalog['Event Start idx'] == dd.eventIdx[:,0] + 1).all()
+    
+
+def test_syncFolder(tmpdir, tst_config):
+    
+    hist = {'daily.csv': b'1,2', 'hourly.csv': b'3,4'}
+    tree = {'pt': {'catalog.csv': b'a,b', 'Histograms': hist,
+                   'Data': {'%02d.dat'%i: bytes([i]*10) for i in range(5)}}}
+    manifest_pth = os.path.join(tmpdir, 'manifest.json')
+    
+    def sync(client, full=False):
+        manifest = box_sync.BoxManifest(manifest_pth)
+        return box_sync.syncFolder(client, client.items['0.0'], tmpdir, manifest, full=full)
+    
+    # First sync lists and downloads everything
+    summary = sync(_FakeBoxClient(tree))
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (8, 0, 3)
+    
+    # Unchanged folders are not listed
+    client = _FakeBoxClient(tree)
+    summary = sync(client)
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (0, 8, 0)
+    assert client.n_listings == {}
+    
+    # Only changed file is downloaded, unchanged Data folder is not listed
+    hist['daily.csv'] = b'5,6'
+    client = _FakeBoxClient(tree)
+    summary = sync(client)
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (1, 7, 2)
+    with open(os.path.join(tmpdir, 'pt', 'Histograms', 'daily.csv'), 'rb') as f:
+        assert f.read() == b'5,6'
+    
+    # Missing local files are downloaded again, full sync lists every folder
+    os.remove(os.path.join(tmpdir, 'pt', 'Data', '03.dat'))
+    summary = sync(_FakeBoxClient(tree))
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (1, 7, 1)
+    summary = sync(_FakeBoxClient(tree), full=True)
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (0, 8, 3)
+    
+    # Files downloaded before the manifest existed are checked by SHA1
+    os.remove(manifest_pth)
+    with open(os.path.join(tmpdir, 'pt', 'catalog.csv'), 'wb') as f:
+        f.write(b'x,y')
+    summary = sync(_FakeBoxClient(tree))
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (1, 7, 3)
+    
+
+def test_syncFolder_nested(tmpdir):
+    
+    tree = {'pt': {'catalog.csv': b'a,b', 'Data': {'2020': {'01.dat': b'1'}}}}
+    manifest = box_sync.BoxManifest(os.path.join(tmpdir, 'manifest.json'))
+    client = _FakeBoxClient(tree)
+    box_sync.syncFolder(client, client.items['0.0'], tmpdir, manifest)
+    
+    # Only the grandchild folder changes, pt and Data keep their modified_at
+    old = {i: client.items[i].modified_at for i in ['0.0', '0.0.1']}
+    tree['pt']['Data']['2020']['02.dat'] = b'2'
+    client = _FakeBoxClient(tree)
+    for i, modified in old.items():
+        client.items[i].modified_at = modified
+    
+    summary = box_sync.syncFolder(client, client.items['0.0'], tmpdir, manifest)
+    assert (summary['downloaded'], summary['skipped'], summary['listed']) == (1, 2, 1)
+    assert list(client.n_listings) == ['0.0.1.0']
+    assert os.path.exists(os.path.join(tmpdir, 'pt', 'Data', '2020', '02.dat'))
+    
+
 ## Pennsieve Tools TESTS ##
 
+class _FakeLayer:
+    
+    def __init__(self, name):
+        self.name = name
+        self.annots = []
+        self.n_fetches = 0
+        
+    def annotations(self):
+        self.n_fetches += 1
+        return list(self.annots)
+    
+    
+class _FakeTimeSeries:
+    # Local stand-in for a Pennsieve timeseries package. Annotation inserts
+    # take latency seconds, and the first n_errors inserts raise errors
+    
+    def __init__(self, name, state='READY', latency=0, n_errors=0, error=ConnectionError):
+        self.name = name
+        self.type = 'TimeSeries'
+        self.state = state
+        self._layers = {}
+        self.latency = latency
+        self.n_errors = n_errors
+        self.error = error
+        self.n_calls = 0
+        self.n_active = 0
+        self.max_active = 0
+        self.n_layer_listings = 0
+        self.n_process = 0
+        self._lock = threading.Lock()
+        
+    @property
+    def layers(self):
+        self.n_layer_listings += 1
+        return list(self._layers.values())
+    
+    def get_layer(self, name):
+        return self._layers[name]
+    
+    def add_layer(self, name):
+        return self._layers.setdefault(name, _FakeLayer(name))
+    
+    def process(self):
+        self.n_process += 1
+        self.state = 'PROCESSING' if getattr(self, 'polls_to_ready', 0) > 0 else 'READY'
+        
+    def insert_annotation(self, layer, label, start, end, description=None):
+        
+        with self._lock:
+            self.n_calls += 1
+            self.n_active += 1
+            self.max_active = max(self.max_active, self.n_active)
+            fail = self.n_calls <= self.n_errors
+        time.sleep(self.latency)
+        with self._lock:
+            self.n_active -= 1
+        if fail:
+            raise self.error('Fake error')
+        
+        annot = type('Annotation', (), {'label': label, 'start': start, 'end': end,
+                                        'description': description})
+        self.add_layer(layer).annots.append(annot)
+        
+
+class _FakeCollection:
+    # Local stand-in for a Pennsieve collection, records uploaded files and
+    # the number of times its items are listed. As in the Pennsieve client,
+    # items are listed once and cached until the collection is fetched again
+    
+    def __init__(self, name, items=()):
+        self.name = name
+        self.id = 'N:collection:%s'%name
+        self.type = 'Collection'
+        self.state = 'READY'
+        self._items = list(items)
+        self._listed = None
+        self.uploaded = []
+        self.tmp_peak = 0
+        self.n_listings = 0
+        
+    @property
+    def items(self):
+        if self._listed is None:
+            self.n_listings += 1
+            self._listed = list(self._items)
+        return list(self._listed)
+    
+    def fetch(self):
+        # Drop the cached listing, processing timeseries with polls_to_ready 
+        # set finish after that many fetches
+        self._listed = None
+        for i in self._items:
+            if i.state == 'PROCESSING' and getattr(i, 'polls_to_ready', 0) > 0:
+                i.polls_to_ready -= 1
+                i.state = 'READY' if i.polls_to_ready == 0 else 'PROCESSING'
+        return self
+    
+    def get_items_by_name(self, name):
+        return [i for i in self.items if i.name == name]
+    
+    def create_collection(self, name):
+        self._items.append(_FakeCollection(name))
+        if self._listed is not None:
+            self._listed.append(self._items[-1])
+        return self._items[-1]
+    
+    def upload(self, path, display_progress=False):
+        files = sorted(os.listdir(path))
+        self.uploaded += files
+        self._items += [_FakeTimeSeries(f[:-4], 'UPLOADED') for f in files if f.endswith('.dat')]
+        
+        # Largest number of month folders on disk at upload time
+        self.tmp_peak = max(self.tmp_peak, len(os.listdir(os.path.dirname(path))))
+        
+
+class _FakePennsieve:
+    # Local stand-in for the Pennsieve client with a single dataset
+    
+    def __init__(self, collections=()):
+        self.dataset = _FakeCollection('pytest', collections)
+        self.dataset.type = 'DataSet'
+        self.n_fetches = 0
+        
+    def get_dataset(self, name):
+        self.n_fetches += 1
+        return self.dataset.fetch()
+    
+    def get(self, id):
+        self.n_fetches += 1
+        return [i for i in self.dataset._items if i.id == id][0].fetch()
+    
+    
+@pytest.mark.parametrize('n_jobs, max_tmp_bytes', [(1, None), (2, None), (2, 1)])
+def test_uploadNewDatByMonth(tmpdir, tst_config, ecog_df, exmpl_dat, n_jobs, max_tmp_bytes):
+    
+    ptID = 'RNS001'
+    
+    # Spread events over three months, first month already uploaded
+    ecog_df['Raw UTC timestamp'] = ['2020-01-06 07:02:35.980', '2020-02-06 07:03:35.980',
+                                    '2020-02-06 07:03:36.004', '2020-03-06 07:03:36.020',
+                                    '2020-03-06 07:03:36.080', '2020-03-06 07:03:36.080']
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    
+    collection = _FakeCollection(ptID, [_FakeTimeSeries('%s_2020_01'%ptID)])
+    pnsv = _FakePennsieve([collection])
+    
+    groups = pennsieve_tools._monthGroups(utils.str2usec(ecog_df['Raw UTC timestamp']))
+    assert list(groups.keys()) == [(2020, 1), (2020, 2), (2020, 3)]
+    assert groups[(2020, 3)].tolist() == [3, 4, 5]
+    
+    pennsieve_tools.uploadNewDatByMonth(ptID, tst_config, pnsv, n_jobs=n_jobs, 
+                                        max_tmp_bytes=max_tmp_bytes)
+    assert sorted(collection.uploaded) == ['RNS001_2020_02.dat', 'RNS001_2020_02.lay',
+                                           'RNS001_2020_03.dat', 'RNS001_2020_03.lay']
+    if max_tmp_bytes:
+        assert collection.tmp_peak == 1
+    
+    # Month pyramids are kept after the month files are uploaded
+    pyr_path = utils.getDataPath(ptID, tst_config, 'month pyramid folder')
+    assert sorted(os.listdir(pyr_path)) == ['RNS001_2020_02_pyramid.h5', 'RNS001_2020_03_pyramid.h5']
+    with minmax_pyramid.MinMaxPyramid(os.path.join(pyr_path, 'RNS001_2020_03_pyramid.h5')) as pyr:
+        assert pyr.n_samples == 3*exmpl_dat.shape[1]
+    
+
+def test_uploadNewDatByMonth_failed(monkeypatch, tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    ptID = 'RNS001'
+    ecog_df['Raw UTC timestamp'] = ['2020-01-06 07:02:35.980', '2020-02-06 07:03:35.980',
+                                    '2020-02-06 07:03:36.004', '2020-03-06 07:03:36.020',
+                                    '2020-03-06 07:03:36.080', '2020-03-06 07:03:36.080']
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    
+    collection = _FakeCollection(ptID)
+    pnsv = _FakePennsieve([collection])
+    pennsieve_tools.clear_listing_cache()
+    
+    # Failed month builds are returned, other months are still uploaded
+    build = npdh.createConcatDatLayFiles
+    def fail_feb(ptID, config, catalog, ts_name, path):
+        if ts_name.endswith('2020_02'):
+            raise OSError('Fake error')
+        return build(ptID, config, catalog, ts_name, path)
+    monkeypatch.setattr(npdh, 'createConcatDatLayFiles', fail_feb)
+    
+    assert pennsieve_tools.uploadNewDatByMonth(ptID, tst_config, pnsv) == ['RNS001_2020_02']
+    assert sorted(collection.uploaded) == ['RNS001_2020_01.dat', 'RNS001_2020_01.lay',
+                                           'RNS001_2020_03.dat', 'RNS001_2020_03.lay']
+    
+    # Failed month is built on the next run
+    monkeypatch.setattr(npdh, 'createConcatDatLayFiles', build)
+    assert pennsieve_tools.uploadNewDatByMonth(ptID, tst_config, pnsv) == []
+    assert 'RNS001_2020_02.dat' in collection.uploaded
+    
+
+def test_run_pipeline_upload(monkeypatch, tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    import pennsieve
+    
+    ptID = 'RNS001'
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    config_pth = os.path.join(tmpdir, 'config.JSON')
+    with open(config_pth, 'w') as f:
+        json.dump(tst_config, f)
+    
+    # Failed uploads fail the patient
+    collection = _FakeCollection(ptID)
+    def upload(path, display_progress=False):
+        raise ConnectionError('Fake error')
+    collection.upload = upload
+    monkeypatch.setattr(pennsieve, 'Pennsieve', lambda: _FakePennsieve([collection]))
+    pennsieve_tools.clear_listing_cache()
+    
+    status = run_pipeline.main(['--config', config_pth, '--stages', 'upload'])
+    assert status == 1
+    with open(os.path.join(tst_config['paths']['RNS_RAW_Folder'], 'logs', 'RNS001.log')) as f:
+        assert 'upload stage reported a failure' in f.read()
+    
+
+def test_CollectionListing(tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    ptID = 'RNS001'
+    ecog_df['Raw UTC timestamp'] = ['2020-01-06 07:02:35.980', '2020-02-06 07:03:35.980',
+                                    '2020-03-06 07:03:36.004', '2020-03-06 07:03:36.020',
+                                    '2020-05-06 07:03:36.080', '2020-05-06 07:03:36.080']
+    ecog_df['ECoG trigger'] = ['Scheduled', 'Scheduled', 'Long_Episode', 'Scheduled', 
+                               'Saturation', 'Scheduled']
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    
+    collection = _FakeCollection(ptID, [_FakeTimeSeries('%s_2020_01'%ptID)])
+    pnsv = _FakePennsieve([collection])
+    pennsieve_tools.clear_listing_cache()
+    
+    # Upload, process and annotate every month with one fetch and listing per step 
+    # that changes the collection, independent of number of months
+    pennsieve_tools.uploadNewDatByMonth(ptID, tst_config, pnsv)
+    assert pennsieve_tools.annotate_UTC_from_catalog(ptID, tst_config, pnsv)
+    assert pennsieve_tools.annotate_UTC_from_catalog(ptID, tst_config, pnsv)
+    assert collection.n_listings == 3
+    assert pnsv.dataset.n_listings == 1
+    assert pnsv.n_fetches == 3
+    
+    listing = pennsieve_tools.get_pt_listing(ptID, tst_config, pnsv)
+    assert listing.collection is collection
+    assert listing.state('%s_2020_03'%ptID) == 'READY'
+    assert listing.get('%s_2021_01'%ptID) is None
+    assert [len(l.annots) for l in listing.get('%s_2020_05'%ptID).layers] == [1]
+    
+    # Annotations are inserted in the layer of their own trigger type
+    for ts in listing.items:
+        for layer in ts._layers.values():
+            assert all(a.label.startswith(layer.name) for a in layer.annots)
+    
+
+def test_LabelCache(tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    ptID = 'RNS001'
+    _setupRawDir(ptID, tst_config, tmpdir, ecog_df, exmpl_dat)
+    
+    ts = _FakeTimeSeries('%s_2020_02'%ptID)
+    pnsv = _FakePennsieve([_FakeCollection(ptID, [ts])])
+    pennsieve_tools.clear_listing_cache()
+    
+    def n_remote_calls():
+        return ts.n_layer_listings + sum(l.n_fetches for l in ts._layers.values())
+    
+    # First run fetches remote state, next run only uses the persisted cache
+    assert pennsieve_tools.annotate_UTC_from_catalog(ptID, tst_config, pnsv)
+    n_calls = n_remote_calls()
+    pennsieve_tools.clear_listing_cache()
+    assert pennsieve_tools.annotate_UTC_from_catalog(ptID, tst_config, pnsv)
+    assert n_remote_calls() == n_calls
+    assert sum(len(l.annots) for l in ts._layers.values()) == 5
+    
+    # Full sync fetches all layers again, without duplicating annotations
+    pennsieve_tools.annotate_UTC_from_catalog(ptID, tst_config, pnsv, sync='full')
+    assert n_remote_calls() > n_calls
+    assert sum(len(l.annots) for l in ts._layers.values()) == 5
+    
+    # Stale entries and replaced timeseries are fetched again
+    listing = pennsieve_tools.get_pt_listing(ptID, tst_config, pnsv)
+    cache_pth = utils.getDataPath(ptID, tst_config, 'pennsieve label cache')
+    cache = pennsieve_tools.LabelCache(cache_pth, max_age=0)
+    time.sleep(0.01)
+    assert len(cache.labels(listing, ts, 'Scheduled')) == 5
+    assert ts._layers['Scheduled'].n_fetches == 2
+    
+    pennsieve_tools.clear_listing_cache()
+    listing = pennsieve_tools.get_pt_listing(ptID, tst_config, pnsv)
+    n_listings = ts.n_layer_listings
+    cache = pennsieve_tools.LabelCache(cache_pth)
+    assert cache.layers(listing, ts) == ['Scheduled']
+    assert ts.n_layer_listings == n_listings
+    ts.id = 'N:package:1'
+    assert cache.layers(listing, ts) == ['Scheduled']
+    assert ts.n_layer_listings == n_listings + 1
+    
+
+def test_poll_catalog_annotations(tmpdir, tst_config, ecog_df, exmpl_dat):
+    
+    ecog_df['Raw UTC timestamp'] = ['2020-01-06 07:02:35.980', '2020-02-06 07:03:35.980',
+                                    '2020-02-06 07:03:36.004', '2020-03-06 07:03:36.020',
+                                    '2020-03-06 07:03:36.080', '2020-03-06 07:03:36.080']
+    _setupRawDir('RNS001', tst_config, tmpdir, ecog_df, exmpl_dat)
+    _setupRawDir('RNS002', tst_config, tmpdir, ecog_df, exmpl_dat)
+    
+    # RNS001 months finish processing at different times, one RNS002 month never does
+    ts1 = [_FakeTimeSeries('RNS001_2020_01'), _FakeTimeSeries('RNS001_2020_02', 'UPLOADED'),
+           _FakeTimeSeries('RNS001_2020_03', 'PROCESSING')]
+    ts1[1].polls_to_ready = 2
+    ts1[2].polls_to_ready = 4
+    ts2 = [_FakeTimeSeries('RNS002_2020_01'), _FakeTimeSeries('RNS002_2020_02', 'PROCESSING')]
+    ts2[1].polls_to_ready = 10**6
+    pnsv = _FakePennsieve([_FakeCollection('RNS001', ts1), _FakeCollection('RNS002', ts2)])
+    pennsieve_tools.clear_listing_cache()
+    
+    t0 = time.monotonic()
+    ptDone = pennsieve_tools.poll_catalog_annotations(['RNS001', 'RNS002'], tst_config, pnsv,
+                                                      deadline=0.5, min_wait=0.01, max_wait=0.04)
+    assert ptDone == {'RNS001': True, 'RNS002': False}
+    assert time.monotonic() - t0 < 1
+    
+    n_annots = lambda ts: sum(len(l.annots) for l in ts._layers.values())
+    assert [n_annots(ts) for ts in ts1] == [1, 2, 2]
+    assert [n_annots(ts) for ts in ts2] == [1, 0]
+    assert ts1[1].n_process == 1
+    
+
+def test_insert_annotations(monkeypatch):
+    
+    monkeypatch.setattr(pennsieve_tools, 'ANNOT_RETRY_WAIT', 0)
+    annots = [('Layer %d'%(i%2), 'annot %d'%i, i*10**6, (i+1)*10**6) for i in range(40)]
+    
+    # Concurrent inserts, new layers created by a single insert
+    ts = _FakeTimeSeries('RNS001_2020_01', latency=0.01)
+    summary = pennsieve_tools.insert_annotations(ts, annots, n_threads=4)
+    assert summary == {'inserted': 40, 'failed': 0}
+    assert ts.max_active == 4
+    assert [len(l.annots) for l in ts.layers] == [20, 20]
+    
+    # Transient errors are retried
+    ts = _FakeTimeSeries('RNS001_2020_01', n_errors=3)
+    summary = pennsieve_tools.insert_annotations(ts, annots, n_threads=4, retries=3)
+    assert summary == {'inserted': 40, 'failed': 0}
+    assert ts.n_calls == 43
+    
+    # Other errors are not
+    ts = _FakeTimeSeries('RNS001_2020_01', n_errors=3, error=ValueError)
+    summary = pennsieve_tools.insert_annotations(ts, annots, n_threads=4)
+    assert summary == {'inserted': 37, 'failed': 3}
+    assert ts.n_calls == 40
+    
+    # HTTP errors are only retried for rate limits and server errors
+    def http_error(status):
+        response = requests.Response()
+        response.status_code = status
+        return lambda msg: requests.HTTPError(msg, response=response)
+    
+    for status, n_calls, n_failed in [(503, 43, 0), (429, 43, 0), (400, 40, 3), (404, 40, 3)]:
+        ts = _FakeTimeSeries('RNS001_2020_01', n_errors=3, error=http_error(status))
+        summary = pennsieve_tools.insert_annotations(ts, annots, n_threads=4, retries=3)
+        assert summary == {'inserted': 40 - n_failed, 'failed': n_failed}
+        assert ts.n_calls == n_calls
+    
+
 # # Test uplooad
 # def test_Pennsieve_layer_tools(tst_config, tmpdir, ecog_df, exmpl_dat):
    
@@ -376,4 +1563,4 @@ def test_getTimeStrings(ecog_df):
     
     
 
-    
\ No newline at end of file
+    